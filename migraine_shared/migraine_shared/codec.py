@@ -0,0 +1,47 @@
+"""
+JSON encoding and decoding.
+
+Uses orjson if it is installed, falling back to the standard library json.
+"""
+
+import json
+from typing import Any, Callable, Optional, Union
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj: Any, *, default: Optional[Callable] = None, sort_keys: bool = False) -> bytes:
+    """
+    Encode obj as UTF-8 JSON.
+
+    Args:
+        default: Called to obtain a serializable version of an object that cannot otherwise be serialized.
+        sort_keys: Whether to sort the keys of each object.
+    """
+    if orjson:
+        return orjson.dumps(
+            obj,
+            default=default,
+            option=orjson.OPT_NON_STR_KEYS | (orjson.OPT_SORT_KEYS if sort_keys else 0),
+        )
+
+    return json.dumps(
+        obj,
+        default=default,
+        sort_keys=sort_keys,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    ).encode("utf-8")
+
+
+def loads(data: Union[bytes, bytearray, str]) -> Any:
+    """
+    Decode JSON.
+    """
+    if orjson:
+        return orjson.loads(data)
+
+    return json.loads(data)
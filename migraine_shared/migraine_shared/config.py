@@ -1,7 +1,10 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from pathlib import Path
 import ruamel.yaml
-from typing import Union
+from typing import Dict, Optional, Union
+
+import migraine_shared.password
+import migraine_shared.routing
 
 
 @dataclass(frozen=True)
@@ -16,6 +19,13 @@ class CouchDBConfig:
     cookie_auth_secret: str
     uuid: str
 
+    routing: Optional[migraine_shared.routing.RoutingTable] = None
+    """
+    Routing of users to clusters, parsed from an optional list of clusters.
+
+    If clusters are not provided, every user is on the cluster at baseurl.
+    """
+
     @staticmethod
     def load(couchdb_config_path: Union[Path, str]):
         couchdb_config_path = Path(couchdb_config_path)
@@ -34,7 +44,12 @@ class CouchDBConfig:
             admin_user=yaml_config["admin"]["user"],
             admin_password=yaml_config["admin"]["password"],
             cookie_auth_secret=yaml_config["cookieAuthSecret"],
-            uuid=yaml_config["uuid"]
+            uuid=yaml_config["uuid"],
+            routing=(
+                migraine_shared.routing.RoutingTable.parse(yaml_config["clusters"])
+                if "clusters" in yaml_config
+                else migraine_shared.routing.RoutingTable.single(baseurl=yaml_config["baseurl"])
+            ),
         )
 
 
@@ -51,6 +66,132 @@ class FlaskConfig:
     database_admin_password: str
     database_admin_user: str
 
+    database_routing: Optional[migraine_shared.routing.RoutingTable] = None
+    """
+    Routing of users to database clusters, parsed from an optional list of database_clusters.
+
+    If clusters are not provided, every user is on the cluster at database_baseurl.
+    """
+
+    database_internal_baseurls: Dict[str, str] = field(default_factory=dict)
+    """
+    Internal baseurl of each cluster, used for server-side calls in place of its public baseurl.
+
+    Parsed from an optional database_internal_baseurl, which is the internal baseurl of database_baseurl,
+    and from an optional internal_baseurl of each of database_clusters.
+    """
+
+    database_connect_timeout: float = 3.05
+    """
+    Seconds to wait when connecting to the database.
+    """
+
+    database_read_timeout: float = 10
+    """
+    Seconds to wait between bytes of a response from the database.
+    """
+
+    database_request_deadline: float = 20
+    """
+    Seconds within which every database call made in serving a request must complete.
+    """
+
+    create_user_max_concurrent: int = 4
+    """
+    Maximum concurrent requests to create a user.
+    """
+
+    create_user_max_waiting: int = 16
+    """
+    Maximum requests to create a user that wait for one of create_user_max_concurrent.
+    """
+
+    create_user_wait_timeout: float = 5
+    """
+    Seconds a request to create a user waits before it is rejected.
+    """
+
+    create_user_rate: float = 1
+    """
+    Requests to create a user allowed per second from each client, once its burst is used.
+    """
+
+    create_user_burst: int = 10
+    """
+    Requests to create a user allowed from each client in a burst.
+    """
+
+    trusted_proxy_hops: int = 1
+    """
+    Proxies in front of Flask (e.g., ingress) that each append the address they received from to X-Forwarded-For.
+
+    The client is the address appended by the outermost trusted proxy, as any earlier address can be spoofed.
+    """
+
+    password_hash_iterations: Optional[int] = None
+    """
+    PBKDF2 iterations used to derive password keys in Flask.
+
+    If provided, keys are derived in a Flask process pool, rather than by CouchDB from a plaintext password.
+    """
+
+    password_hash_processes: int = migraine_shared.password.PASSWORD_EXECUTOR_DEFAULT_WORKERS
+    """
+    Processes in the pool deriving password keys.
+
+    Each process is a separate interpreter, so the pool is sized to the memory available to Flask.
+    """
+
+    compression_minimum_size: int = 1024
+    """
+    Minimum bytes of a response body before it is compressed.
+    """
+
+    compression_gzip_level: int = 6
+    """
+    Level of gzip compression, from 1 (fastest) to 9 (smallest).
+    """
+
+    compression_brotli_quality: int = 4
+    """
+    Quality of brotli compression, from 0 (fastest) to 11 (smallest).
+    """
+
+    cache_control: str = "private, no-cache"
+    """
+    Cache-Control applied to cacheable responses.
+
+    The default allows a client to cache, but requires revalidation using the ETag on every use.
+    """
+
+    cors_max_age: int = 600
+    """
+    Seconds a browser may cache a CORS preflight response.
+    """
+
+    user_directory_snapshot_path: Optional[str] = None
+    """
+    Path of a snapshot used to bootstrap the in-memory user directory.
+
+    If not provided, the user directory is built from the beginning of the _users changes feed.
+    """
+
+    capture_path: Optional[str] = None
+    """
+    Path of a file to which sanitized request traces are captured, for replay.
+
+    If not provided, requests are not captured.
+    """
+
+    capture_max_bytes: int = 10 * 1024 * 1024
+    """
+    Bytes of a capture file before it is rotated.
+    """
+
+    capture_backup_count: int = 5
+    """
+    Rotated capture files retained.
+    """
 
     @staticmethod
     def load(flask_config_path: Union[Path, str]):
@@ -64,10 +205,55 @@ class FlaskConfig:
 
     @staticmethod
     def parse(yaml_config: dict):
+        database_internal_baseurls = {}
+        if "database_internal_baseurl" in yaml_config:
+            database_internal_baseurls[yaml_config["database_baseurl"]] = yaml_config["database_internal_baseurl"]
+        for cluster in yaml_config.get("database_clusters", []):
+            if "internal_baseurl" in cluster:
+                database_internal_baseurls[cluster["baseurl"]] = cluster["internal_baseurl"]
+
         return FlaskConfig(
             baseurl=yaml_config["baseurl"],
             secret_key=yaml_config["secret_key"],
             database_baseurl=yaml_config["database_baseurl"],
             database_admin_user=yaml_config["database_admin"]["user"],
             database_admin_password=yaml_config["database_admin"]["password"],
+            database_routing=(
+                migraine_shared.routing.RoutingTable.parse(yaml_config["database_clusters"])
+                if "database_clusters" in yaml_config
+                else migraine_shared.routing.RoutingTable.single(baseurl=yaml_config["database_baseurl"])
+            ),
+            database_internal_baseurls=database_internal_baseurls,
+            database_connect_timeout=float(
+                yaml_config.get("database_connect_timeout", FlaskConfig.database_connect_timeout)
+            ),
+            database_read_timeout=float(
+                yaml_config.get("database_read_timeout", FlaskConfig.database_read_timeout)
+            ),
+            database_request_deadline=float(
+                yaml_config.get("database_request_deadline", FlaskConfig.database_request_deadline)
+            ),
+            create_user_max_concurrent=int(yaml_config.get("create_user_max_concurrent", FlaskConfig.create_user_max_concurrent)),
+            create_user_max_waiting=int(yaml_config.get("create_user_max_waiting", FlaskConfig.create_user_max_waiting)),
+            create_user_wait_timeout=float(yaml_config.get("create_user_wait_timeout", FlaskConfig.create_user_wait_timeout)),
+            create_user_rate=float(yaml_config.get("create_user_rate", FlaskConfig.create_user_rate)),
+            create_user_burst=int(yaml_config.get("create_user_burst", FlaskConfig.create_user_burst)),
+            trusted_proxy_hops=int(yaml_config.get("trusted_proxy_hops", FlaskConfig.trusted_proxy_hops)),
+            password_hash_iterations=(
+                int(yaml_config["password_hash_iterations"])
+                if yaml_config.get("password_hash_iterations") is not None
+                else None
+            ),
+            password_hash_processes=int(
+                yaml_config.get("password_hash_processes", FlaskConfig.password_hash_processes)
+            ),
+            compression_minimum_size=int(yaml_config.get("compression_minimum_size", FlaskConfig.compression_minimum_size)),
+            compression_gzip_level=int(yaml_config.get("compression_gzip_level", FlaskConfig.compression_gzip_level)),
+            compression_brotli_quality=int(yaml_config.get("compression_brotli_quality", FlaskConfig.compression_brotli_quality)),
+            cache_control=yaml_config.get("cache_control", FlaskConfig.cache_control),
+            cors_max_age=int(yaml_config.get("cors_max_age", FlaskConfig.cors_max_age)),
+            user_directory_snapshot_path=yaml_config.get("user_directory_snapshot_path"),
+            capture_path=yaml_config.get("capture_path"),
+            capture_max_bytes=int(yaml_config.get("capture_max_bytes", FlaskConfig.capture_max_bytes)),
+            capture_backup_count=int(yaml_config.get("capture_backup_count", FlaskConfig.capture_backup_count)),
         )
@@ -1,24 +1,57 @@
+import concurrent.futures
+import contextvars
 import hashlib
+import json
 import re
 import requests
+from typing import Dict, List, Optional, Tuple
 from urllib.parse import urljoin
 
+import migraine_shared.password
+import migraine_shared.routing
+import migraine_shared.session
+
+# CouchDB limits the number of databases in a single _dbs_info request.
+# https://docs.couchdb.org/en/stable/api/server/common.html#dbs-info
+DBS_INFO_BATCH_SIZE = 100
+
+# Seconds to wait for a password key derived in an executor, if the current deadline is not sooner.
+PASSWORD_DERIVATION_TIMEOUT = 10
+
+# Database on each cluster recording accounts whose database is queued for deletion, one document per account.
+# It is not a user database, so is never listed with them.
+TEARDOWN_DATABASE = "account_teardowns"
+
 
 def create_account(
     couchdb_session_admin: requests.Session,
-    couchdb_baseurl: str,
+    couchdb_baseurl: migraine_shared.routing.CouchDBLocation,
     account: str,
     password: str,
+    optimistic: bool = False,
+    password_executor: Optional[concurrent.futures.Executor] = None,
+    password_iterations: int = migraine_shared.password.PBKDF2_DEFAULT_ITERATIONS,
 ) -> requests.Response:
     """
     Use a session_admin to create an account.
 
+    If optimistic, do not first check whether the account exists.
+    Instead rely on CouchDB conflicts, rolling back any partial creation.
+    Creation then requires three requests instead of five.
+
+    If a password_executor is provided, the password key is derived in that executor with password_iterations,
+    and the user document is written without a plaintext password. Otherwise CouchDB derives the key.
+    Raises DeadlineExceeded if the key is not derived within the current deadline or PASSWORD_DERIVATION_TIMEOUT.
+
     If creation succeeds, return a "shallow" 200 Response.
     If the requested user is forbidden, return a "shallow" 403 Response.
     If the requested account already exists, return a "shallow" 409 Response.
     If an underlying request fails, return that Response.
     """
 
+    # Route to the cluster serving the account.
+    couchdb_baseurl = baseurl_for_user(couchdb_baseurl=couchdb_baseurl, user=account)
+
     # Ensure the requested_user is valid.
     if not validate_user(user=account):
         response = requests.Response()
@@ -30,13 +63,38 @@ def create_account(
     user_doc = {
         "type": "user",
         "name": account,
-        "password": password,
         "roles": [],
     }
+    if password_executor:
+        # Wait no longer than the current deadline, as derivation can be queued behind other requests.
+        remaining = migraine_shared.session.remaining()
+        timeout = PASSWORD_DERIVATION_TIMEOUT if remaining is None else min(remaining, PASSWORD_DERIVATION_TIMEOUT)
+
+        future = password_executor.submit(
+            migraine_shared.password.derive_password_fields,
+            password=password,
+            iterations=password_iterations,
+        )
+        try:
+            user_doc.update(future.result(timeout=max(timeout, 0)))
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise migraine_shared.session.DeadlineExceeded("Deadline exceeded deriving password key")
+    else:
+        user_doc["password"] = password
 
     # Name of a corresponding database.
     user_database = database_for_user(user=account)
 
+    if optimistic:
+        return _create_account_optimistic(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_baseurl,
+            account=account,
+            user_doc_id=user_doc_id,
+            user_doc=user_doc,
+        )
+
     # Ensure the user does not already exist.
     response = couchdb_session_admin.get(
         urljoin(couchdb_baseurl, "_users/{}".format(user_doc_id)),
@@ -73,6 +131,100 @@ def create_account(
     if not response.ok:
         return response
 
+    # Create the requested database.
+    response = create_database(
+        couchdb_session_admin=couchdb_session_admin,
+        couchdb_baseurl=couchdb_baseurl,
+        account=account,
+    )
+    if not response.ok:
+        return response
+
+    response = requests.Response()
+    response.status_code = 200
+    return response
+
+
+def _create_account_optimistic(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: migraine_shared.routing.CouchDBLocation,
+    account: str,
+    user_doc_id: str,
+    user_doc: Dict,
+) -> requests.Response:
+    """
+    Create an account without first checking whether it exists, as in create_account.
+    """
+
+    # Create the requested user.
+    # If the user already exists, this fails with a conflict.
+    response = couchdb_session_admin.put(
+        urljoin(couchdb_baseurl, "_users/{}".format(user_doc_id)),
+        json=user_doc,
+    )
+    if response.status_code in [409, 412]:
+        response = requests.Response()
+        response.reason = {"message": "User already exists."}
+        response.status_code = 409
+        return response
+    if not response.ok:
+        return response
+
+    user_doc_rev = response.json()["rev"]
+
+    # Create the requested database.
+    # If the database already exists, this fails with a precondition failure.
+    response = create_database(
+        couchdb_session_admin=couchdb_session_admin,
+        couchdb_baseurl=couchdb_baseurl,
+        account=account,
+    )
+    if not response.ok:
+        # Roll back the user we created.
+        couchdb_session_admin.delete(
+            urljoin(couchdb_baseurl, "_users/{}".format(user_doc_id)),
+            headers={"If-Match": user_doc_rev},
+        )
+
+        if response.status_code == 412:
+            # The database existed before we attempted to create it, so it is not rolled back.
+            response = requests.Response()
+            # Something is off we reach here, database shouldn't exist if the user doesn't exist.
+            response.reason = {
+                "message": "User database already exists."
+            }
+            response.status_code = 409
+            return response
+
+        # Roll back any database we created.
+        couchdb_session_admin.delete(
+            urljoin(couchdb_baseurl, database_for_user(user=account)),
+        )
+
+        return response
+
+    response = requests.Response()
+    response.status_code = 200
+    return response
+
+
+def create_database(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: migraine_shared.routing.CouchDBLocation,
+    account: str,
+) -> requests.Response:
+    """
+    Use a session_admin to create the database of an account, granting the account access.
+
+    If creation succeeds, return a "shallow" 200 Response.
+    If an underlying request fails, return that Response.
+    """
+
+    # Route to the cluster serving the account.
+    couchdb_baseurl = baseurl_for_user(couchdb_baseurl=couchdb_baseurl, user=account)
+
+    user_database = database_for_user(user=account)
+
     # Create the requested database.
     response = couchdb_session_admin.put(
         urljoin(couchdb_baseurl, user_database),
@@ -109,67 +261,398 @@ def create_account(
 
 def delete_account(
     couchdb_session_admin: requests.Session,
-    couchdb_baseurl: str,
+    couchdb_baseurl: migraine_shared.routing.CouchDBLocation,
     account: str,
 ) -> requests.Response:
     """
     Use a session_admin to delete an account.
 
+    The user document and the database are deleted concurrently.
+
     If deletion succeeds, return a "shallow" 204 Response.
     If the account did not exist, return a "shallow" 404 Response.
     If an underlying request fails, return that Response.
     """
 
-    # Name of a corresponding user document and database.
-    user_doc_id = "org.couchdb.user:{}".format(account)
-    user_database = database_for_user(user=account)
+    # Route to the cluster serving the account.
+    couchdb_baseurl = baseurl_for_user(couchdb_baseurl=couchdb_baseurl, user=account)
+
+    # The session is shared by both deletions, as the admin session of Flask is shared by the threads serving requests.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        # Each runs in a copy of the current context, so both are bounded by any current deadline.
+        future_user_document = executor.submit(
+            contextvars.copy_context().run,
+            delete_user_document,
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_baseurl,
+            account=account,
+        )
+        future_database = executor.submit(
+            contextvars.copy_context().run,
+            delete_database,
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_baseurl,
+            account=account,
+        )
 
-    # Account at least partially existed if either the user or the database existed
-    account_existed = False
+        responses = [future_user_document.result(), future_database.result()]
+
+    # If either deletion failed, return the underlying failure
+    for response_current in responses:
+        if response_current.status_code not in [204, 404]:
+            return response_current
+
+    response = requests.Response()
+    if any(response_current.status_code == 204 for response_current in responses):
+        # Successful deletion, the account at least partially existed
+        response.status_code = 204
+    else:
+        # No account existed
+        response.status_code = 404
+
+    return response
+
+
+def delete_user_document(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: migraine_shared.routing.CouchDBLocation,
+    account: str,
+) -> requests.Response:
+    """
+    Use a session_admin to delete the user document of an account.
+
+    If deletion succeeds, return a "shallow" 204 Response.
+    If the user document did not exist, return a "shallow" 404 Response.
+    If an underlying request fails, return that Response.
+    """
+
+    # Route to the cluster serving the account.
+    couchdb_baseurl = baseurl_for_user(couchdb_baseurl=couchdb_baseurl, user=account)
+
+    user_doc_id = "org.couchdb.user:{}".format(account)
 
     # Check if the user exists.
-    response = couchdb_session_admin.get(
+    # A HEAD provides the "_rev" in its ETag, without the document itself.
+    response = couchdb_session_admin.head(
         urljoin(couchdb_baseurl, "_users/{}".format(user_doc_id)),
     )
-    if response.ok:
-        # The account at least partially existed
-        account_existed = True
-
-        # The user exists, issue a delete including the "_rev" we obtained.
-        existing_user_doc = response.json()
-        response = couchdb_session_admin.delete(
-            urljoin(couchdb_baseurl, "_users/{}".format(user_doc_id)),
-            headers={"If-Match": existing_user_doc["_rev"]},
-        )
-        if not response.ok:
-            # Deletion failed, return the underlying failure
-            return response
+    if response.status_code == 404:
+        response = requests.Response()
+        response.status_code = 404
+        return response
+    if not response.ok:
+        return response
 
-    # Check if the database exists.
-    response = couchdb_session_admin.get(
-        urljoin(couchdb_baseurl, user_database),
+    # The user exists, issue a delete including the "_rev" we obtained.
+    response = couchdb_session_admin.delete(
+        urljoin(couchdb_baseurl, "_users/{}".format(user_doc_id)),
+        headers={"If-Match": response.headers["ETag"].strip('"')},
     )
-    if response.ok:
-        # The account at least partially existed
-        account_existed = True
+    if not response.ok:
+        # Deletion failed, return the underlying failure
+        return response
+
+    response = requests.Response()
+    response.status_code = 204
+    return response
 
-        # The database exists, issue a delete.
-        response = couchdb_session_admin.delete(urljoin(couchdb_baseurl, user_database))
-        if not response.ok:
-            # Deletion failed, return the underlying failure
-            return response
+
+def delete_database(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: migraine_shared.routing.CouchDBLocation,
+    account: str,
+) -> requests.Response:
+    """
+    Use a session_admin to delete the database of an account.
+
+    If deletion succeeds, return a "shallow" 204 Response.
+    If the database did not exist, return a "shallow" 404 Response.
+    If an underlying request fails, return that Response.
+    """
+
+    # Route to the cluster serving the account.
+    couchdb_baseurl = baseurl_for_user(couchdb_baseurl=couchdb_baseurl, user=account)
+
+    user_database = database_for_user(user=account)
+
+    # A delete of a database that does not exist fails with a 404, so no check is needed.
+    response = couchdb_session_admin.delete(urljoin(couchdb_baseurl, user_database))
+    if not response.ok and response.status_code != 404:
+        # Deletion failed, return the underlying failure
+        return response
+
+    database_existed = response.ok
 
     response = requests.Response()
-    if account_existed:
+    if database_existed:
         # Successful deletion
         response.status_code = 204
     else:
-        # No account existed
+        # No database existed
         response.status_code = 404
 
     return response
 
 
+def queue_database_teardown(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: migraine_shared.routing.CouchDBLocation,
+    account: str,
+) -> requests.Response:
+    """
+    Use a session_admin to queue deletion of the database of an account.
+
+    The queue is persisted in the TEARDOWN_DATABASE of the cluster serving the account,
+    so a queued deletion is not lost if the process that queued it stops before completing it.
+    Queueing is idempotent.
+
+    If queueing succeeds, return a "shallow" 202 Response.
+    If an underlying request fails, return that Response.
+    """
+
+    # Route to the cluster serving the account.
+    couchdb_baseurl = baseurl_for_user(couchdb_baseurl=couchdb_baseurl, user=account)
+
+    teardown_url = urljoin(couchdb_baseurl, "{}/{}".format(TEARDOWN_DATABASE, account))
+    teardown_doc = {"database": database_for_user(user=account)}
+
+    response = couchdb_session_admin.put(teardown_url, json=teardown_doc)
+    if response.status_code == 404:
+        # The teardown database is created on first use, and may be created concurrently.
+        response = couchdb_session_admin.put(urljoin(couchdb_baseurl, TEARDOWN_DATABASE))
+        if not response.ok and response.status_code != 412:
+            return response
+
+        response = couchdb_session_admin.put(teardown_url, json=teardown_doc)
+
+    # A conflict means the deletion is already queued
+    if not response.ok and response.status_code != 409:
+        return response
+
+    response = requests.Response()
+    response.status_code = 202
+    return response
+
+
+def complete_database_teardown(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: migraine_shared.routing.CouchDBLocation,
+    account: str,
+) -> requests.Response:
+    """
+    Use a session_admin to delete the database of an account queued by queue_database_teardown, then dequeue it.
+
+    An account may be created again after its deletion was queued, in which case its database is retained.
+
+    If the database is deleted, return a "shallow" 204 Response.
+    If the database did not exist, return a "shallow" 404 Response.
+    If the account exists again, so the database is retained, return a "shallow" 409 Response.
+    If an underlying request fails, return that Response.
+    """
+
+    # Route to the cluster serving the account.
+    couchdb_baseurl = baseurl_for_user(couchdb_baseurl=couchdb_baseurl, user=account)
+
+    response = couchdb_session_admin.head(
+        urljoin(couchdb_baseurl, "_users/org.couchdb.user:{}".format(account)),
+    )
+    if response.ok:
+        teardown_response = requests.Response()
+        teardown_response.status_code = 409
+    elif response.status_code == 404:
+        teardown_response = delete_database(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_baseurl,
+            account=account,
+        )
+        if teardown_response.status_code not in [204, 404]:
+            return teardown_response
+    else:
+        return response
+
+    # Dequeue, using the "_rev" provided by a HEAD in its ETag.
+    teardown_url = urljoin(couchdb_baseurl, "{}/{}".format(TEARDOWN_DATABASE, account))
+    response = couchdb_session_admin.head(teardown_url)
+    if response.ok:
+        response = couchdb_session_admin.delete(
+            teardown_url,
+            headers={"If-Match": response.headers["ETag"].strip('"')},
+        )
+    # Another process may have completed the same teardown
+    if not response.ok and response.status_code not in [404, 409]:
+        return response
+
+    return teardown_response
+
+
+def pending_database_teardowns(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: str,
+) -> List[str]:
+    """
+    Use a session_admin to obtain the accounts whose database deletion is queued on a cluster.
+
+    Raises if an underlying request fails.
+    """
+
+    response = couchdb_session_admin.get(urljoin(couchdb_baseurl, "{}/_all_docs".format(TEARDOWN_DATABASE)))
+    if response.status_code == 404:
+        # Nothing has been queued
+        return []
+    response.raise_for_status()
+
+    return [row["id"] for row in response.json()["rows"]]
+
+
+def databases_info(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: migraine_shared.routing.CouchDBLocation,
+    databases: List[str],
+) -> Dict[str, Optional[Dict]]:
+    """
+    Use a session_admin to obtain information on many databases.
+
+    Issues a _dbs_info request for each batch of DBS_INFO_BATCH_SIZE databases on each cluster.
+
+    Returns a dictionary from each database to its information, or to None if the database does not exist.
+    Raises if an underlying request fails.
+    """
+
+    routing = migraine_shared.routing.as_routing_table(couchdb_baseurl)
+
+    result = {}
+    for (baseurl_current, databases_current) in routing.group_databases(databases=databases).items():
+        for batch_start in range(0, len(databases_current), DBS_INFO_BATCH_SIZE):
+            response = couchdb_session_admin.post(
+                urljoin(baseurl_current, "_dbs_info"),
+                json={
+                    "keys": databases_current[batch_start:batch_start + DBS_INFO_BATCH_SIZE],
+                },
+            )
+            response.raise_for_status()
+
+            for database_current in response.json():
+                result[database_current["key"]] = database_current.get("info")
+
+    return result
+
+
+def user_databases_page(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: migraine_shared.routing.CouchDBLocation,
+    start: Optional[str],
+    limit: int,
+) -> Tuple[List[str], Optional[str]]:
+    """
+    Use a session_admin to obtain a page of user databases, in sorted order.
+
+    The page begins at start, or at the first user database if start is None.
+    A page includes databases from only one cluster, so it may include fewer than limit databases.
+
+    Returns the databases in the page and the start of the next page, or None if this is the last page.
+    Raises ValueError if start is not valid, or raises if an underlying request fails.
+    """
+
+    if start is not None and not validate_database(database=start):
+        raise ValueError("Invalid start: {}".format(start))
+
+    routing = migraine_shared.routing.as_routing_table(couchdb_baseurl)
+    sorted_routes = routing.sorted_routes
+
+    start = start or "user_{}".format(sorted_routes[0].hash_start)
+    route = routing.route_for_database(database=start)
+
+    # Request one extra database, which is the start of the next page.
+    response = couchdb_session_admin.get(
+        urljoin(route.baseurl, "_all_dbs"),
+        params={
+            "startkey": json.dumps(start),
+            "endkey": json.dumps("user_{}\ufff0".format(route.hash_end)),
+            "limit": limit + 1,
+        },
+    )
+    response.raise_for_status()
+    databases = response.json()
+
+    if len(databases) > limit:
+        next_start = databases[limit]
+    elif route != sorted_routes[-1]:
+        # Continue with the cluster serving the next range
+        next_start = "user_{}".format(sorted_routes[sorted_routes.index(route) + 1].hash_start)
+    else:
+        next_start = None
+
+    return databases[:limit], next_start
+
+
+def lookup_accounts(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: migraine_shared.routing.CouchDBLocation,
+    accounts: List[str],
+) -> Dict[str, bool]:
+    """
+    Use a session_admin to determine whether each of many accounts exists.
+
+    An account exists if both its user document and its database exist.
+    Issues one _all_docs request for the user documents on each cluster, then _dbs_info requests for their databases.
+
+    Returns a dictionary from each account to whether it exists.
+    Raises if an underlying request fails.
+    """
+
+    routing = migraine_shared.routing.as_routing_table(couchdb_baseurl)
+
+    # Accounts that are not valid cannot exist, and are not requested.
+    result = {account: False for account in accounts}
+    accounts_by_database = {
+        database_for_user(user=account): account for account in result if validate_user(user=account)
+    }
+
+    existing_accounts = []
+    for (baseurl_current, databases_current) in routing.group_databases(
+        databases=list(accounts_by_database.keys()),
+    ).items():
+        requested_accounts_current = [accounts_by_database[database] for database in databases_current]
+
+        # Obtain all requested user documents.
+        response = couchdb_session_admin.post(
+            urljoin(baseurl_current, "_users/_all_docs"),
+            json={
+                "keys": ["org.couchdb.user:{}".format(account) for account in requested_accounts_current],
+            },
+        )
+        response.raise_for_status()
+
+        # Rows are in the order of the requested keys.
+        # A row has an "error" if the document never existed, or a "deleted" value if it was deleted.
+        existing_accounts.extend(
+            account
+            for (account, row) in zip(requested_accounts_current, response.json()["rows"])
+            if "error" not in row and not row["value"].get("deleted")
+        )
+
+    # Confirm databases exist only for accounts with user documents.
+    existing_databases = databases_info(
+        couchdb_session_admin=couchdb_session_admin,
+        couchdb_baseurl=couchdb_baseurl,
+        databases=[database_for_user(user=account) for account in existing_accounts],
+    )
+    for account in existing_accounts:
+        result[account] = existing_databases[database_for_user(user=account)] is not None
+
+    return result
+
+
+def baseurl_for_user(*, couchdb_baseurl: migraine_shared.routing.CouchDBLocation, user: str) -> str:
+    """
+    Obtain the baseurl of the cluster serving a specified user.
+    """
+
+    return migraine_shared.routing.as_routing_table(couchdb_baseurl).baseurl_for_database(
+        database=database_for_user(user=user)
+    )
+
+
 def database_for_user(*, user: str):
     """
     Obtain the name of the database for a specified user.
@@ -184,6 +667,14 @@ def database_for_user(*, user: str):
     return "user_{}".format(hashlib.md5(user.encode("utf-8")).digest().hex())
 
 
+def validate_database(*, database: str) -> bool:
+    """
+    Determine whether a provided name is a user database, or the prefix of a user database.
+    """
+
+    return migraine_shared.routing.USER_DATABASE_PATTERN.match(database) is not None
+
+
 def validate_user(*, user: str) -> bool:
     """
     Determine whether a provided user name is allowable.
@@ -196,6 +687,10 @@ def validate_user(*, user: str) -> bool:
     if user.startswith("user_"):
         return False
 
+    # Forbid user that start with '_', as CouchDB reserves those names and we reserve those routes
+    if user.startswith("_"):
+        return False
+
     # Limit to 32 characters, just to avoid any issues
     if len(user) > 32:
         return False
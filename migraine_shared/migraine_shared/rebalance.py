@@ -0,0 +1,243 @@
+"""
+Migrate a range of database hashes between CouchDB clusters.
+
+A migration replicates the user documents and user databases in the range from source clusters to a target
+cluster. Replication is incremental, so a migration is performed in steps:
+
+1. Migrate while the current routing table is still deployed, copying the bulk of the range.
+2. Deploy the routing table in which the range is served by the target.
+3. Migrate again, copying anything written before the new routing table was deployed,
+   and deleting the copies that remain on the source clusters.
+
+Sources are selected by the range rather than by the routing table, which after step 2 routes the range to the
+target. By default every other cluster in the routing table is a source. A cluster that no longer serves any range
+is no longer in the routing table, so must be provided as a source.
+"""
+
+import base64
+from dataclasses import dataclass
+import json
+import logging
+import requests
+from typing import List, Optional
+from urllib.parse import urljoin
+
+import migraine_shared.database
+import migraine_shared.routing
+
+USER_DOC_ID_PREFIX = "org.couchdb.user:"
+
+# Rows obtained in each request when listing users or databases.
+PAGE_SIZE = 1000
+
+# Document ids in a single replication of the _users database.
+REPLICATE_DOC_IDS_BATCH_SIZE = 1000
+
+
+@dataclass(frozen=True)
+class MigrationReport:
+    """
+    Users and databases migrated to the target cluster.
+    """
+
+    routing: migraine_shared.routing.RoutingTable
+    users: List[str]
+    databases: List[str]
+
+
+def _replication_endpoint(*, baseurl: str, database: str, admin_user: str, admin_password: str) -> dict:
+    """
+    Obtain a replication endpoint, authenticated as the admin.
+    """
+    credentials = base64.b64encode("{}:{}".format(admin_user, admin_password).encode("utf-8")).decode("utf-8")
+
+    return {
+        "url": urljoin(baseurl, database),
+        "headers": {
+            "Authorization": "Basic {}".format(credentials),
+        },
+    }
+
+
+def _users_in_range(
+    couchdb_session_admin: requests.Session,
+    route: migraine_shared.routing.ClusterRoute,
+) -> List[str]:
+    """
+    Obtain the users of a cluster whose databases are in the range of a route.
+    """
+
+    users = []
+    startkey = USER_DOC_ID_PREFIX
+    while True:
+        response = couchdb_session_admin.get(
+            urljoin(route.baseurl, "_users/_all_docs"),
+            params={
+                "startkey": json.dumps(startkey),
+                "endkey": json.dumps(USER_DOC_ID_PREFIX + "\ufff0"),
+                "limit": PAGE_SIZE + 1,
+            },
+        )
+        response.raise_for_status()
+        rows = response.json()["rows"]
+
+        for row in rows[:PAGE_SIZE]:
+            user = row["id"][len(USER_DOC_ID_PREFIX):]
+            database = migraine_shared.database.database_for_user(user=user)
+            if route.includes(database_hash=database[len(migraine_shared.routing.USER_DATABASE_PREFIX):]):
+                users.append(user)
+
+        if len(rows) <= PAGE_SIZE:
+            return users
+
+        startkey = rows[PAGE_SIZE]["id"]
+
+
+def _databases_in_range(
+    couchdb_session_admin: requests.Session,
+    route: migraine_shared.routing.ClusterRoute,
+) -> List[str]:
+    """
+    Obtain the user databases of a cluster that are in the range of a route.
+    """
+
+    databases = []
+    start = "{}{}".format(migraine_shared.routing.USER_DATABASE_PREFIX, route.hash_start)
+    while start is not None:
+        databases_page, start = migraine_shared.database.user_databases_page(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=route.baseurl,
+            start=start,
+            limit=PAGE_SIZE,
+        )
+        for database in databases_page:
+            if not route.includes(database_hash=database[len(migraine_shared.routing.USER_DATABASE_PREFIX):]):
+                return databases
+            databases.append(database)
+
+    return databases
+
+
+def migrate_hash_range(
+    couchdb_session_admin: requests.Session,
+    routing: migraine_shared.routing.RoutingTable,
+    admin_user: str,
+    admin_password: str,
+    hash_start: str,
+    hash_end: str,
+    target_baseurl: str,
+    delete_source: bool = False,
+    source_baseurls: Optional[List[str]] = None,
+) -> MigrationReport:
+    """
+    Use a session_admin to replicate users and databases in a hash range to the cluster at target_baseurl.
+
+    Replicates from each of source_baseurls, or from every cluster in the routing table other than the target.
+    Every cluster must share the admin user and password, which the target uses to replicate from each source.
+    If delete_source, delete the source copies of what was replicated.
+
+    Returns the routing table in which the range is served by the target, and what was migrated.
+    Raises if an underlying request fails.
+    """
+
+    if source_baseurls is None:
+        source_baseurls = routing.baseurls
+
+    # Express the range at the length of the routing table, so it can be compared with each database hash.
+    prefix_length = max([len(hash_start)] + [len(route.hash_start) for route in routing.routes])
+    range_hash_start = hash_start.ljust(prefix_length, "0")
+    range_hash_end = hash_end.ljust(prefix_length, "f")
+
+    target = _replication_endpoint(
+        baseurl=target_baseurl,
+        database="_users",
+        admin_user=admin_user,
+        admin_password=admin_password,
+    )
+
+    migrated_users = []
+    migrated_databases = []
+    for source_baseurl in source_baseurls:
+        if source_baseurl == target_baseurl:
+            continue
+
+        route = migraine_shared.routing.ClusterRoute(
+            baseurl=source_baseurl,
+            hash_start=range_hash_start,
+            hash_end=range_hash_end,
+        )
+
+        # Replicate user documents, selected by id.
+        users = _users_in_range(couchdb_session_admin=couchdb_session_admin, route=route)
+        for batch_start in range(0, len(users), REPLICATE_DOC_IDS_BATCH_SIZE):
+            response = couchdb_session_admin.post(
+                urljoin(target_baseurl, "_replicate"),
+                json={
+                    "source": _replication_endpoint(
+                        baseurl=route.baseurl,
+                        database="_users",
+                        admin_user=admin_user,
+                        admin_password=admin_password,
+                    ),
+                    "target": target,
+                    "doc_ids": [
+                        "{}{}".format(USER_DOC_ID_PREFIX, user)
+                        for user in users[batch_start:batch_start + REPLICATE_DOC_IDS_BATCH_SIZE]
+                    ],
+                },
+            )
+            response.raise_for_status()
+
+        # Replicate each database, then its _security, which replication does not copy.
+        databases = _databases_in_range(couchdb_session_admin=couchdb_session_admin, route=route)
+        for database in databases:
+            response = couchdb_session_admin.post(
+                urljoin(target_baseurl, "_replicate"),
+                json={
+                    "source": _replication_endpoint(
+                        baseurl=route.baseurl,
+                        database=database,
+                        admin_user=admin_user,
+                        admin_password=admin_password,
+                    ),
+                    "target": _replication_endpoint(
+                        baseurl=target_baseurl,
+                        database=database,
+                        admin_user=admin_user,
+                        admin_password=admin_password,
+                    ),
+                    "create_target": True,
+                },
+            )
+            response.raise_for_status()
+
+            response = couchdb_session_admin.get(urljoin(route.baseurl, "{}/_security".format(database)))
+            response.raise_for_status()
+            response = couchdb_session_admin.put(
+                urljoin(target_baseurl, "{}/_security".format(database)),
+                json=response.json(),
+            )
+            response.raise_for_status()
+
+        if delete_source:
+            for user in users:
+                response = migraine_shared.database.delete_user_document(
+                    couchdb_session_admin=couchdb_session_admin,
+                    couchdb_baseurl=route.baseurl,
+                    account=user,
+                )
+                if response.status_code not in [204, 404]:
+                    logging.error("Failed to delete source user {}: {}".format(user, response.status_code))
+            for database in databases:
+                response = couchdb_session_admin.delete(urljoin(route.baseurl, database))
+                if not response.ok and response.status_code != 404:
+                    logging.error("Failed to delete source database {}: {}".format(database, response.status_code))
+
+        migrated_users.extend(users)
+        migrated_databases.extend(databases)
+
+    return MigrationReport(
+        routing=routing.reassign(hash_start=hash_start, hash_end=hash_end, baseurl=target_baseurl),
+        users=migrated_users,
+        databases=migrated_databases,
+    )
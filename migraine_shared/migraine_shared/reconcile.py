@@ -0,0 +1,462 @@
+"""
+Reconcile user documents with user databases.
+
+Because there are no transactions, a race or a partial failure in creating or deleting an account
+can leave a user document without a database, or a database without a user document.
+
+Users are listed in order of their names, but databases are listed in order of a hash of those names.
+Reconciliation therefore partitions users by the first character of their database name, spilling each partition
+to a temporary file. Each partition is then sorted and merge-joined against the matching range of databases.
+Work is linear in the number of accounts, and memory is bounded by the size of a partition.
+
+Accounts can be created or deleted during reconciliation, so each mismatch is confirmed before it is reported.
+
+Deletions of databases queued by deleting an account are completed first, whether or not mismatches are repaired.
+Each was explicitly requested, but may not have been completed by the process that queued it.
+
+With several clusters, each cluster is reconciled separately, considering only the users and databases routed to it.
+Copies left behind on another cluster by a migration of a hash range are therefore never reported or repaired.
+"""
+
+import concurrent.futures
+from dataclasses import dataclass
+import json
+import logging
+import re
+import requests
+import tempfile
+from typing import Iterator, List, Optional, Tuple
+from urllib.parse import urljoin
+
+import migraine_shared.database
+import migraine_shared.routing
+
+USER_DOC_ID_PREFIX = "org.couchdb.user:"
+USER_DATABASE_PREFIX = "user_"
+USER_DATABASE_PATTERN = "^user_[0-9a-f]{32}$"
+
+# Databases are named by a hex hash, partitions are by its first character.
+PARTITIONS = "0123456789abcdef"
+
+# Rows obtained in each request when listing users or databases.
+PAGE_SIZE = 1000
+
+# Concurrent requests when repairing.
+REPAIR_CONCURRENCY = 4
+
+
+@dataclass(frozen=True)
+class ReconcileReport:
+    """
+    Mismatches found by reconciliation.
+    """
+
+    users_without_database: List[str]
+    databases_without_user: List[str]
+    users_repaired: List[str]
+    databases_repaired: List[str]
+    teardowns_completed: List[str]
+    """
+    Accounts whose queued database deletion was completed.
+    """
+
+    @property
+    def consistent(self) -> bool:
+        return not self.users_without_database and not self.databases_without_user
+
+
+def _paginate(
+    couchdb_session_admin: requests.Session,
+    url: str,
+    startkey: str,
+    endkey: str,
+    key: str = None,
+) -> Iterator:
+    """
+    Stream rows of a listing in key order, one page at a time.
+
+    Each page requests one extra row, whose key is the start of the next page.
+    """
+
+    while True:
+        response = couchdb_session_admin.get(
+            url,
+            params={
+                "startkey": json.dumps(startkey),
+                "endkey": json.dumps(endkey),
+                "limit": PAGE_SIZE + 1,
+            },
+        )
+        response.raise_for_status()
+
+        rows = response.json()
+        if key:
+            rows = rows[key]
+
+        yield from rows[:PAGE_SIZE]
+
+        if len(rows) <= PAGE_SIZE:
+            return
+
+        startkey = rows[PAGE_SIZE]["key"] if key else rows[PAGE_SIZE]
+
+
+def _stream_users(couchdb_session_admin: requests.Session, couchdb_baseurl: str) -> Iterator[str]:
+    """
+    Stream the names of all users.
+    """
+
+    for row in _paginate(
+        couchdb_session_admin=couchdb_session_admin,
+        url=urljoin(couchdb_baseurl, "_users/_all_docs"),
+        startkey=USER_DOC_ID_PREFIX,
+        endkey=USER_DOC_ID_PREFIX + "\ufff0",
+        key="rows",
+    ):
+        yield row["id"][len(USER_DOC_ID_PREFIX):]
+
+
+def _stream_databases(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: str,
+    partition: str,
+) -> Iterator[str]:
+    """
+    Stream the names of all user databases in a partition, in sorted order.
+    """
+
+    for database in _paginate(
+        couchdb_session_admin=couchdb_session_admin,
+        url=urljoin(couchdb_baseurl, "_all_dbs"),
+        startkey=USER_DATABASE_PREFIX + partition,
+        endkey=USER_DATABASE_PREFIX + partition + "\ufff0",
+    ):
+        # Ignore any database not created by database_for_user
+        if re.match(USER_DATABASE_PATTERN, database):
+            yield database
+
+
+def _merge_join(
+    users: List[Tuple[str, str]],
+    databases: Iterator[str],
+) -> Tuple[List[str], List[str]]:
+    """
+    Merge-join (database, user) pairs sorted by database with database names in sorted order.
+
+    Returns users without a database and databases without a user.
+    """
+
+    users_without_database = []
+    databases_without_user = []
+
+    users_iter = iter(users)
+    user_current: Optional[Tuple[str, str]] = next(users_iter, None)
+    for database_current in databases:
+        while user_current is not None and user_current[0] < database_current:
+            users_without_database.append(user_current[1])
+            user_current = next(users_iter, None)
+
+        if user_current is not None and user_current[0] == database_current:
+            user_current = next(users_iter, None)
+        else:
+            databases_without_user.append(database_current)
+
+    while user_current is not None:
+        users_without_database.append(user_current[1])
+        user_current = next(users_iter, None)
+
+    return users_without_database, databases_without_user
+
+
+def _existing_users(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: str,
+    users: List[str],
+) -> List[str]:
+    """
+    Obtain which of the users have a user document, using one request.
+    """
+
+    if not users:
+        return []
+
+    response = couchdb_session_admin.post(
+        urljoin(couchdb_baseurl, "_users/_all_docs"),
+        json={"keys": [USER_DOC_ID_PREFIX + user for user in users]},
+    )
+    response.raise_for_status()
+
+    return [
+        user
+        for (user, row) in zip(users, response.json()["rows"])
+        if "error" not in row and not row["value"].get("deleted")
+    ]
+
+
+def _confirm_users_without_database(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: str,
+    users: List[str],
+) -> List[str]:
+    """
+    Confirm users have a user document but still lack a database.
+    """
+
+    confirmed = []
+    for batch_start in range(0, len(users), migraine_shared.database.DBS_INFO_BATCH_SIZE):
+        batch = _existing_users(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_baseurl,
+            users=users[batch_start:batch_start + migraine_shared.database.DBS_INFO_BATCH_SIZE],
+        )
+
+        databases_info = migraine_shared.database.databases_info(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_baseurl,
+            databases=[migraine_shared.database.database_for_user(user=user) for user in batch],
+        )
+        confirmed.extend(
+            user
+            for user in batch
+            if databases_info[migraine_shared.database.database_for_user(user=user)] is None
+        )
+
+    return confirmed
+
+
+def _confirm_databases_without_user(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: str,
+    databases: List[str],
+) -> List[str]:
+    """
+    Confirm databases exist but lack a user document.
+
+    The user of a database cannot be recovered from its name, but create_database names it in the _security document.
+    A database without a user in its _security document may still be in creation, so is not confirmed.
+    """
+
+    database_users = {}
+    for database in databases:
+        response = couchdb_session_admin.get(urljoin(couchdb_baseurl, "{}/_security".format(database)))
+        if response.status_code == 404:
+            # Database no longer exists
+            continue
+        response.raise_for_status()
+
+        names = response.json().get("members", {}).get("names", [])
+        if len(names) == 1 and migraine_shared.database.database_for_user(user=names[0]) == database:
+            database_users[database] = names[0]
+
+    existing_users = set(
+        _existing_users(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_baseurl,
+            users=list(database_users.values()),
+        )
+    )
+
+    return [database for (database, user) in database_users.items() if user not in existing_users]
+
+
+def _repair(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: str,
+    users_without_database: List[str],
+    databases_without_user: List[str],
+) -> Tuple[List[str], List[str]]:
+    """
+    Create databases for users without a database, delete databases without a user.
+
+    Returns the users and databases that were successfully repaired.
+    """
+
+    def repair_user(user: str) -> bool:
+        response = migraine_shared.database.create_database(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_baseurl,
+            account=user,
+        )
+        if not response.ok:
+            logging.error("Failed to create database for user {}: {}".format(user, response.status_code))
+        return response.ok
+
+    def repair_database(database: str) -> bool:
+        response = couchdb_session_admin.delete(urljoin(couchdb_baseurl, database))
+        if not response.ok and response.status_code != 404:
+            logging.error("Failed to delete database {}: {}".format(database, response.status_code))
+            return False
+        return True
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=REPAIR_CONCURRENCY) as executor:
+        users_repaired = [
+            user
+            for (user, repaired) in zip(users_without_database, executor.map(repair_user, users_without_database))
+            if repaired
+        ]
+        databases_repaired = [
+            database
+            for (database, repaired) in zip(databases_without_user, executor.map(repair_database, databases_without_user))
+            if repaired
+        ]
+
+    return users_repaired, databases_repaired
+
+
+def _complete_teardowns(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: str,
+) -> List[str]:
+    """
+    Complete every database deletion queued on a cluster.
+
+    Returns the accounts whose deletion was completed.
+    """
+
+    completed = []
+    for account in migraine_shared.database.pending_database_teardowns(
+        couchdb_session_admin=couchdb_session_admin,
+        couchdb_baseurl=couchdb_baseurl,
+    ):
+        response = migraine_shared.database.complete_database_teardown(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_baseurl,
+            account=account,
+        )
+        if response.status_code in [204, 404, 409]:
+            completed.append(account)
+        else:
+            logging.error("Failed to complete teardown of account {}: {}".format(account, response.status_code))
+
+    return completed
+
+
+def _reconcile_cluster(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: str,
+    routing: migraine_shared.routing.RoutingTable,
+    repair: bool,
+) -> ReconcileReport:
+    """
+    Reconcile the users and databases of one cluster that are routed to that cluster.
+    """
+
+    def routed_here(database: str) -> bool:
+        return routing.baseurl_for_database(database=database) == couchdb_baseurl
+
+    users_without_database = []
+    databases_without_user = []
+    users_repaired = []
+    databases_repaired = []
+
+    # Complete queued deletions first, so their databases are not reported as without a user.
+    teardowns_completed = _complete_teardowns(
+        couchdb_session_admin=couchdb_session_admin,
+        couchdb_baseurl=couchdb_baseurl,
+    )
+
+    with tempfile.TemporaryDirectory() as spill_dir:
+        # Partition users by their database, writing each partition to a file as "<database> <user>" lines.
+        spill_files = {
+            partition: open("{}/{}".format(spill_dir, partition), "w+", encoding="utf-8")
+            for partition in PARTITIONS
+        }
+        try:
+            for user in _stream_users(
+                couchdb_session_admin=couchdb_session_admin,
+                couchdb_baseurl=couchdb_baseurl,
+            ):
+                database = migraine_shared.database.database_for_user(user=user)
+                if routed_here(database):
+                    spill_files[database[len(USER_DATABASE_PREFIX)]].write("{} {}\n".format(database, user))
+
+            for partition in PARTITIONS:
+                # User names cannot contain spaces, so each line splits into a database and a user.
+                spill_file = spill_files[partition]
+                spill_file.seek(0)
+                users = sorted(tuple(line.rstrip("\n").split(" ", 1)) for line in spill_file)
+
+                partition_users_without_database, partition_databases_without_user = _merge_join(
+                    users=users,
+                    databases=(
+                        database
+                        for database in _stream_databases(
+                            couchdb_session_admin=couchdb_session_admin,
+                            couchdb_baseurl=couchdb_baseurl,
+                            partition=partition,
+                        )
+                        if routed_here(database)
+                    ),
+                )
+                del users
+
+                # Confirm mismatches, as accounts may have been created or deleted since they were listed
+                partition_users_without_database = _confirm_users_without_database(
+                    couchdb_session_admin=couchdb_session_admin,
+                    couchdb_baseurl=couchdb_baseurl,
+                    users=partition_users_without_database,
+                )
+                partition_databases_without_user = _confirm_databases_without_user(
+                    couchdb_session_admin=couchdb_session_admin,
+                    couchdb_baseurl=couchdb_baseurl,
+                    databases=partition_databases_without_user,
+                )
+
+                users_without_database.extend(partition_users_without_database)
+                databases_without_user.extend(partition_databases_without_user)
+
+                # Repair each partition as it is completed, so mismatches are not held for the entire run.
+                if repair:
+                    partition_users_repaired, partition_databases_repaired = _repair(
+                        couchdb_session_admin=couchdb_session_admin,
+                        couchdb_baseurl=couchdb_baseurl,
+                        users_without_database=partition_users_without_database,
+                        databases_without_user=partition_databases_without_user,
+                    )
+                    users_repaired.extend(partition_users_repaired)
+                    databases_repaired.extend(partition_databases_repaired)
+        finally:
+            for spill_file in spill_files.values():
+                spill_file.close()
+
+    return ReconcileReport(
+        users_without_database=users_without_database,
+        databases_without_user=databases_without_user,
+        users_repaired=users_repaired,
+        databases_repaired=databases_repaired,
+        teardowns_completed=teardowns_completed,
+    )
+
+
+def reconcile_accounts(
+    couchdb_session_admin: requests.Session,
+    couchdb_baseurl: migraine_shared.routing.CouchDBLocation,
+    repair: bool = False,
+) -> ReconcileReport:
+    """
+    Use a session_admin to find user documents without a database and databases without a user document.
+
+    Queued deletions of databases are always completed.
+    If repair, create a database for each user without a database and delete each database without a user.
+    Raises if an underlying request fails.
+    """
+
+    routing = migraine_shared.routing.as_routing_table(couchdb_baseurl)
+
+    reports = [
+        _reconcile_cluster(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=baseurl_current,
+            routing=routing,
+            repair=repair,
+        )
+        for baseurl_current in routing.baseurls
+    ]
+
+    return ReconcileReport(
+        users_without_database=[user for report in reports for user in report.users_without_database],
+        databases_without_user=[database for report in reports for database in report.databases_without_user],
+        users_repaired=[user for report in reports for user in report.users_repaired],
+        databases_repaired=[database for report in reports for database in report.databases_repaired],
+        teardowns_completed=[account for report in reports for account in report.teardowns_completed],
+    )
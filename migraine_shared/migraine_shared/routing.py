@@ -0,0 +1,239 @@
+"""
+Routing of users to CouchDB clusters.
+
+Each user is placed on a cluster according to the hex hash in the name of their database,
+as obtained from database_for_user. Each cluster serves a contiguous range of hash prefixes.
+The user document and the database of a user are both on the same cluster.
+"""
+
+from dataclasses import dataclass
+import re
+from typing import Dict, Iterable, List, Tuple, Union
+
+USER_DATABASE_PREFIX = "user_"
+HEX_DIGITS = "0123456789abcdef"
+
+# A user database, or a prefix of one, as named by database_for_user.
+USER_DATABASE_PATTERN = re.compile("^user_[0-9a-f]{1,32}$")
+
+
+@dataclass(frozen=True)
+class ClusterRoute:
+    """
+    A range of database hash prefixes, served by a cluster.
+
+    The range includes both hash_start and hash_end, which must be hex prefixes of the same length.
+    """
+
+    baseurl: str
+    hash_start: str
+    hash_end: str
+
+    def includes(self, *, database_hash: str) -> bool:
+        return self.hash_start <= database_hash[:len(self.hash_start)] <= self.hash_end
+
+    def expanded(self, *, prefix_length: int) -> "ClusterRoute":
+        """
+        Obtain the same range, expressed using prefixes of a longer length.
+        """
+        return ClusterRoute(
+            baseurl=self.baseurl,
+            hash_start=self.hash_start.ljust(prefix_length, "0"),
+            hash_end=self.hash_end.ljust(prefix_length, "f"),
+        )
+
+
+def _hex_offset(prefix: str, offset: int) -> str:
+    """
+    Obtain the prefix of the same length that is offset from a prefix.
+    """
+    return format(int(prefix, 16) + offset, "0{}x".format(len(prefix)))
+
+
+@dataclass(frozen=True)
+class RoutingTable:
+    """
+    Routes covering every database hash, each hash served by exactly one cluster.
+    """
+
+    routes: Tuple[ClusterRoute, ...]
+
+    def __post_init__(self):
+        for route in self.routes:
+            if len(route.hash_start) != len(route.hash_end) or not route.hash_start:
+                raise ValueError("Invalid hash range: {} to {}".format(route.hash_start, route.hash_end))
+            if any(digit not in HEX_DIGITS for digit in route.hash_start + route.hash_end):
+                raise ValueError("Invalid hash range: {} to {}".format(route.hash_start, route.hash_end))
+
+        if not self.routes:
+            raise ValueError("No routes")
+
+        # Every prefix of the longest length must be served by exactly one route.
+        # Expressed at that length and sorted, each route must begin immediately after the previous route ends.
+        prefix_length = max(len(route.hash_start) for route in self.routes)
+        hash_first = "0" * prefix_length
+        hash_last = "f" * prefix_length
+
+        hash_next = hash_first
+        for route in sorted(
+            (route.expanded(prefix_length=prefix_length) for route in self.routes),
+            key=lambda route: route.hash_start,
+        ):
+            if route.hash_end < route.hash_start:
+                raise ValueError("Invalid hash range: {} to {}".format(route.hash_start, route.hash_end))
+            if hash_next is None or route.hash_start < hash_next:
+                raise ValueError("Hash prefix {} is served by more than one route".format(route.hash_start))
+            if route.hash_start > hash_next:
+                raise ValueError("Hash prefix {} is not served by any route".format(hash_next))
+
+            hash_next = _hex_offset(route.hash_end, 1) if route.hash_end != hash_last else None
+
+        if hash_next is not None:
+            raise ValueError("Hash prefix {} is not served by any route".format(hash_next))
+
+    @staticmethod
+    def single(*, baseurl: str) -> "RoutingTable":
+        """
+        Obtain a routing table that places every user on one cluster.
+        """
+        return RoutingTable(routes=(ClusterRoute(baseurl=baseurl, hash_start="0", hash_end="f"),))
+
+    @staticmethod
+    def parse(yaml_config: List[dict]) -> "RoutingTable":
+        """
+        Parse a list of clusters, each with a "baseurl" and a "hash_range" of [start, end].
+        """
+        return RoutingTable(
+            routes=tuple(
+                ClusterRoute(
+                    baseurl=cluster["baseurl"],
+                    hash_start=str(cluster["hash_range"][0]).lower(),
+                    hash_end=str(cluster["hash_range"][1]).lower(),
+                )
+                for cluster in yaml_config
+            )
+        )
+
+    @property
+    def baseurls(self) -> List[str]:
+        """
+        Obtain the distinct baseurl of every cluster, in order of the hash ranges they serve.
+        """
+        return list(dict.fromkeys(route.baseurl for route in self.sorted_routes))
+
+    @property
+    def sorted_routes(self) -> List[ClusterRoute]:
+        return sorted(self.routes, key=lambda route: route.hash_start)
+
+    def route_for_database(self, *, database: str) -> ClusterRoute:
+        """
+        Obtain the route serving a user database, or a prefix of a user database.
+
+        Raises ValueError if database is not a user database.
+        """
+        if not USER_DATABASE_PATTERN.match(database):
+            raise ValueError("Not a user database: {}".format(database))
+
+        # A prefix is served by the route that serves the first database beginning with that prefix
+        prefix_length = max(len(route.hash_start) for route in self.routes)
+        database_hash = database[len(USER_DATABASE_PREFIX):].ljust(prefix_length, "0")
+        for route in self.routes:
+            if route.includes(database_hash=database_hash):
+                return route
+
+        raise ValueError("No route for database: {}".format(database))
+
+    def baseurl_for_database(self, *, database: str) -> str:
+        return self.route_for_database(database=database).baseurl
+
+    def intersect(self, *, hash_start: str, hash_end: str) -> List[ClusterRoute]:
+        """
+        Obtain the portion of each route within a range, in order of the hash ranges.
+        """
+        prefix_length = max([len(hash_start)] + [len(route.hash_start) for route in self.routes])
+        hash_start = hash_start.ljust(prefix_length, "0")
+        hash_end = hash_end.ljust(prefix_length, "f")
+
+        result = []
+        for route in self.sorted_routes:
+            route = route.expanded(prefix_length=prefix_length)
+            if route.hash_end < hash_start or hash_end < route.hash_start:
+                continue
+            result.append(
+                ClusterRoute(
+                    baseurl=route.baseurl,
+                    hash_start=max(route.hash_start, hash_start),
+                    hash_end=min(route.hash_end, hash_end),
+                )
+            )
+
+        return result
+
+    def reassign(self, *, hash_start: str, hash_end: str, baseurl: str) -> "RoutingTable":
+        """
+        Obtain a routing table in which a range is served by the cluster at baseurl.
+        """
+        prefix_length = max([len(hash_start)] + [len(route.hash_start) for route in self.routes])
+        hash_start = hash_start.ljust(prefix_length, "0")
+        hash_end = hash_end.ljust(prefix_length, "f")
+
+        routes = [ClusterRoute(baseurl=baseurl, hash_start=hash_start, hash_end=hash_end)]
+        for route in self.routes:
+            route = route.expanded(prefix_length=prefix_length)
+            # Retain any portion of the route before or after the range
+            if route.hash_start < hash_start:
+                routes.append(
+                    ClusterRoute(
+                        baseurl=route.baseurl,
+                        hash_start=route.hash_start,
+                        hash_end=min(route.hash_end, _hex_offset(hash_start, -1)),
+                    )
+                )
+            if hash_end < route.hash_end:
+                routes.append(
+                    ClusterRoute(
+                        baseurl=route.baseurl,
+                        hash_start=max(route.hash_start, _hex_offset(hash_end, 1)),
+                        hash_end=route.hash_end,
+                    )
+                )
+
+        return RoutingTable(routes=tuple(sorted(routes, key=lambda route: route.hash_start)))
+
+    def to_yaml_config(self) -> List[dict]:
+        """
+        Obtain the list of clusters that parse into this routing table.
+        """
+        return [
+            {
+                "baseurl": route.baseurl,
+                "hash_range": [route.hash_start, route.hash_end],
+            }
+            for route in self.sorted_routes
+        ]
+
+    def group_databases(self, *, databases: Iterable[str]) -> Dict[str, List[str]]:
+        """
+        Group databases by the baseurl of the cluster that serves them, preserving their order.
+        """
+        groups = {}
+        for database in databases:
+            groups.setdefault(self.baseurl_for_database(database=database), []).append(database)
+
+        return groups
+
+
+CouchDBLocation = Union[str, RoutingTable]
+"""
+Either the baseurl of a single cluster, or a routing table across clusters.
+"""
+
+
+def as_routing_table(couchdb_location: CouchDBLocation) -> RoutingTable:
+    """
+    Obtain a routing table for a location, which may be a baseurl of a single cluster.
+    """
+    if isinstance(couchdb_location, RoutingTable):
+        return couchdb_location
+
+    return RoutingTable.single(baseurl=couchdb_location)
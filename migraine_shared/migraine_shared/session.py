@@ -0,0 +1,314 @@
+"""
+Sessions for server-side calls to CouchDB.
+
+Clients address CouchDB at its public baseurl, which passes through ingress and a proxy.
+A server running in the same cluster can instead call CouchDB directly at an internal baseurl.
+
+A stalled CouchDB must not stall its callers, so calls are bounded by timeouts and by the deadline of the
+request being served, and fail fast while CouchDB is failing.
+"""
+
+import contextlib
+import contextvars
+import logging
+import random
+import requests
+import requests.auth
+import threading
+import time
+from typing import Dict, Optional, Tuple
+from urllib.parse import urlparse
+
+import migraine_shared.codec
+
+from timeit import default_timer as timer
+
+# Seconds to use the public baseurl after the internal baseurl fails, before trying it again.
+INTERNAL_RETRY_INTERVAL = 30
+
+
+class InternalRoutingSession(requests.Session):
+    """
+    Session that sends requests for a public baseurl to its internal baseurl.
+
+    Code using the session continues to address the public baseurl.
+    If the internal baseurl cannot be reached, the request is sent to the public baseurl,
+    which is then used until INTERNAL_RETRY_INTERVAL has passed.
+
+    Cookies are specific to a host, so a cookie obtained from the internal baseurl is not sent to the public baseurl.
+    A request sent to the public baseurl is therefore authenticated using fallback_auth, if provided.
+    """
+
+    def __init__(
+        self,
+        *,
+        internal_baseurls: Dict[str, str],
+        fallback_auth: Optional[requests.auth.AuthBase] = None,
+    ):
+        """
+        Args:
+            internal_baseurls: Dictionary from each public baseurl to its internal baseurl.
+            fallback_auth: Authentication for requests sent to a public baseurl.
+        """
+        super().__init__()
+
+        self.internal_baseurls = dict(internal_baseurls)
+        self.fallback_auth = fallback_auth
+
+        self._lock = threading.Lock()
+        self._internal_failed_time: Dict[str, float] = {}
+
+    def _internal_available(self, *, public_baseurl: str) -> bool:
+        with self._lock:
+            failed_time = self._internal_failed_time.get(public_baseurl)
+
+        return failed_time is None or timer() - failed_time > INTERNAL_RETRY_INTERVAL
+
+    def request(self, method, url, *args, **kwargs):
+        public_baseurl = next(
+            (baseurl for baseurl in self.internal_baseurls if url.startswith(baseurl)),
+            None,
+        )
+        if public_baseurl is None:
+            return super().request(method, url, *args, **kwargs)
+
+        if self._internal_available(public_baseurl=public_baseurl):
+            internal_url = self.internal_baseurls[public_baseurl] + url[len(public_baseurl):]
+            try:
+                response = super().request(method, internal_url, *args, **kwargs)
+
+                with self._lock:
+                    self._internal_failed_time.pop(public_baseurl, None)
+
+                return response
+            except requests.exceptions.ConnectionError:
+                # The request did not reach CouchDB, so it is safe to send again.
+                logging.warning(
+                    "Failed to connect to internal {}, using public {}".format(
+                        self.internal_baseurls[public_baseurl], public_baseurl
+                    )
+                )
+                with self._lock:
+                    self._internal_failed_time[public_baseurl] = timer()
+
+        if self.fallback_auth is not None and kwargs.get("auth") is None:
+            kwargs["auth"] = self.fallback_auth
+
+        return super().request(method, url, *args, **kwargs)
+
+
+# Seconds to wait when connecting, and between bytes of a response.
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 10
+
+# Attempts of an idempotent request, and the base and cap in seconds of the jittered delay between attempts.
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF_BASE = 0.1
+RETRY_BACKOFF_CAP = 2
+
+# Statuses of an idempotent request that are retried.
+RETRY_STATUSES = [502, 503, 504]
+
+# Methods that are safe to retry.
+IDEMPOTENT_METHODS = ["GET", "HEAD"]
+
+# Consecutive failures that open a circuit, and seconds before an open circuit allows a trial request.
+CIRCUIT_FAILURE_THRESHOLD = 5
+CIRCUIT_RESET_TIMEOUT = 30
+
+# Time by which the current request must complete, if any.
+_deadline = contextvars.ContextVar("deadline", default=None)
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """
+    The deadline of the current request passed before a call could complete.
+    """
+
+
+class CircuitOpen(requests.exceptions.ConnectionError):
+    """
+    A call was not attempted, because its circuit is open.
+    """
+
+    def __init__(self, *args, retry_after: float, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.retry_after = retry_after
+
+
+@contextlib.contextmanager
+def deadline(seconds: float):
+    """
+    Context in which every call must complete within seconds.
+
+    A deadline applies to every call made in the context, including through contextvars.copy_context().
+    A nested deadline cannot extend an enclosing deadline.
+    """
+    deadline_time = timer() + seconds
+    deadline_current = _deadline.get()
+    if deadline_current is not None:
+        deadline_time = min(deadline_time, deadline_current)
+
+    token = _deadline.set(deadline_time)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def remaining() -> Optional[float]:
+    """
+    Obtain the seconds remaining before the current deadline, or None if there is no deadline.
+    """
+    deadline_current = _deadline.get()
+    if deadline_current is None:
+        return None
+
+    return deadline_current - timer()
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for each host.
+
+    A circuit opens after CIRCUIT_FAILURE_THRESHOLD consecutive failures, and calls then fail fast.
+    After CIRCUIT_RESET_TIMEOUT, a single trial call is allowed, which closes the circuit if it succeeds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._failures: Dict[str, int] = {}
+        self._opened_time: Dict[str, float] = {}
+        self._trial: Dict[str, bool] = {}
+
+    def before_call(self, *, host: str) -> bool:
+        """
+        Raise CircuitOpen if a call to host should fail fast.
+
+        Returns whether the call is the trial, whose outcome must then be recorded or the trial released.
+        """
+        with self._lock:
+            opened_time = self._opened_time.get(host)
+            if opened_time is None:
+                return False
+
+            retry_after = CIRCUIT_RESET_TIMEOUT - (timer() - opened_time)
+            if retry_after > 0 or self._trial.get(host):
+                raise CircuitOpen("Circuit open for {}".format(host), retry_after=max(retry_after, 1))
+
+            # Allow this call as the trial
+            self._trial[host] = True
+            return True
+
+    def release(self, *, host: str):
+        """
+        Release the trial of host without an outcome, so a later call can be the trial.
+        """
+        with self._lock:
+            self._trial.pop(host, None)
+
+    def record(self, *, host: str, success: bool):
+        with self._lock:
+            if success:
+                self._failures.pop(host, None)
+                self._opened_time.pop(host, None)
+                self._trial.pop(host, None)
+                return
+
+            self._failures[host] = self._failures.get(host, 0) + 1
+            if self._trial.pop(host, False) or self._failures[host] >= CIRCUIT_FAILURE_THRESHOLD:
+                if host not in self._opened_time:
+                    logging.warning("Opening circuit for {}".format(host))
+                self._opened_time[host] = timer()
+
+
+class CouchDBSession(InternalRoutingSession):
+    """
+    InternalRoutingSession that applies timeouts, deadlines, retries, and a circuit breaker.
+
+    Every call has a connect and read timeout, and the read timeout is limited to the remaining deadline.
+    Idempotent calls are retried with jittered backoff after a connection failure, a timeout, or a RETRY_STATUSES.
+    Calls are first checked against the circuit breaker, which is typically shared by every session of a process.
+    JSON bodies of calls and responses are encoded and decoded using migraine_shared.codec.
+    """
+
+    def __init__(
+        self,
+        *,
+        internal_baseurls: Optional[Dict[str, str]] = None,
+        fallback_auth: Optional[requests.auth.AuthBase] = None,
+        connect_timeout: float = DEFAULT_CONNECT_TIMEOUT,
+        read_timeout: float = DEFAULT_READ_TIMEOUT,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+    ):
+        super().__init__(internal_baseurls=internal_baseurls or {}, fallback_auth=fallback_auth)
+
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.circuit_breaker = circuit_breaker
+
+    def _timeout(self, *, timeout) -> Tuple[Tuple[float, float], bool]:
+        """
+        Obtain the timeout of a call, limited by the remaining deadline, and whether the deadline limited it.
+        """
+        if timeout is None:
+            timeout = (self.connect_timeout, self.read_timeout)
+        elif not isinstance(timeout, tuple):
+            timeout = (timeout, timeout)
+
+        remaining_current = remaining()
+        if remaining_current is None:
+            return timeout, False
+        if remaining_current <= 0:
+            raise DeadlineExceeded("Deadline exceeded")
+
+        timeout_limited = (min(timeout[0], remaining_current), min(timeout[1], remaining_current))
+        return timeout_limited, timeout_limited != timeout
+
+    def request(self, method, url, *args, **kwargs):
+        host = urlparse(url).netloc
+        attempts = RETRY_ATTEMPTS if method.upper() in IDEMPOTENT_METHODS else 1
+        timeout = kwargs.pop("timeout", None)
+
+        # Encode a body once, using the codec, rather than on each attempt.
+        if kwargs.get("json") is not None:
+            kwargs["data"] = migraine_shared.codec.dumps(kwargs.pop("json"))
+            kwargs["headers"] = {"Content-Type": "application/json", **(kwargs.get("headers") or {})}
+
+        for attempt in range(attempts):
+            # Check the deadline before the circuit breaker, which may allow this call as its trial.
+            (timeout_current, deadline_limited) = self._timeout(timeout=timeout)
+
+            trial = False
+            if self.circuit_breaker:
+                trial = self.circuit_breaker.before_call(host=host)
+
+            recorded = False
+            try:
+                response = super().request(method, url, *args, timeout=timeout_current, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as exception:
+                # A timeout shortened by the deadline of the caller does not indicate a failure of the host.
+                if self.circuit_breaker and not (deadline_limited and isinstance(exception, requests.exceptions.Timeout)):
+                    self.circuit_breaker.record(host=host, success=False)
+                    recorded = True
+                if attempt + 1 == attempts:
+                    raise
+            else:
+                if self.circuit_breaker:
+                    self.circuit_breaker.record(host=host, success=response.status_code < 500)
+                    recorded = True
+                if response.status_code not in RETRY_STATUSES or attempt + 1 == attempts:
+                    # Decode the body using the codec, in place of requests.Response.json.
+                    response.json = lambda **json_kwargs: migraine_shared.codec.loads(response.content)
+                    return response
+            finally:
+                # A trial that ended without an outcome must not hold the circuit open.
+                if trial and not recorded:
+                    self.circuit_breaker.release(host=host)
+
+            # Full jitter, without sleeping past the deadline.
+            delay = random.uniform(0, min(RETRY_BACKOFF_CAP, RETRY_BACKOFF_BASE * 2 ** attempt))
+            remaining_current = remaining()
+            if remaining_current is not None and remaining_current <= delay:
+                raise DeadlineExceeded("Deadline exceeded")
+            time.sleep(delay)
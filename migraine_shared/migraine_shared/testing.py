@@ -2,14 +2,37 @@
 Utilities for configuring testing.
 """
 
+import concurrent.futures
+from contextlib import contextmanager
+import contextvars
 from dataclasses import dataclass
+import json
+import os
 from pathlib import Path
 import pytest
 import requests
-from typing import List
-from urllib.parse import urljoin
+import requests.adapters
+import secrets
+import threading
+import time
+from typing import Dict, List, Optional
+from urllib.parse import urljoin, urlparse
 
 import migraine_shared.config
+import migraine_shared.database
+import migraine_shared.routing
+
+# Connections pooled by the admin session, for each host.
+ADMIN_POOL_MAXSIZE = 16
+
+# Concurrent requests in provisioning or releasing pooled accounts.
+ACCOUNT_POOL_WORKERS = 8
+
+# Maximum length of an account name, as allowed by migraine_shared.database.validate_user.
+ACCOUNT_NAME_MAX_LENGTH = 32
+
+# Minimum random bytes in a unique account name.
+ACCOUNT_NAME_MIN_RANDOM_BYTES = 4
 
 
 @dataclass(frozen=True)
@@ -22,7 +45,7 @@ def create_test_config(*, configs: List[TestingConfig]):
     """
     Create a fixture to provide test configuration.
     """
-    @pytest.fixture(params=configs)
+    @pytest.fixture(params=configs, scope="session")
     def test_config(request) -> TestingConfig:
         return request.param
 
@@ -34,7 +57,7 @@ def create_couchdb_config(*, test_config):
     """
     assert test_config
 
-    @pytest.fixture
+    @pytest.fixture(scope="session")
     def couchdb_config(test_config: TestingConfig) -> migraine_shared.config.CouchDBConfig:
         """
         Fixture to provide CouchDB configuration.
@@ -48,32 +71,29 @@ def create_couchdb_config(*, test_config):
 def _couchdb_session_admin(couchdb_config: migraine_shared.config.CouchDBConfig) -> requests.Session:
     """
     Helper for creating couchdb_session_admin.
+
+    Authenticating with each cluster also confirms it is reachable and that the session has the _admin role,
+    so each cluster requires only a single request.
     """
-    # Obtain a session
+    # Obtain a session, pooling enough connections for fixtures that make concurrent requests
     session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_maxsize=ADMIN_POOL_MAXSIZE)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+
+    # Authenticate the session with each cluster
+    for baseurl in couchdb_config.routing.baseurls:
+        response = session.post(
+            urljoin(baseurl, "_session"),
+            json={
+                "name": couchdb_config.admin_user,
+                "password": couchdb_config.admin_password,
+            },
+        )
+        assert response.ok
 
-    # Confirm the database is reachable
-    session = requests.session()
-    response = session.get(
-        urljoin(couchdb_config.baseurl, ''),
-    )
-    assert response.ok
-
-    # Authenticate the session
-    response = session.post(
-        urljoin(couchdb_config.baseurl, "_session"),
-        json={
-            "name": couchdb_config.admin_user,
-            "password": couchdb_config.admin_password,
-        },
-    )
-    assert response.ok
-
-    # Only an administrator can access the _users database
-    response = session.get(
-        urljoin(couchdb_config.baseurl, "_users"),
-    )
-    assert response.ok
+        # Only an administrator can access the _users database
+        assert "_admin" in response.json()["roles"]
 
     return session
 
@@ -83,11 +103,12 @@ def create_couchdb_session_admin(*, couchdb_config):
     """
     assert couchdb_config
 
-    @pytest.fixture
+    @pytest.fixture(scope="session")
     def couchdb_session_admin(couchdb_config: migraine_shared.config.CouchDBConfig) -> requests.Session:
         """
         Fixture providing a session authenticated as administrator.
 
+        Shared by every test using the same configuration, so is created once.
         This will xfail if _couchdb_session_admin fails, so all tests based on it will xfail.
         """
         try:
@@ -122,7 +143,7 @@ def create_flask_config(*, test_config):
     """
     assert test_config
 
-    @pytest.fixture
+    @pytest.fixture(scope="session")
     def flask_config(test_config: TestingConfig) -> migraine_shared.config.FlaskConfig:
         """
         Fixture to provide Flask configuration.
@@ -141,7 +162,6 @@ def _flask_session_unauthenticated(flask_config: migraine_shared.config.FlaskCon
     session = requests.Session()
 
     # Confirm Flask is reachable
-    session = requests.session()
     response = session.get(
         urljoin(flask_config.baseurl, ''),
     )
@@ -155,7 +175,7 @@ def create_flask_session_unauthenticated(*, flask_config):
     """
     assert flask_config
 
-    @pytest.fixture
+    @pytest.fixture(scope="session")
     def flask_session_unauthenticated(flask_config: migraine_shared.config.FlaskConfig) -> requests.Session:
         """
         Fixture providing a session that is not authenticated.
@@ -187,3 +207,361 @@ def create_test_flask_session_unauthenticated(*, flask_config):
         _flask_session_unauthenticated(flask_config=flask_config)
 
     return test_flask_session_unauthenticated
+
+# Environment variable naming a file to which round trips of each test are appended, as JSON lines.
+ROUND_TRIPS_REPORT_ENV = "COUCHDB_ROUND_TRIPS_REPORT"
+
+# Name of the marker declaring maximum round trips for each operation of a test.
+ROUND_TRIPS_MARKER = "couchdb_round_trips"
+
+# Operation of the current context, so requests made in a copied context are attributed to it.
+_round_trip_operation = contextvars.ContextVar("round_trip_operation", default=None)
+
+
+@dataclass(frozen=True)
+class RoundTrip:
+    operation: Optional[str]
+    method: str
+    path: str
+    status_code: int
+    elapsed: float
+
+
+@dataclass(frozen=True)
+class OperationRecord:
+    operation: str
+    round_trips: int
+    elapsed: float
+
+
+class RoundTripRecorder:
+    """
+    Records every HTTP request made through the sessions to which it is attached.
+
+    Requests are attributed to the operation within which they are made, using operation().
+    Requests made outside of any operation are recorded but not attributed.
+    An operation with a budget that exceeds it fails as it completes, within the test.
+    """
+
+    def __init__(self, *, budgets: Optional[Dict[str, int]] = None):
+        self.round_trips: List[RoundTrip] = []
+        self.operations: List[OperationRecord] = []
+        self.budgets: Dict[str, int] = dict(budgets or {})
+
+        self._lock = threading.Lock()
+
+    def attach(self, *, session: requests.Session):
+        session.hooks["response"].append(self._record)
+
+    def detach(self, *, session: requests.Session):
+        session.hooks["response"].remove(self._record)
+
+    def _record(self, response: requests.Response, *args, **kwargs):
+        round_trip = RoundTrip(
+            operation=_round_trip_operation.get(),
+            method=response.request.method,
+            path=urlparse(response.request.url).path,
+            status_code=response.status_code,
+            elapsed=response.elapsed.total_seconds(),
+        )
+
+        with self._lock:
+            self.round_trips.append(round_trip)
+
+    @contextmanager
+    def operation(self, name: str):
+        """
+        Attribute requests made within the context to an operation.
+
+        Raises AssertionError on leaving the context if the operation exceeded its budget.
+        """
+        with self._lock:
+            start_index = len(self.round_trips)
+        start_time = time.perf_counter()
+
+        token = _round_trip_operation.set(name)
+        try:
+            yield
+        finally:
+            _round_trip_operation.reset(token)
+
+            with self._lock:
+                round_trips = [
+                    round_trip
+                    for round_trip in self.round_trips[start_index:]
+                    if round_trip.operation == name
+                ]
+                record = OperationRecord(
+                    operation=name,
+                    round_trips=len(round_trips),
+                    elapsed=time.perf_counter() - start_time,
+                )
+                self.operations.append(record)
+
+        # Reached only if the operation completed, so its own failure is not masked.
+        violations = self._violations(records=[record])
+        assert not violations, "; ".join(violations)
+
+    def report(self) -> Dict[str, Dict]:
+        """
+        Summarize each operation, over every time it was performed.
+        """
+        result = {}
+        for record in self.operations:
+            summary = result.setdefault(record.operation, {
+                "count": 0,
+                "max_round_trips": 0,
+                "total_round_trips": 0,
+                "total_elapsed": 0.0,
+            })
+            summary["count"] += 1
+            summary["max_round_trips"] = max(summary["max_round_trips"], record.round_trips)
+            summary["total_round_trips"] += record.round_trips
+            summary["total_elapsed"] += record.elapsed
+
+        return result
+
+    def _violations(self, *, records: List[OperationRecord]) -> List[str]:
+        return [
+            "{} made {} CouchDB round trips, budget is {}".format(
+                record.operation,
+                record.round_trips,
+                self.budgets[record.operation],
+            )
+            for record in records
+            if record.operation in self.budgets and record.round_trips > self.budgets[record.operation]
+        ]
+
+    def budget_violations(self) -> List[str]:
+        """
+        Describe each time an operation exceeded its budget of round trips.
+        """
+        return self._violations(records=self.operations)
+
+
+def _export_round_trips(*, nodeid: str, recorder: RoundTripRecorder):
+    """
+    Append the round trips of a test to the report, if a report was requested.
+    """
+    report_path = os.environ.get(ROUND_TRIPS_REPORT_ENV)
+    if not report_path:
+        return
+
+    with open(report_path, "a") as report_file:
+        report_file.write(json.dumps({"test": nodeid, "operations": recorder.report()}, sort_keys=True) + "\n")
+
+
+def create_couchdb_round_trips(*, couchdb_session_admin):
+    """
+    Create a fixture to record round trips made through couchdb_session_admin.
+    """
+    assert couchdb_session_admin
+
+    @pytest.fixture
+    def couchdb_round_trips(request, couchdb_session_admin: requests.Session) -> RoundTripRecorder:
+        """
+        Fixture providing a recorder attached to couchdb_session_admin.
+
+        If the test is marked couchdb_round_trips, each keyword names an operation and its maximum round trips.
+        For example, @pytest.mark.couchdb_round_trips(create_account=5).
+        Each time an operation is performed, it must not exceed its maximum, or the test fails.
+        """
+        marker = request.node.get_closest_marker(ROUND_TRIPS_MARKER)
+        recorder = RoundTripRecorder(budgets=marker.kwargs if marker else None)
+        recorder.attach(session=couchdb_session_admin)
+
+        yield recorder
+
+        recorder.detach(session=couchdb_session_admin)
+        _export_round_trips(nodeid=request.node.nodeid, recorder=recorder)
+
+    return couchdb_round_trips
+
+
+def worker_name() -> str:
+    """
+    Obtain the name of the pytest-xdist worker executing tests, or "main" if tests are not distributed.
+    """
+    return os.environ.get("PYTEST_XDIST_WORKER", "main")
+
+
+def unique_account_name(*, prefix: str) -> str:
+    """
+    Obtain an account name that is unique across test runs and pytest-xdist workers.
+
+    The random suffix uses whatever length remains within ACCOUNT_NAME_MAX_LENGTH.
+    """
+    name = "{}_{}_".format(prefix, worker_name())
+    nbytes = (ACCOUNT_NAME_MAX_LENGTH - len(name)) // 2
+    assert nbytes >= ACCOUNT_NAME_MIN_RANDOM_BYTES, "Prefix is too long for a unique account name"
+
+    return name + secrets.token_hex(nbytes=nbytes)
+
+
+@dataclass(frozen=True)
+class PooledAccount:
+    user: str
+    password: str
+
+
+class AccountPool:
+    """
+    Accounts created before tests and deleted after them, each in bulk.
+
+    User documents are created and deleted in a single _bulk_docs request to each cluster.
+    Databases cannot be created in bulk, so are created and deleted concurrently.
+    Each account is acquired by at most one test, so a test may modify or delete its account.
+    If the pool is exhausted, further accounts are created individually and deleted with the pool.
+    """
+
+    def __init__(
+        self,
+        *,
+        couchdb_session_admin: requests.Session,
+        couchdb_routing: migraine_shared.routing.RoutingTable,
+        prefix: str,
+        size: int,
+    ):
+        self.couchdb_session_admin = couchdb_session_admin
+        self.couchdb_routing = couchdb_routing
+        self.prefix = prefix
+
+        self.accounts: List[PooledAccount] = [
+            PooledAccount(user=unique_account_name(prefix=prefix), password=secrets.token_urlsafe())
+            for _ in range(size)
+        ]
+        self._available: List[PooledAccount] = list(self.accounts)
+        self._lock = threading.Lock()
+
+    def _accounts_by_baseurl(self, *, accounts: List[PooledAccount]) -> Dict[str, List[PooledAccount]]:
+        result: Dict[str, List[PooledAccount]] = {}
+        for account in accounts:
+            baseurl = migraine_shared.database.baseurl_for_user(couchdb_baseurl=self.couchdb_routing, user=account.user)
+            result.setdefault(baseurl, []).append(account)
+
+        return result
+
+    def provision(self):
+        """
+        Create every account in the pool.
+        """
+        for (baseurl, accounts) in self._accounts_by_baseurl(accounts=self.accounts).items():
+            response = self.couchdb_session_admin.post(
+                urljoin(baseurl, "_users/_bulk_docs"),
+                json={
+                    "docs": [
+                        {
+                            "_id": "org.couchdb.user:{}".format(account.user),
+                            "type": "user",
+                            "name": account.user,
+                            "roles": [],
+                            "password": account.password,
+                        }
+                        for account in accounts
+                    ],
+                },
+            )
+            assert response.ok
+            assert all(result.get("ok") for result in response.json())
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=ACCOUNT_POOL_WORKERS) as executor:
+            responses = list(executor.map(
+                lambda account: migraine_shared.database.create_database(
+                    couchdb_session_admin=self.couchdb_session_admin,
+                    couchdb_baseurl=self.couchdb_routing,
+                    account=account.user,
+                ),
+                self.accounts,
+            ))
+        assert all(response.ok for response in responses)
+
+    def acquire(self) -> PooledAccount:
+        """
+        Obtain an account not acquired by any other test.
+        """
+        with self._lock:
+            if self._available:
+                return self._available.pop(0)
+
+        account = PooledAccount(user=unique_account_name(prefix=self.prefix), password=secrets.token_urlsafe())
+        response = migraine_shared.database.create_account(
+            couchdb_session_admin=self.couchdb_session_admin,
+            couchdb_baseurl=self.couchdb_routing,
+            account=account.user,
+            password=account.password,
+        )
+        assert response.ok
+
+        with self._lock:
+            self.accounts.append(account)
+
+        return account
+
+    def release(self):
+        """
+        Delete every account in the pool, including any already deleted by a test.
+        """
+        for (baseurl, accounts) in self._accounts_by_baseurl(accounts=self.accounts).items():
+            user_doc_ids = ["org.couchdb.user:{}".format(account.user) for account in accounts]
+
+            # Obtain the current revision of each user document
+            response = self.couchdb_session_admin.post(
+                urljoin(baseurl, "_users/_all_docs"),
+                json={"keys": user_doc_ids},
+            )
+            assert response.ok
+
+            deleted_docs = [
+                {"_id": row["id"], "_rev": row["value"]["rev"], "_deleted": True}
+                for row in response.json()["rows"]
+                if "value" in row and not row["value"].get("deleted")
+            ]
+            if deleted_docs:
+                response = self.couchdb_session_admin.post(
+                    urljoin(baseurl, "_users/_bulk_docs"),
+                    json={"docs": deleted_docs},
+                )
+                assert response.ok
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=ACCOUNT_POOL_WORKERS) as executor:
+            responses = list(executor.map(
+                lambda account: migraine_shared.database.delete_database(
+                    couchdb_session_admin=self.couchdb_session_admin,
+                    couchdb_baseurl=self.couchdb_routing,
+                    account=account.user,
+                ),
+                self.accounts,
+            ))
+        assert all(response.status_code in [204, 404] for response in responses)
+
+
+def create_account_pool(*, couchdb_config, couchdb_session_admin, prefix: str, size: int):
+    """
+    Create a fixture to provide a pool of accounts, created before and deleted after every test using it.
+    """
+    assert couchdb_config
+    assert couchdb_session_admin
+
+    @pytest.fixture(scope="session")
+    def account_pool(
+        couchdb_config: migraine_shared.config.CouchDBConfig,
+        couchdb_session_admin: requests.Session,
+    ) -> AccountPool:
+        """
+        Fixture providing a pool of accounts.
+
+        Shared by every test using the same configuration, so accounts are created and deleted once.
+        """
+        pool = AccountPool(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_routing=couchdb_config.routing,
+            prefix=prefix,
+            size=size,
+        )
+        pool.provision()
+
+        yield pool
+
+        pool.release()
+
+    return account_pool
@@ -1,5 +1,6 @@
 import celery
 import celery.apps.worker
+import celery.schedules
 import logging
 import tasks
 
@@ -17,7 +18,16 @@ app.conf.update({
             'task': 'tasks.celery_ciao',
             'schedule': 15,
 
-        }
+        },
+        'reconcile-accounts': {
+            'task': 'tasks.reconcile_accounts',
+            # Nightly, only reporting mismatches.
+            # Repair deletes user databases, so is invoked manually (i.e., `invoke database.<env>.reconcile --repair`).
+            'schedule': celery.schedules.crontab(hour=3, minute=0),
+            'kwargs': {
+                'repair': False,
+            },
+        },
     }
 })
 
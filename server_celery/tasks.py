@@ -1,4 +1,16 @@
 import celery
+import logging
+import os
+import requests
+import requests.auth
+
+import migraine_shared.config
+import migraine_shared.reconcile
+import migraine_shared.session
+
+
+# Path is relative to server_celery
+COUCHDB_CONFIG_PATH = os.getenv('COUCHDB_CONFIG_PATH', '../secrets/configuration/dev_couchdb.yaml')
 
 
 print('loading')
@@ -29,3 +41,44 @@ def celery_ciao():
     celery_hola.apply_async()
     celery_hola.apply_async()
     celery_hola.apply_async()
+
+
+@celery.shared_task()
+def reconcile_accounts(repair=False):
+    """
+    Find, and optionally repair, user documents without a database and databases without a user document.
+    """
+    couchdb_config = migraine_shared.config.CouchDBConfig.load(couchdb_config_path=COUCHDB_CONFIG_PATH)
+
+    session = migraine_shared.session.CouchDBSession()
+    session.auth = requests.auth.HTTPBasicAuth(
+        username=couchdb_config.admin_user,
+        password=couchdb_config.admin_password,
+    )
+
+    report = migraine_shared.reconcile.reconcile_accounts(
+        couchdb_session_admin=session,
+        couchdb_baseurl=couchdb_config.routing,
+        repair=repair,
+    )
+
+    if report.teardowns_completed:
+        logging.info('Completed queued teardown of {} accounts'.format(len(report.teardowns_completed)))
+
+    if not report.consistent:
+        logging.warning(
+            'Reconciled accounts: {} users without database, {} databases without user, {} users repaired, {} databases repaired'.format(
+                len(report.users_without_database),
+                len(report.databases_without_user),
+                len(report.users_repaired),
+                len(report.databases_repaired),
+            )
+        )
+
+    return {
+        'users_without_database': report.users_without_database,
+        'databases_without_user': report.databases_without_user,
+        'users_repaired': report.users_repaired,
+        'databases_repaired': report.databases_repaired,
+        'teardowns_completed': report.teardowns_completed,
+    }
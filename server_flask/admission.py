@@ -0,0 +1,147 @@
+from collections import OrderedDict
+import contextlib
+from flask import abort, current_app, jsonify, request
+from functools import wraps
+import math
+import threading
+
+from timeit import default_timer as timer
+
+
+# Maximum clients tracked by a RateLimiter, after which the least recently seen are forgotten.
+RATE_LIMITER_MAX_CLIENTS = 10000
+
+
+class AdmissionRejected(Exception):
+    """
+    A request was not admitted, and may be retried after retry_after seconds.
+    """
+
+    def __init__(self, *, retry_after: float):
+        super().__init__()
+        self.retry_after = retry_after
+
+
+class ConcurrencyLimiter:
+    """
+    Limit on concurrent requests, with a bounded queue of requests waiting to run.
+
+    A request that cannot run immediately waits in the queue for up to wait_timeout.
+    A request is rejected if the queue is full, or if it times out in the queue.
+    """
+
+    def __init__(self, *, max_concurrent: int, max_waiting: int, wait_timeout: float):
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._max_waiting = max_waiting
+        self._wait_timeout = wait_timeout
+
+        self._lock = threading.Lock()
+        self._waiting = 0
+
+    @contextlib.contextmanager
+    def admit(self):
+        if not self._semaphore.acquire(blocking=False):
+            with self._lock:
+                if self._waiting >= self._max_waiting:
+                    raise AdmissionRejected(retry_after=self._wait_timeout)
+                self._waiting += 1
+
+            try:
+                acquired = self._semaphore.acquire(timeout=self._wait_timeout)
+            finally:
+                with self._lock:
+                    self._waiting -= 1
+
+            if not acquired:
+                raise AdmissionRejected(retry_after=self._wait_timeout)
+
+        try:
+            yield
+        finally:
+            self._semaphore.release()
+
+
+class RateLimiter:
+    """
+    Token bucket for each client.
+
+    Each bucket holds up to burst tokens and refills at rate tokens per second.
+    Each request takes one token, and is rejected if the bucket of its client is empty.
+    """
+
+    def __init__(self, *, rate: float, burst: int):
+        self._rate = rate
+        self._burst = burst
+
+        self._lock = threading.Lock()
+        self._buckets: OrderedDict = OrderedDict()
+
+    def admit(self, *, client: str):
+        time_current = timer()
+
+        with self._lock:
+            tokens, time_updated = self._buckets.pop(client, (self._burst, time_current))
+            tokens = min(self._burst, tokens + (time_current - time_updated) * self._rate)
+
+            if tokens < 1:
+                self._buckets[client] = (tokens, time_current)
+                raise AdmissionRejected(retry_after=(1 - tokens) / self._rate)
+
+            self._buckets[client] = (tokens - 1, time_current)
+            if len(self._buckets) > RATE_LIMITER_MAX_CLIENTS:
+                self._buckets.popitem(last=False)
+
+
+class AdmissionController:
+    """
+    Admission of requests to an endpoint, by a per-client RateLimiter and then a shared ConcurrencyLimiter.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_concurrent: int,
+        max_waiting: int,
+        wait_timeout: float,
+        rate: float,
+        burst: int,
+    ):
+        self.concurrency_limiter = ConcurrencyLimiter(
+            max_concurrent=max_concurrent,
+            max_waiting=max_waiting,
+            wait_timeout=wait_timeout,
+        )
+        self.rate_limiter = RateLimiter(rate=rate, burst=burst)
+
+    @contextlib.contextmanager
+    def admit(self, *, client: str):
+        self.rate_limiter.admit(client=client)
+        with self.concurrency_limiter.admit():
+            yield
+
+
+def admission_controlled(extension_name: str):
+    """
+    Decorator function to admit a request through the AdmissionController in app.extensions[extension_name].
+
+    Raise 429 with Retry-After if the request is not admitted.
+    """
+
+    def decorator(f):
+        @wraps(f)
+        def check_admission(*args, **kwargs):
+            # The client is the address obtained by ProxyFix from trusted proxies, not one the client can provide.
+            client = request.remote_addr
+
+            try:
+                with current_app.extensions[extension_name].admit(client=client):
+                    return f(*args, **kwargs)
+            except AdmissionRejected as rejected:
+                response = jsonify(message="Too many requests.")
+                response.status_code = 429
+                response.headers["Retry-After"] = str(math.ceil(rejected.retry_after))
+                abort(response)  # 429 Too Many Requests
+
+        return check_admission
+
+    return decorator
@@ -1,11 +1,23 @@
-from flask import Flask
+from flask import Flask, g, jsonify
 from flask_cors import CORS
 from flask_json import as_json
 from flask_json import FlaskJSON
 import logging
 import os
+import requests.exceptions
+from werkzeug.middleware.proxy_fix import ProxyFix
 
-from users import users_blueprint
+import migraine_shared.password
+import migraine_shared.session
+
+from admission import AdmissionController
+from batch import batch_blueprint
+from capture import CaptureMiddleware
+from codec import CodecJSONProvider
+from compression import CompressionMiddleware
+from profiling import cpu_profiling_blueprint, profiling_blueprint, ProfilingMiddleware
+from user_directory import UserDirectory
+from users import ROUND_TRIPS_HEADER, users_blueprint
 
 
 def create_app():
@@ -30,14 +42,113 @@ def create_app():
     # Although ingress could provide CORS in production,
     # our development configuration also generates CORS requests.
     # Simple CORS wrapper of the application allows any and all requests.
-    CORS(app)
+    # Allow browsers to cache preflight responses, rather than a preflight before every request.
+    CORS(app, max_age=app.config["CORS_MAX_AGE"])
 
-    # Improved JSON support.
+    # Improved JSON support, encoding and decoding with our codec.
     FlaskJSON(app)
+    app.json_provider_class = CodecJSONProvider
+    app.json = CodecJSONProvider(app)
+
+    # Directory of users on each cluster, maintained in the background from its _users changes feed.
+    database_baseurls = app.config["DATABASE_ROUTING"].baseurls
+    user_directories = {}
+    for (index, baseurl) in enumerate(database_baseurls):
+        snapshot_path = app.config["USER_DIRECTORY_SNAPSHOT_PATH"]
+        if snapshot_path and len(database_baseurls) > 1:
+            # Each cluster requires its own snapshot
+            snapshot_path = "{}.{}".format(snapshot_path, index)
+
+        user_directories[baseurl] = UserDirectory(
+            baseurl=baseurl,
+            admin_user=app.config["DATABASE_ADMIN_USER"],
+            admin_password=app.config["DATABASE_ADMIN_PASSWORD"],
+            internal_baseurl=app.config["DATABASE_INTERNAL_BASEURLS"].get(baseurl),
+            snapshot_path=snapshot_path,
+        )
+        user_directories[baseurl].start()
+    app.extensions["user_directories"] = user_directories
+
+    # Admission control for creating users, which is the most expensive endpoint.
+    app.extensions["create_user_admission"] = AdmissionController(
+        max_concurrent=app.config["CREATE_USER_MAX_CONCURRENT"],
+        max_waiting=app.config["CREATE_USER_MAX_WAITING"],
+        wait_timeout=app.config["CREATE_USER_WAIT_TIMEOUT"],
+        rate=app.config["CREATE_USER_RATE"],
+        burst=app.config["CREATE_USER_BURST"],
+    )
+
+    # Process pool deriving password keys, if Flask rather than the database derives them.
+    if app.config["PASSWORD_HASH_ITERATIONS"]:
+        app.extensions["password_executor"] = migraine_shared.password.create_password_executor(
+            max_workers=app.config["PASSWORD_HASH_PROCESSES"],
+        )
+
+    # Every database call made in serving a request must complete within the deadline of the request.
+    # The deadline is a context variable, so the same thread must enter and exit it.
+    @app.before_request
+    def enter_deadline():
+        g.deadline = migraine_shared.session.deadline(app.config["DATABASE_REQUEST_DEADLINE"])
+        g.deadline.__enter__()
+
+    @app.teardown_request
+    def exit_deadline(exception):
+        if "deadline" in g:
+            g.deadline.__exit__(None, None, None)
+
+    # Report the database round trips of each authenticated request, so tests can hold endpoints to a budget.
+    @app.after_request
+    def report_round_trips(response):
+        if g.get("authenticated"):
+            response.headers[ROUND_TRIPS_HEADER] = str(g.get("couchdb_round_trips", 0))
+        return response
+
+    # Fail fast while the database is unhealthy, rather than holding a thread.
+    @app.errorhandler(migraine_shared.session.CircuitOpen)
+    def handle_circuit_open(error):
+        response = jsonify(message="Database unavailable.")
+        response.status_code = 503
+        response.headers["Retry-After"] = str(int(error.retry_after))
+        return response
+
+    @app.errorhandler(requests.exceptions.Timeout)
+    def handle_database_timeout(error):
+        response = jsonify(message="Database timeout.")
+        response.status_code = 504
+        return response
+
+    # Compress large responses, for clients that accept it.
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app,
+        minimum_size=app.config["COMPRESSION_MINIMUM_SIZE"],
+        gzip_level=app.config["COMPRESSION_GZIP_LEVEL"],
+        brotli_quality=app.config["COMPRESSION_BROTLI_QUALITY"],
+    )
+
+    # Capture sanitized traces of requests, if configured, for replay.
+    if app.config["CAPTURE_PATH"]:
+        app.wsgi_app = CaptureMiddleware(
+            app.wsgi_app,
+            secret_key=app.config["SECRET_KEY"],
+            path=app.config["CAPTURE_PATH"],
+            max_bytes=app.config["CAPTURE_MAX_BYTES"],
+            backup_count=app.config["CAPTURE_BACKUP_COUNT"],
+        )
+
+    # Profile requests that opt in, including compressing their response.
+    app.wsgi_app = ProfilingMiddleware(app.wsgi_app, secret_key=app.config["SECRET_KEY"])
+
+    # The client address is the one appended to X-Forwarded-For by the outermost trusted proxy.
+    # Every middleware and endpoint therefore sees that address, rather than an address the client provided.
+    if app.config["TRUSTED_PROXY_HOPS"]:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config["TRUSTED_PROXY_HOPS"])
 
     # Register blue prints.
     # TODO - maybe move blue prints to their own folder if functions explode.
     app.register_blueprint(users_blueprint, url_prefix="/users")
+    app.register_blueprint(batch_blueprint)
+    app.register_blueprint(profiling_blueprint, url_prefix="/_admin/memory")
+    app.register_blueprint(cpu_profiling_blueprint, url_prefix="/_admin/cpu")
 
     # Basic status endpoint.
     # TODO - move this into a blueprint
@@ -0,0 +1,215 @@
+from flask import Blueprint, current_app, Flask, g, request
+from flask_json import as_json
+import concurrent.futures
+import contextlib
+import logging
+from typing import Dict, List, Optional
+
+import migraine_shared.session
+
+import codec
+from users import _validate_request_json_schema, ROUND_TRIPS_HEADER, secure
+
+from timeit import default_timer as timer
+
+
+batch_blueprint = Blueprint("batch_blueprint", __name__)
+
+
+# Maximum number of sub-requests in a single batch.
+BATCH_MAX_REQUESTS = 100
+
+# Sub-requests that are executed concurrently.
+# Shared by every batch, so concurrent batches cannot multiply the load on the database.
+BATCH_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=8,
+    thread_name_prefix="batch",
+)
+
+# Methods of sub-requests that only read, which are executed concurrently.
+# Any other sub-request is a barrier, executed only after every previous sub-request.
+READ_METHODS = ["GET"]
+
+# Headers of a sub-response that are not returned, as they describe its transport rather than its content.
+OMITTED_HEADERS = ["Access-Control-Allow-Origin", "Content-Length", "Content-Type"]
+
+BATCH_VALIDATOR = codec.register_validator(
+    name="batch",
+    schema={
+        "type": "object",
+        "properties": {
+            "requests": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "method": {"enum": ["GET", "POST", "DELETE"]},
+                        # Sub-requests are limited to the users blueprint.
+                        "path": {"type": "string", "pattern": "^/users/"},
+                        "headers": {
+                            "type": "object",
+                            "additionalProperties": {"type": "string"},
+                        },
+                        "body": {},
+                    },
+                    "required": ["method", "path"],
+                },
+                "maxItems": BATCH_MAX_REQUESTS,
+            },
+        },
+        "required": ["requests"],
+    },
+)
+
+
+def _remaining(*, deadline_time: Optional[float]) -> Optional[float]:
+    """
+    Obtain the seconds remaining before the deadline of the batch, or None if it has no deadline.
+    """
+    if deadline_time is None:
+        return None
+
+    return max(deadline_time - timer(), 0)
+
+
+def _execute(
+    *,
+    app: Flask,
+    sub_request: Dict,
+    batch_headers: Dict,
+    batch_environ: Dict,
+    deadline_time: Optional[float],
+) -> Dict:
+    """
+    Execute a sub-request, as if it had been received by the app.
+
+    Runs in its own app and request context, with the hooks and error handlers of a complete request.
+    The sub-request has the authorization and client address of the batch, and is limited by the deadline of the batch.
+    A sub-request that would start after that deadline instead fails with 504.
+    """
+    remaining = _remaining(deadline_time=deadline_time)
+    if remaining == 0:
+        return {"status": 504, "headers": {}, "body": {"message": "Batch deadline exceeded."}}
+
+    headers = dict(sub_request.get("headers", {}))
+    headers.pop("X-Forwarded-For", None)
+    headers.update(batch_headers)
+
+    try:
+        # The deadline is a context variable, which is not inherited by the executor thread.
+        # The deadline of the sub-request is nested within it, so cannot extend it.
+        with migraine_shared.session.deadline(remaining) if remaining is not None else contextlib.nullcontext():
+            with app.app_context():
+                with app.test_request_context(
+                    sub_request["path"],
+                    method=sub_request["method"],
+                    headers=headers,
+                    json=sub_request.get("body"),
+                    environ_base=batch_environ,
+                ):
+                    response = app.full_dispatch_request()
+    except Exception:
+        logging.exception("Failure executing batch sub-request {} {}".format(sub_request["method"], sub_request["path"]))
+        return {"status": 500, "headers": {}, "body": None}
+
+    return {
+        "status": response.status_code,
+        "headers": {
+            key: value
+            for (key, value) in response.headers.items()
+            if key not in OMITTED_HEADERS
+        },
+        "body": response.get_json(silent=True),
+    }
+
+
+@batch_blueprint.route("/_batch", methods=["POST"])
+@as_json
+@secure
+def batch():
+    """
+    Execute many sub-requests against the users blueprint.
+
+    Consecutive reads are executed concurrently.
+    Any other sub-request waits for every previous sub-request, and is completed before any later sub-request starts.
+    Each sub-request is authorized by the authorization of the batch.
+    Sub-requests share the deadline of the batch, and any that remain when it passes have status 504.
+
+    Body params:
+    {
+        "requests": [
+            {
+                "method": "GET", "POST", or "DELETE",
+                "path": path of the sub-request, beginning "/users/",
+                "headers": {optional headers of the sub-request},
+                "body": optional JSON body of the sub-request,
+            },
+            ...
+        ]
+    }
+
+    Returns:
+    {
+        "responses": [
+            {
+                "status": status of the sub-response,
+                "headers": {headers of the sub-response},
+                "body": JSON body of the sub-response, or null,
+            },
+            ...
+        ]
+    }
+    """
+    #
+    # Validate the contents of the request
+    #
+
+    _validate_request_json_schema(instance=request.json, validator=BATCH_VALIDATOR)
+
+    # Obtain contents of the request
+    sub_requests = request.json["requests"]
+
+    #
+    # Execute the sub-requests
+    #
+
+    app = current_app._get_current_object()
+    batch_headers = {"Authorization": request.headers["Authorization"]}
+    if "X-Forwarded-For" in request.headers:
+        batch_headers["X-Forwarded-For"] = request.headers["X-Forwarded-For"]
+    batch_environ = {"REMOTE_ADDR": request.remote_addr}
+
+    remaining = migraine_shared.session.remaining()
+    deadline_time = timer() + remaining if remaining is not None else None
+
+    futures: List[concurrent.futures.Future] = []
+    for sub_request in sub_requests:
+        if sub_request["method"] not in READ_METHODS:
+            # Barrier, wait for every previous sub-request
+            concurrent.futures.wait(futures, timeout=_remaining(deadline_time=deadline_time))
+
+        futures.append(
+            BATCH_EXECUTOR.submit(
+                _execute,
+                app=app,
+                sub_request=sub_request,
+                batch_headers=batch_headers,
+                batch_environ=batch_environ,
+                deadline_time=deadline_time,
+            )
+        )
+
+        if sub_request["method"] not in READ_METHODS:
+            # Barrier, complete before any later sub-request
+            concurrent.futures.wait(futures, timeout=_remaining(deadline_time=deadline_time))
+
+    responses = [future.result() for future in futures]
+
+    # Round trips of the batch are those of its sub-requests.
+    g.couchdb_round_trips = g.get("couchdb_round_trips", 0) + sum(
+        int(response["headers"].get(ROUND_TRIPS_HEADER, 0)) for response in responses
+    )
+
+    return {
+        "responses": responses
+    }
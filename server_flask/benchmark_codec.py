@@ -0,0 +1,75 @@
+"""
+Micro-benchmark of request validation and JSON encoding and decoding.
+
+Compares each codec operation against the approach it replaced:
+- jsonschema.validate, which checks the schema and builds a validator on every call.
+- The standard library json, used by Flask-JSON and by requests.
+
+Run from server_flask:
+
+    python benchmark_codec.py
+"""
+
+import json
+import jsonschema
+import timeit
+
+import codec
+import migraine_shared.codec
+import users
+
+# Iterations of each operation.
+NUMBER = 2000
+
+# Representative payloads.
+CREATE_USER_REQUEST = {"user_name": "benchmark_user", "user_password": "benchmark_password"}
+USERS_RESPONSE = {"users": ["user_{:05d}".format(index) for index in range(1000)]}
+ALL_DOCS_RESPONSE = json.dumps({
+    "total_rows": 1000,
+    "offset": 0,
+    "rows": [
+        {
+            "id": "org.couchdb.user:user_{:05d}".format(index),
+            "key": "org.couchdb.user:user_{:05d}".format(index),
+            "value": {"rev": "1-{:032x}".format(index)},
+        }
+        for index in range(1000)
+    ],
+}).encode("utf-8")
+
+
+def _benchmark(name: str, baseline, candidate):
+    time_baseline = timeit.timeit(baseline, number=NUMBER)
+    time_candidate = timeit.timeit(candidate, number=NUMBER)
+
+    print("{:<24} {:>10.1f}us {:>10.1f}us {:>8.1f}x".format(
+        name,
+        time_baseline / NUMBER * 1e6,
+        time_candidate / NUMBER * 1e6,
+        time_baseline / time_candidate,
+    ))
+
+
+def main():
+    print("orjson: {}".format("installed" if migraine_shared.codec.orjson else "not installed, using json"))
+    print("{:<24} {:>12} {:>12} {:>9}".format("operation", "baseline", "codec", "speedup"))
+
+    _benchmark(
+        "validate create_user",
+        lambda: jsonschema.validate(instance=CREATE_USER_REQUEST, schema=users.CREATE_USER_VALIDATOR.schema),
+        lambda: codec.validation_error(validator=users.CREATE_USER_VALIDATOR, instance=CREATE_USER_REQUEST),
+    )
+    _benchmark(
+        "encode users response",
+        lambda: json.dumps(USERS_RESPONSE, sort_keys=True),
+        lambda: migraine_shared.codec.dumps(USERS_RESPONSE, sort_keys=True),
+    )
+    _benchmark(
+        "decode _all_docs",
+        lambda: json.loads(ALL_DOCS_RESPONSE),
+        lambda: migraine_shared.codec.loads(ALL_DOCS_RESPONSE),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,181 @@
+import hashlib
+import hmac
+import io
+import json
+import logging
+import logging.handlers
+import re
+import time
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import parse_qsl
+
+# Paths that are not captured, as they are not application traffic.
+EXCLUDED_PATH_PREFIXES = ["/_admin/"]
+
+# Keys whose string values are user names, replaced by a pseudonym.
+USER_NAME_KEYS = ["user_name", "user_names"]
+
+# Keys whose string values are paths, whose user names are replaced by a pseudonym.
+PATH_KEYS = ["path"]
+
+# Keys whose string values are retained, as each is one of a few values that cannot identify a user.
+# Names of the keys of any object, including header names, are always retained.
+RETAINED_VALUES = {
+    "method": ["GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"],
+}
+
+# Query arguments retained, as their values cannot identify a user.
+RETAINED_QUERY_ARGS = ["limit"]
+
+# A redacted string, retaining only its length.
+REDACTED_FORMAT = "<redacted:{}>"
+REDACTED_PATTERN = re.compile("^<redacted:([0-9]+)>$")
+
+# Segments of a path that are user names, within "/users/".
+USER_PATH_PATTERN = re.compile("^(/users/)([^_/][^/]*)(.*)$")
+
+
+def pseudonym(*, key: bytes, value: str) -> str:
+    """
+    Obtain a stable pseudonym for a value, which cannot be reversed without the key.
+
+    A pseudonym of a user name is itself a valid user name, so it can be created on replay.
+    """
+    return "p{}".format(hmac.new(key, value.encode("utf-8"), hashlib.sha256).hexdigest()[:20])
+
+
+def sanitize_path(*, key: bytes, path: str) -> str:
+    match = USER_PATH_PATTERN.match(path)
+    if match is None:
+        return path
+
+    return "{}{}{}".format(match.group(1), pseudonym(key=key, value=match.group(2)), match.group(3))
+
+
+def route_for_path(path: str) -> str:
+    """
+    Obtain the route of a sanitized path, for grouping requests.
+    """
+    return USER_PATH_PATTERN.sub("\\1<user_name>\\3", path)
+
+
+def body_shape(*, key: bytes, value: Any, parent_key: Optional[str] = None) -> Any:
+    """
+    Obtain the shape of a JSON body.
+
+    Structure, keys, numbers, and booleans are retained, as are enumerated values such as the method of a sub-request.
+    User names are replaced by a pseudonym, and any other string is redacted to its length.
+    """
+    if isinstance(value, dict):
+        return {
+            item_key: body_shape(key=key, value=item_value, parent_key=item_key)
+            for (item_key, item_value) in value.items()
+        }
+    if isinstance(value, list):
+        return [body_shape(key=key, value=item, parent_key=parent_key) for item in value]
+    if isinstance(value, str):
+        if parent_key in USER_NAME_KEYS:
+            return pseudonym(key=key, value=value)
+        if parent_key in PATH_KEYS:
+            return sanitize_path(key=key, path=value)
+        if value in RETAINED_VALUES.get(parent_key, []):
+            return value
+        return REDACTED_FORMAT.format(len(value))
+
+    return value
+
+
+class CaptureMiddleware:
+    """
+    WSGI middleware capturing sanitized traces of requests to a rotating file, as JSON lines.
+
+    A trace includes the method, route, timing, status, and shape of the body of a request.
+    It never includes credentials, header values, passwords, or user names.
+    User names and client addresses are replaced by pseudonyms keyed by the secret key,
+    so requests by the same user remain related across pods and restarts.
+    """
+
+    def __init__(
+        self,
+        app: Callable,
+        *,
+        secret_key: str,
+        path: str,
+        max_bytes: int,
+        backup_count: int,
+    ):
+        self.app = app
+        self._key = secret_key.encode("utf-8")
+
+        # A dedicated logger, so traces are not mixed with application logging.
+        handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        self._logger = logging.getLogger("{}.{}".format(__name__, path))
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._logger.handlers = [handler]
+
+    def _trace(self, environ) -> Optional[Dict]:
+        path = environ.get("PATH_INFO", "")
+        if any(path.startswith(prefix) for prefix in EXCLUDED_PATH_PREFIXES):
+            return None
+
+        # Read and restore the body, so its shape can be captured.
+        body = None
+        content_length = int(environ.get("CONTENT_LENGTH") or 0)
+        if content_length:
+            raw_body = environ["wsgi.input"].read(content_length)
+            environ["wsgi.input"] = io.BytesIO(raw_body)
+            try:
+                body = body_shape(key=self._key, value=json.loads(raw_body))
+            except ValueError:
+                body = REDACTED_FORMAT.format(len(raw_body))
+
+        # The client address, as obtained by ProxyFix from trusted proxies.
+        client = environ.get("REMOTE_ADDR", "")
+        sanitized_path = sanitize_path(key=self._key, path=path)
+
+        return {
+            "time": time.time(),
+            "method": environ["REQUEST_METHOD"],
+            "path": sanitized_path,
+            "route": route_for_path(sanitized_path),
+            "query": {
+                query_key: query_value
+                for (query_key, query_value) in parse_qsl(environ.get("QUERY_STRING", ""))
+                if query_key in RETAINED_QUERY_ARGS
+            },
+            "conditional": "HTTP_IF_NONE_MATCH" in environ,
+            "client": pseudonym(key=self._key, value=client),
+            "request_bytes": content_length,
+            "body": body,
+        }
+
+    def __call__(self, environ, start_response):
+        trace = self._trace(environ)
+        if trace is None:
+            return self.app(environ, start_response)
+
+        return self._capture(environ=environ, start_response=start_response, trace=trace)
+
+    def _capture(self, *, environ, start_response, trace: Dict):
+        start = time.perf_counter()
+
+        def capture_start_response(status, response_headers, exc_info=None):
+            trace["status"] = int(status.split(" ", 1)[0])
+            return start_response(status, response_headers, exc_info)
+
+        response_bytes = 0
+        app_iter = self.app(environ, capture_start_response)
+        try:
+            for chunk in app_iter:
+                response_bytes += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
+
+            trace["duration"] = time.perf_counter() - start
+            trace["response_bytes"] = response_bytes
+            self._logger.info(json.dumps(trace, sort_keys=True))
+
@@ -0,0 +1,53 @@
+from flask_json import FlaskJSONProvider
+import jsonschema
+import jsonschema.exceptions
+import jsonschema.protocols
+import jsonschema.validators
+from typing import Any, Dict
+
+import migraine_shared.codec
+
+
+VALIDATORS: Dict[str, jsonschema.protocols.Validator] = {}
+"""
+Registry of validators, each compiled once from its schema.
+"""
+
+
+def register_validator(*, name: str, schema: Dict) -> jsonschema.protocols.Validator:
+    """
+    Check a schema and compile its validator, registering it under name.
+
+    Raises jsonschema.SchemaError if the schema is invalid, so an invalid schema fails at import.
+    """
+    assert name not in VALIDATORS
+
+    validator_class = jsonschema.validators.validator_for(schema)
+    validator_class.check_schema(schema)
+
+    VALIDATORS[name] = validator_class(schema)
+
+    return VALIDATORS[name]
+
+
+def validation_error(*, validator: jsonschema.protocols.Validator, instance: Any):
+    """
+    Obtain the most relevant error in validating instance, or None if it is valid.
+    """
+    return jsonschema.exceptions.best_match(validator.iter_errors(instance))
+
+
+class CodecJSONProvider(FlaskJSONProvider):
+    """
+    Flask-JSON provider that encodes and decodes using migraine_shared.codec.
+    """
+
+    def dumps(self, obj: Any, **kwargs: Any) -> str:
+        return migraine_shared.codec.dumps(
+            obj,
+            default=self.default,
+            sort_keys=kwargs.get("sort_keys", self.sort_keys),
+        ).decode("utf-8")
+
+    def loads(self, s, **kwargs: Any) -> Any:
+        return migraine_shared.codec.loads(s)
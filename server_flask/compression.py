@@ -0,0 +1,224 @@
+import zlib
+from typing import Callable, Iterable, List, Optional, Tuple
+
+from werkzeug.datastructures import Headers
+from werkzeug.http import parse_accept_header
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+# Content types that benefit from compression.
+COMPRESSIBLE_MIMETYPES = [
+    "application/json",
+    "text/html",
+    "text/plain",
+]
+
+# Statuses whose responses have no body.
+NO_BODY_STATUSES = [204, 304]
+
+
+def _add_vary(headers: Headers):
+    """
+    Add Accept-Encoding to the Vary of a response, unless it is already present.
+    """
+    vary = [value.strip().lower() for value in headers.get("Vary", "").split(",") if value.strip()]
+    if "*" not in vary and "accept-encoding" not in vary:
+        headers["Vary"] = ", ".join([headers["Vary"], "Accept-Encoding"]) if vary else "Accept-Encoding"
+
+
+class _GzipCompressor:
+    def __init__(self, *, level: int):
+        # A wbits of 16 + MAX_WBITS produces a gzip header and trailer.
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush(zlib.Z_FINISH)
+
+
+class _BrotliCompressor:
+    def __init__(self, *, quality: int):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+class CompressionMiddleware:
+    """
+    WSGI middleware compressing responses, negotiated using Accept-Encoding.
+
+    Supports brotli if it is installed, and gzip.
+    A response is compressed only if its body reaches minimum_size.
+    If the length of a response is not known, its body is buffered only until it reaches minimum_size,
+    after which each chunk is compressed and flushed as it is produced, so a chunked response is still streamed.
+    """
+
+    def __init__(
+        self,
+        app: Callable,
+        *,
+        minimum_size: int,
+        gzip_level: int,
+        brotli_quality: int,
+    ):
+        self.app = app
+        self.minimum_size = minimum_size
+        self.gzip_level = gzip_level
+        self.brotli_quality = brotli_quality
+
+    def _negotiate(self, *, accept_encoding: str) -> Optional[str]:
+        """
+        Obtain the preferred supported encoding, or None if the response should not be encoded.
+        """
+        accepted = parse_accept_header(accept_encoding)
+
+        # Prefer the highest quality, then the order of supported.
+        supported = ["br", "gzip"] if brotli else ["gzip"]
+        encoding = max(supported, key=lambda encoding: (accepted.quality(encoding), -supported.index(encoding)))
+
+        return encoding if accepted.quality(encoding) > 0 else None
+
+    def _compressor(self, *, encoding: str):
+        if encoding == "br":
+            return _BrotliCompressor(quality=self.brotli_quality)
+
+        return _GzipCompressor(level=self.gzip_level)
+
+    def __call__(self, environ, start_response):
+        encoding = self._negotiate(accept_encoding=environ.get("HTTP_ACCEPT_ENCODING", ""))
+        if encoding is None or environ["REQUEST_METHOD"] == "HEAD":
+            # The response would differ with a different Accept-Encoding, even though this one is not encoded.
+            def vary_start_response(status, response_headers, exc_info=None):
+                headers = Headers(response_headers)
+                _add_vary(headers)
+                return start_response(status, headers.to_wsgi_list(), exc_info)
+
+            return self.app(environ, vary_start_response)
+
+        # Headers are held until enough of the body is known to decide whether to compress.
+        # An app may call start_response lazily, as it produces its first chunk.
+        captured: List[Tuple[str, Headers, Optional[object]]] = []
+        # A write callable obtained from start_response, if the app used it and the response is therefore not encoded.
+        passthrough_write: List[Callable] = []
+
+        def capture_start_response(status, response_headers, exc_info=None):
+            captured[:] = [(status, Headers(response_headers), exc_info)]
+
+            def write(data):
+                # The legacy write callable cannot be buffered, so the response is sent without encoding.
+                if not passthrough_write:
+                    (status_captured, headers, exc_info_captured) = captured[0]
+                    _add_vary(headers)
+                    passthrough_write.append(start_response(status_captured, headers.to_wsgi_list(), exc_info_captured))
+                passthrough_write[0](data)
+
+            return write
+
+        app_iter = self.app(environ, capture_start_response)
+
+        return self._respond(
+            app_iter=app_iter,
+            captured=captured,
+            passthrough_write=passthrough_write,
+            encoding=encoding,
+            start_response=start_response,
+        )
+
+    def _compressible(self, *, status: str, headers: Headers) -> bool:
+        if int(status.split(" ", 1)[0]) in NO_BODY_STATUSES:
+            return False
+        if "Content-Encoding" in headers:
+            return False
+        if headers.get("Content-Type", "").split(";")[0].strip() not in COMPRESSIBLE_MIMETYPES:
+            return False
+
+        content_length = headers.get("Content-Length", type=int)
+        if content_length is not None and content_length < self.minimum_size:
+            return False
+
+        return True
+
+    def _respond(
+        self,
+        *,
+        app_iter,
+        captured,
+        passthrough_write,
+        encoding: str,
+        start_response,
+    ) -> Iterable[bytes]:
+        try:
+            chunks = iter(app_iter)
+
+            # Buffer until start_response has been called, and the body reaches the minimum size or ends.
+            buffered = []
+            buffered_size = 0
+            exhausted = False
+            while not captured or buffered_size < self.minimum_size:
+                if passthrough_write:
+                    break
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                    break
+                buffered.append(chunk)
+                buffered_size += len(chunk)
+
+            if passthrough_write:
+                # Headers were sent when the app used write, so the remainder is also not encoded.
+                yield from buffered
+                if not exhausted:
+                    yield from chunks
+                return
+
+            if not captured:
+                raise RuntimeError("The app did not call start_response.")
+
+            (status, headers, exc_info) = captured[0]
+            _add_vary(headers)
+
+            if buffered_size < self.minimum_size or not self._compressible(status=status, headers=headers):
+                start_response(status, headers.to_wsgi_list(), exc_info)
+                yield from buffered
+                if not exhausted:
+                    yield from chunks
+                return
+
+            headers["Content-Encoding"] = encoding
+            headers.remove("Content-Length")
+            # The encoded representation differs from the identity representation.
+            etag = headers.get("ETag")
+            if etag and not etag.startswith("W/"):
+                headers["ETag"] = "W/{}".format(etag)
+            start_response(status, headers.to_wsgi_list(), exc_info)
+
+            compressor = self._compressor(encoding=encoding)
+            compressed = compressor.compress(b"".join(buffered))
+            if not exhausted:
+                for chunk in chunks:
+                    compressed += compressor.compress(chunk)
+                    compressed += compressor.flush()
+                    if compressed:
+                        yield compressed
+                        compressed = b""
+            compressed += compressor.finish()
+            yield compressed
+        finally:
+            if hasattr(app_iter, "close"):
+                app_iter.close()
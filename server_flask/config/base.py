@@ -1,3 +1,8 @@
+from typing import Dict, Optional
+
+import migraine_shared.routing
+
+
 class Config:
     SECRET_KEY: str
     """
@@ -21,12 +26,146 @@ class Config:
     Admin password for the database.
     """
 
+    DATABASE_ROUTING: migraine_shared.routing.RoutingTable
+    """
+    Routing of users to database clusters.
+
+    Every cluster shares the admin user and password.
+    """
+
+    DATABASE_INTERNAL_BASEURLS: Dict[str, str]
+    """
+    Internal baseurl of each database cluster, used for server-side calls in place of its public baseurl.
+    """
+
+    DATABASE_CONNECT_TIMEOUT: float
+    """
+    Seconds to wait when connecting to the database.
+    """
+
+    DATABASE_READ_TIMEOUT: float
+    """
+    Seconds to wait between bytes of a response from the database.
+    """
+
+    DATABASE_REQUEST_DEADLINE: float
+    """
+    Seconds within which every database call made in serving a request must complete.
+    """
+
+    CREATE_USER_MAX_CONCURRENT: int
+    """
+    Maximum concurrent requests to create a user.
+    """
+
+    CREATE_USER_MAX_WAITING: int
+    """
+    Maximum requests to create a user that wait for one of create_user_max_concurrent.
+    """
+
+    CREATE_USER_WAIT_TIMEOUT: float
+    """
+    Seconds a request to create a user waits before it is rejected.
+    """
+
+    CREATE_USER_RATE: float
+    """
+    Requests to create a user allowed per second from each client, once its burst is used.
+    """
+
+    CREATE_USER_BURST: int
+    """
+    Requests to create a user allowed from each client in a burst.
+    """
+
+    TRUSTED_PROXY_HOPS: int
+    """
+    Proxies in front of Flask that each append to X-Forwarded-For, whose addresses are trusted.
+    """
+
+    PASSWORD_HASH_ITERATIONS: Optional[int]
+    """
+    PBKDF2 iterations used to derive password keys in a process pool, or None to leave derivation to the database.
+    """
+
+    PASSWORD_HASH_PROCESSES: int
+    """
+    Processes in the pool deriving password keys.
+    """
+
+    COMPRESSION_MINIMUM_SIZE: int
+    """
+    Minimum bytes of a response body before it is compressed.
+    """
+
+    COMPRESSION_GZIP_LEVEL: int
+    """
+    Level of gzip compression, from 1 (fastest) to 9 (smallest).
+    """
+
+    COMPRESSION_BROTLI_QUALITY: int
+    """
+    Quality of brotli compression, from 0 (fastest) to 11 (smallest).
+    """
+
+    CACHE_CONTROL: str
+    """
+    Cache-Control header applied to cacheable responses, which are also given an ETag.
+    """
+
+    CORS_MAX_AGE: int
+    """
+    Seconds a browser may cache a CORS preflight response.
+    """
+
+    USER_DIRECTORY_SNAPSHOT_PATH: Optional[str]
+    """
+    Path of a snapshot used to bootstrap the in-memory user directory, or None.
+    """
+
+    CAPTURE_PATH: Optional[str]
+    """
+    Path of a file to which sanitized request traces are captured, or None.
+    """
+
+    CAPTURE_MAX_BYTES: int
+    """
+    Bytes of a capture file before it is rotated.
+    """
+
+    CAPTURE_BACKUP_COUNT: int
+    """
+    Rotated capture files retained.
+    """
+
     def __init__(
         self,
         secret_key: str,
         database_baseurl: str,
         database_admin_user: str,
         database_admin_password: str,
+        database_routing: migraine_shared.routing.RoutingTable,
+        database_internal_baseurls: Dict[str, str],
+        database_connect_timeout: float,
+        database_read_timeout: float,
+        database_request_deadline: float,
+        create_user_max_concurrent: int,
+        create_user_max_waiting: int,
+        create_user_wait_timeout: float,
+        create_user_rate: float,
+        create_user_burst: int,
+        trusted_proxy_hops: int,
+        password_hash_iterations: Optional[int],
+        password_hash_processes: int,
+        compression_minimum_size: int,
+        compression_gzip_level: int,
+        compression_brotli_quality: int,
+        cache_control: str,
+        cors_max_age: int,
+        user_directory_snapshot_path: Optional[str],
+        capture_path: Optional[str],
+        capture_max_bytes: int,
+        capture_backup_count: int,
     ):
         """
         Using an explicit constructor so it is clear fields are required.
@@ -36,3 +175,25 @@ class Config:
         self.DATABASE_BASEURL = database_baseurl
         self.DATABASE_ADMIN_USER = database_admin_user
         self.DATABASE_ADMIN_PASSWORD = database_admin_password
+        self.DATABASE_ROUTING = database_routing
+        self.DATABASE_INTERNAL_BASEURLS = database_internal_baseurls
+        self.DATABASE_CONNECT_TIMEOUT = database_connect_timeout
+        self.DATABASE_READ_TIMEOUT = database_read_timeout
+        self.DATABASE_REQUEST_DEADLINE = database_request_deadline
+        self.CREATE_USER_MAX_CONCURRENT = create_user_max_concurrent
+        self.CREATE_USER_MAX_WAITING = create_user_max_waiting
+        self.CREATE_USER_WAIT_TIMEOUT = create_user_wait_timeout
+        self.CREATE_USER_RATE = create_user_rate
+        self.CREATE_USER_BURST = create_user_burst
+        self.TRUSTED_PROXY_HOPS = trusted_proxy_hops
+        self.PASSWORD_HASH_ITERATIONS = password_hash_iterations
+        self.PASSWORD_HASH_PROCESSES = password_hash_processes
+        self.COMPRESSION_MINIMUM_SIZE = compression_minimum_size
+        self.COMPRESSION_GZIP_LEVEL = compression_gzip_level
+        self.COMPRESSION_BROTLI_QUALITY = compression_brotli_quality
+        self.CACHE_CONTROL = cache_control
+        self.CORS_MAX_AGE = cors_max_age
+        self.USER_DIRECTORY_SNAPSHOT_PATH = user_directory_snapshot_path
+        self.CAPTURE_PATH = capture_path
+        self.CAPTURE_MAX_BYTES = capture_max_bytes
+        self.CAPTURE_BACKUP_COUNT = capture_backup_count
@@ -1,8 +1,11 @@
+import os
+
 from config.base import Config
 import migraine_shared.config
 
 # Path is relative to server_flask
-DEV_FLASK_CONFIG_PATH = "../secrets/configuration/dev_local_flask.yaml"
+# Can be overridden by FLASK_CONFIG_PATH, as when replaying a capture against a local database.
+DEV_FLASK_CONFIG_PATH = os.getenv("FLASK_CONFIG_PATH", "../secrets/configuration/dev_local_flask.yaml")
 
 
 class DevelopmentConfig(Config):
@@ -15,4 +18,26 @@ class DevelopmentConfig(Config):
             database_baseurl=flask_config.database_baseurl,
             database_admin_user=flask_config.database_admin_user,
             database_admin_password=flask_config.database_admin_password,
+            database_routing=flask_config.database_routing,
+            database_internal_baseurls=flask_config.database_internal_baseurls,
+            database_connect_timeout=flask_config.database_connect_timeout,
+            database_read_timeout=flask_config.database_read_timeout,
+            database_request_deadline=flask_config.database_request_deadline,
+            create_user_max_concurrent=flask_config.create_user_max_concurrent,
+            create_user_max_waiting=flask_config.create_user_max_waiting,
+            create_user_wait_timeout=flask_config.create_user_wait_timeout,
+            create_user_rate=flask_config.create_user_rate,
+            create_user_burst=flask_config.create_user_burst,
+            trusted_proxy_hops=flask_config.trusted_proxy_hops,
+            password_hash_iterations=flask_config.password_hash_iterations,
+            password_hash_processes=flask_config.password_hash_processes,
+            compression_minimum_size=flask_config.compression_minimum_size,
+            compression_gzip_level=flask_config.compression_gzip_level,
+            compression_brotli_quality=flask_config.compression_brotli_quality,
+            cache_control=flask_config.cache_control,
+            cors_max_age=flask_config.cors_max_age,
+            user_directory_snapshot_path=flask_config.user_directory_snapshot_path,
+            capture_path=flask_config.capture_path,
+            capture_max_bytes=flask_config.capture_max_bytes,
+            capture_backup_count=flask_config.capture_backup_count,
         )
@@ -0,0 +1,700 @@
+import cProfile
+from collections import Counter, deque, OrderedDict
+from flask import abort, Blueprint, g, jsonify, request, Response
+from flask_json import as_json
+import gc
+import hmac
+import io
+import itertools
+import logging
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List, Optional
+
+from users import secure
+
+
+# Admin endpoints for investigating memory and CPU of this process.
+# A deployment has several pods, and each request is served by one of them.
+profiling_blueprint = Blueprint("profiling_blueprint", __name__)
+cpu_profiling_blueprint = Blueprint("cpu_profiling_blueprint", __name__)
+
+
+# Maximum snapshots retained, after which the oldest is discarded.
+MAX_SNAPSHOTS = 4
+
+# Default and maximum number of allocation sites in a listing.
+STATS_DEFAULT_LIMIT = 25
+STATS_MAX_LIMIT = 500
+
+# Ways to group allocation sites, as supported by tracemalloc.
+KEY_TYPES = ["filename", "lineno", "traceback"]
+
+# Default seconds between samples, and the samples retained.
+SAMPLER_DEFAULT_INTERVAL = 10
+SAMPLER_MAX_SAMPLES = 720
+
+SNAPSHOTS: "OrderedDict[int, tracemalloc.Snapshot]" = OrderedDict()
+SNAPSHOT_IDS = itertools.count(1)
+SNAPSHOTS_LOCK = threading.Lock()
+
+# Endpoints of requests currently being served, so samples can be attributed to them.
+IN_FLIGHT: Counter = Counter()
+IN_FLIGHT_LOCK = threading.Lock()
+
+# Threads currently serving requests, by thread identifier, with their native thread identifier.
+REQUEST_THREADS: Dict[int, int] = {}
+
+# Default and minimum seconds between stack samples.
+STACK_SAMPLER_DEFAULT_INTERVAL = 0.01
+STACK_SAMPLER_MIN_INTERVAL = 0.001
+
+# Header requesting a profile of a request, as "Bearer <secret_key>".
+PROFILE_HEADER = "X-Profile"
+
+# Header of the response identifying its profile.
+PROFILE_ID_HEADER = "X-Profile-Id"
+
+# Maximum profiles retained, after which the oldest is discarded.
+MAX_PROFILES = 32
+
+# Functions listed in a profile.
+PROFILE_LIMIT = 50
+
+PROFILES: "OrderedDict[int, str]" = OrderedDict()
+PROFILE_IDS = itertools.count(1)
+PROFILES_LOCK = threading.Lock()
+
+
+def _rss() -> Dict[str, Optional[int]]:
+    """
+    Obtain current and peak resident set size, in bytes.
+
+    Current RSS is read from /proc, which is available in our Linux containers.
+    """
+    result = {
+        "current": None,
+        "peak": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+    }
+
+    try:
+        with open("/proc/self/status") as status_file:
+            for line in status_file:
+                if line.startswith("VmRSS:"):
+                    result["current"] = int(line.split()[1]) * 1024
+    except OSError:
+        pass
+
+    return result
+
+
+def _gc_stats() -> Dict:
+    return {
+        "counts": list(gc.get_count()),
+        "thresholds": list(gc.get_threshold()),
+        "generations": gc.get_stats(),
+    }
+
+
+def _traced() -> Optional[Dict]:
+    if not tracemalloc.is_tracing():
+        return None
+
+    current, peak = tracemalloc.get_traced_memory()
+    return {
+        "current": current,
+        "peak": peak,
+        "overhead": tracemalloc.get_tracemalloc_memory(),
+    }
+
+
+def _in_flight() -> Dict[str, int]:
+    with IN_FLIGHT_LOCK:
+        return {endpoint: count for (endpoint, count) in IN_FLIGHT.items() if count}
+
+
+class Sampler:
+    """
+    Background thread sampling memory at an interval.
+
+    Each sample reads /proc and counters maintained by the interpreter, so is cheap enough to leave running.
+    """
+
+    def __init__(self):
+        self.samples: deque = deque(maxlen=SAMPLER_MAX_SAMPLES)
+        self.interval: Optional[float] = None
+
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, *, interval: float):
+        self.stop()
+
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="memory_sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        while not self._stop.is_set():
+            self.samples.append({
+                "time": time.time(),
+                "rss": _rss()["current"],
+                "traced": (_traced() or {}).get("current"),
+                "gc_counts": list(gc.get_count()),
+                "in_flight": _in_flight(),
+            })
+            self._stop.wait(self.interval)
+
+
+SAMPLER = Sampler()
+
+
+@profiling_blueprint.before_app_request
+def enter_in_flight():
+    if request.endpoint is None:
+        return
+
+    g.in_flight_endpoint = request.endpoint
+    with IN_FLIGHT_LOCK:
+        IN_FLIGHT[g.in_flight_endpoint] += 1
+        REQUEST_THREADS[threading.get_ident()] = threading.get_native_id()
+
+
+@profiling_blueprint.teardown_app_request
+def exit_in_flight(exception):
+    # Only if enter_in_flight was reached, as an earlier hook may have failed.
+    endpoint = g.pop("in_flight_endpoint", None)
+    if endpoint is not None:
+        with IN_FLIGHT_LOCK:
+            IN_FLIGHT[endpoint] -= 1
+            REQUEST_THREADS.pop(threading.get_ident(), None)
+
+
+def _statistics_args():
+    """
+    Obtain the grouping and limit of a listing of allocation sites.
+    """
+    key_type = request.args.get("key_type", "lineno")
+    if key_type not in KEY_TYPES:
+        abort(400, jsonify(message="Invalid key_type."))  # 400 Bad Request
+
+    limit = request.args.get("limit", STATS_DEFAULT_LIMIT, type=int)
+    if not 0 < limit <= STATS_MAX_LIMIT:
+        abort(400, jsonify(message="Invalid limit."))  # 400 Bad Request
+
+    return key_type, limit
+
+
+def _snapshot(snapshot_id: int) -> tracemalloc.Snapshot:
+    with SNAPSHOTS_LOCK:
+        snapshot = SNAPSHOTS.get(snapshot_id)
+    if snapshot is None:
+        abort(404, jsonify(message="Snapshot not found."))  # 404 Not Found
+
+    return snapshot
+
+
+def _format_statistic(statistic) -> Dict:
+    result = {
+        "site": [
+            "{}:{}".format(frame.filename, frame.lineno)
+            for frame in statistic.traceback
+        ],
+        "size": statistic.size,
+        "count": statistic.count,
+    }
+    if isinstance(statistic, tracemalloc.StatisticDiff):
+        result["size_diff"] = statistic.size_diff
+        result["count_diff"] = statistic.count_diff
+
+    return result
+
+
+def _filtered(snapshot: tracemalloc.Snapshot) -> tracemalloc.Snapshot:
+    """
+    Exclude allocations made by the import system and by tracemalloc itself.
+    """
+    return snapshot.filter_traces([
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+        tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ])
+
+
+@profiling_blueprint.route("/", methods=["GET"])
+@as_json
+@secure
+def get_memory():
+    """
+    GET memory of this process.
+
+    Returns:
+    {
+        "pid": process id,
+        "rss": {"current": bytes, "peak": bytes},
+        "gc": {"counts", "thresholds", "generations"},
+        "tracemalloc": {"current", "peak", "overhead"} in bytes, or null if not tracing,
+        "snapshots": [ids of retained snapshots],
+        "in_flight": {endpoint: requests currently being served},
+        "sampler": {"running", "interval"},
+    }
+    """
+    with SNAPSHOTS_LOCK:
+        snapshot_ids = list(SNAPSHOTS)
+
+    return {
+        "pid": os.getpid(),
+        "rss": _rss(),
+        "gc": _gc_stats(),
+        "tracemalloc": _traced(),
+        "snapshots": snapshot_ids,
+        "in_flight": _in_flight(),
+        "sampler": {
+            "running": SAMPLER.running,
+            "interval": SAMPLER.interval,
+        },
+    }
+
+
+@profiling_blueprint.route("/tracemalloc/start", methods=["POST"])
+@as_json
+@secure
+def start_tracemalloc():
+    """
+    Start tracing allocations.
+
+    Tracing adds overhead to every allocation, so should be stopped when no longer needed.
+
+    Query params:
+        frames: Frames stored for each allocation, defaulting to 1.
+    """
+    frames = request.args.get("frames", 1, type=int)
+    if not 0 < frames <= 100:
+        abort(400, jsonify(message="Invalid frames."))  # 400 Bad Request
+
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+    tracemalloc.start(frames)
+
+    return {"tracemalloc": _traced()}
+
+
+@profiling_blueprint.route("/tracemalloc/stop", methods=["POST"])
+@as_json
+@secure
+def stop_tracemalloc():
+    """
+    Stop tracing allocations, discarding any snapshots.
+    """
+    tracemalloc.stop()
+    with SNAPSHOTS_LOCK:
+        SNAPSHOTS.clear()
+
+    return {"tracemalloc": None}
+
+
+@profiling_blueprint.route("/snapshots", methods=["POST"])
+@as_json
+@secure
+def take_snapshot():
+    """
+    Take a snapshot of traced allocations.
+
+    Query params:
+        key_type: Grouping of allocation sites, one of "filename", "lineno", or "traceback".
+        limit: Maximum number of allocation sites.
+
+    Returns:
+    {
+        "snapshot": id of the snapshot,
+        "statistics": [{"site", "size", "count"}, ...] largest first,
+    }
+    """
+    key_type, limit = _statistics_args()
+
+    if not tracemalloc.is_tracing():
+        abort(409, jsonify(message="Tracemalloc is not tracing."))  # 409 Conflict
+
+    snapshot = _filtered(tracemalloc.take_snapshot())
+    with SNAPSHOTS_LOCK:
+        snapshot_id = next(SNAPSHOT_IDS)
+        SNAPSHOTS[snapshot_id] = snapshot
+        while len(SNAPSHOTS) > MAX_SNAPSHOTS:
+            SNAPSHOTS.popitem(last=False)
+
+    return {
+        "snapshot": snapshot_id,
+        "statistics": [_format_statistic(statistic) for statistic in snapshot.statistics(key_type)[:limit]],
+    }
+
+
+@profiling_blueprint.route("/snapshots/<int:snapshot_id>", methods=["GET"])
+@as_json
+@secure
+def get_snapshot(snapshot_id):
+    """
+    GET the top allocation sites of a snapshot.
+
+    Query params:
+        key_type: Grouping of allocation sites, one of "filename", "lineno", or "traceback".
+        limit: Maximum number of allocation sites.
+    """
+    key_type, limit = _statistics_args()
+    snapshot = _snapshot(snapshot_id)
+
+    return {
+        "snapshot": snapshot_id,
+        "statistics": [_format_statistic(statistic) for statistic in snapshot.statistics(key_type)[:limit]],
+    }
+
+
+@profiling_blueprint.route("/snapshots/<int:snapshot_id>/diff/<int:base_snapshot_id>", methods=["GET"])
+@as_json
+@secure
+def diff_snapshots(snapshot_id, base_snapshot_id):
+    """
+    GET the allocation sites that changed most between a base snapshot and a later snapshot.
+
+    Query params:
+        key_type: Grouping of allocation sites, one of "filename", "lineno", or "traceback".
+        limit: Maximum number of allocation sites.
+
+    Returns:
+    {
+        "snapshot": id of the snapshot,
+        "base_snapshot": id of the base snapshot,
+        "statistics": [{"site", "size", "count", "size_diff", "count_diff"}, ...] largest change first,
+    }
+    """
+    key_type, limit = _statistics_args()
+    snapshot = _snapshot(snapshot_id)
+    base_snapshot = _snapshot(base_snapshot_id)
+
+    return {
+        "snapshot": snapshot_id,
+        "base_snapshot": base_snapshot_id,
+        "statistics": [
+            _format_statistic(statistic)
+            for statistic in snapshot.compare_to(base_snapshot, key_type)[:limit]
+        ],
+    }
+
+
+@profiling_blueprint.route("/sampler/start", methods=["POST"])
+@as_json
+@secure
+def start_sampler():
+    """
+    Start sampling memory, replacing any previous samples.
+
+    Query params:
+        interval: Seconds between samples.
+    """
+    interval = request.args.get("interval", SAMPLER_DEFAULT_INTERVAL, type=float)
+    if not interval >= 1:
+        abort(400, jsonify(message="Invalid interval."))  # 400 Bad Request
+
+    SAMPLER.samples.clear()
+    SAMPLER.start(interval=interval)
+
+    return {"sampler": {"running": SAMPLER.running, "interval": SAMPLER.interval}}
+
+
+@profiling_blueprint.route("/sampler/stop", methods=["POST"])
+@as_json
+@secure
+def stop_sampler():
+    """
+    Stop sampling memory, retaining samples.
+    """
+    SAMPLER.stop()
+
+    return {"sampler": {"running": SAMPLER.running, "interval": SAMPLER.interval}}
+
+
+@profiling_blueprint.route("/sampler/samples", methods=["GET"])
+@as_json
+@secure
+def get_samples():
+    """
+    GET memory samples, oldest first.
+
+    Returns:
+    {
+        "samples": [{"time", "rss", "traced", "gc_counts", "in_flight"}, ...],
+    }
+    """
+    samples: List[Dict] = list(SAMPLER.samples)
+
+    return {"samples": samples}
+
+
+def _thread_state(native_id: int) -> str:
+    """
+    Obtain whether a thread is on CPU, from its scheduler state in /proc.
+
+    A thread waiting on the database or on a lock is not on CPU, so is distinguished in the collapsed stacks.
+    """
+    try:
+        with open("/proc/self/task/{}/stat".format(native_id)) as stat_file:
+            # The state follows the parenthesized command, which may itself contain spaces.
+            state = stat_file.read().rsplit(")", 1)[1].split()[0]
+    except (OSError, IndexError):
+        return "unknown"
+
+    return "cpu" if state == "R" else "wait"
+
+
+def _collapsed_stack(frame) -> str:
+    """
+    Format a stack as a line of a collapsed stack, outermost frame first.
+    """
+    frames = []
+    while frame is not None:
+        code = frame.f_code
+        frames.append("{}:{}".format(os.path.basename(code.co_filename), code.co_name).replace(";", ":"))
+        frame = frame.f_back
+
+    return ";".join(reversed(frames))
+
+
+class StackSampler:
+    """
+    Background thread sampling stacks of threads serving requests.
+
+    Counts are kept as collapsed stacks, the input format of flamegraph tools.
+    Each stack is rooted at whether its thread was on CPU, so the CPU budget can be separated from waiting.
+    Threads not serving a request are idle in the server, so are not sampled.
+    """
+
+    def __init__(self):
+        self.stacks: Counter = Counter()
+        self.samples = 0
+        self.interval: Optional[float] = None
+
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, *, interval: float):
+        self.stop()
+
+        with self._lock:
+            self.stacks.clear()
+            self.samples = 0
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack_sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def collapsed(self) -> str:
+        with self._lock:
+            return "".join(
+                "{} {}\n".format(stack, count)
+                for (stack, count) in sorted(self.stacks.items())
+            )
+
+    def _run(self):
+        while not self._stop.is_set():
+            with IN_FLIGHT_LOCK:
+                request_threads = dict(REQUEST_THREADS)
+
+            frames = sys._current_frames()
+            sampled = Counter()
+            for (ident, native_id) in request_threads.items():
+                frame = frames.get(ident)
+                if frame is not None:
+                    sampled["{};{}".format(_thread_state(native_id), _collapsed_stack(frame))] += 1
+            del frames
+
+            with self._lock:
+                self.stacks.update(sampled)
+                self.samples += 1
+
+            self._stop.wait(self.interval)
+
+
+STACK_SAMPLER = StackSampler()
+
+
+@cpu_profiling_blueprint.route("/", methods=["GET"])
+@as_json
+@secure
+def get_cpu():
+    """
+    GET CPU of this process.
+
+    Returns:
+    {
+        "pid": process id,
+        "cpu_seconds": {"user", "system"} consumed by the process,
+        "sampler": {"running", "interval", "samples"},
+        "profiles": [ids of retained request profiles],
+    }
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    with PROFILES_LOCK:
+        profile_ids = list(PROFILES)
+
+    return {
+        "pid": os.getpid(),
+        "cpu_seconds": {
+            "user": usage.ru_utime,
+            "system": usage.ru_stime,
+        },
+        "sampler": {
+            "running": STACK_SAMPLER.running,
+            "interval": STACK_SAMPLER.interval,
+            "samples": STACK_SAMPLER.samples,
+        },
+        "profiles": profile_ids,
+    }
+
+
+@cpu_profiling_blueprint.route("/sampler/start", methods=["POST"])
+@as_json
+@secure
+def start_stack_sampler():
+    """
+    Start sampling stacks, replacing any previous stacks.
+
+    Query params:
+        interval: Seconds between samples.
+    """
+    interval = request.args.get("interval", STACK_SAMPLER_DEFAULT_INTERVAL, type=float)
+    if not interval >= STACK_SAMPLER_MIN_INTERVAL:
+        abort(400, jsonify(message="Invalid interval."))  # 400 Bad Request
+
+    STACK_SAMPLER.start(interval=interval)
+
+    return {"sampler": {"running": STACK_SAMPLER.running, "interval": STACK_SAMPLER.interval}}
+
+
+@cpu_profiling_blueprint.route("/sampler/stop", methods=["POST"])
+@as_json
+@secure
+def stop_stack_sampler():
+    """
+    Stop sampling stacks, retaining stacks.
+    """
+    STACK_SAMPLER.stop()
+
+    return {"sampler": {"running": STACK_SAMPLER.running, "interval": STACK_SAMPLER.interval}}
+
+
+@cpu_profiling_blueprint.route("/sampler/stacks", methods=["GET"])
+@secure
+def get_stacks():
+    """
+    GET sampled stacks, as text of collapsed stacks.
+
+    Each line is a semicolon-separated stack, outermost frame first, then a count of samples.
+    The outermost frame is "cpu" if the thread was on CPU, "wait" if it was not, or "unknown".
+    """
+    return Response(STACK_SAMPLER.collapsed(), mimetype="text/plain")
+
+
+@cpu_profiling_blueprint.route("/profiles/<int:profile_id>", methods=["GET"])
+@secure
+def get_profile(profile_id):
+    """
+    GET a request profile, as text of the functions with the most cumulative time.
+    """
+    with PROFILES_LOCK:
+        profile = PROFILES.get(profile_id)
+    if profile is None:
+        abort(404, jsonify(message="Profile not found."))  # 404 Not Found
+
+    return Response(profile, mimetype="text/plain")
+
+
+class ProfilingMiddleware:
+    """
+    WSGI middleware profiling requests that opt in, using cProfile.
+
+    A request opts in with an X-Profile header of "Bearer <secret_key>".
+    The profile includes producing the response body, so wraps any other middleware.
+    It is retained for the profiles endpoint, identified by an X-Profile-Id header of the response, and logged.
+    A request without the header is passed through, so is unaffected.
+    """
+
+    def __init__(self, app: Callable, *, secret_key: str):
+        self.app = app
+        self._expected = "Bearer {}".format(secret_key).encode("utf-8")
+
+    def _opted_in(self, environ) -> bool:
+        header = environ.get("HTTP_{}".format(PROFILE_HEADER.upper().replace("-", "_")))
+        if header is None:
+            return False
+
+        return hmac.compare_digest(header.encode("utf-8"), self._expected)
+
+    def __call__(self, environ, start_response):
+        if not self._opted_in(environ):
+            return self.app(environ, start_response)
+
+        return self._profile(environ=environ, start_response=start_response)
+
+    def _profile(self, *, environ, start_response):
+        profile_id = next(PROFILE_IDS)
+
+        def profile_start_response(status, response_headers, exc_info=None):
+            return start_response(status, response_headers + [(PROFILE_ID_HEADER, str(profile_id))], exc_info)
+
+        # A cProfile profiler only profiles the thread that enabled it.
+        profiler = cProfile.Profile()
+        app_iter = None
+        try:
+            profiler.enable()
+            app_iter = self.app(environ, profile_start_response)
+            profiler.disable()
+
+            for chunk in app_iter:
+                profiler.disable()
+                yield chunk
+                profiler.enable()
+        finally:
+            if app_iter is not None and hasattr(app_iter, "close"):
+                app_iter.close()
+            profiler.disable()
+
+            self._retain(profile_id=profile_id, profiler=profiler, environ=environ)
+
+    def _retain(self, *, profile_id: int, profiler: cProfile.Profile, environ):
+        output = io.StringIO()
+        output.write("{} {}\n".format(environ["REQUEST_METHOD"], environ.get("PATH_INFO", "")))
+        pstats.Stats(profiler, stream=output).sort_stats("cumulative").print_stats(PROFILE_LIMIT)
+        profile = output.getvalue()
+
+        with PROFILES_LOCK:
+            PROFILES[profile_id] = profile
+            while len(PROFILES) > MAX_PROFILES:
+                PROFILES.popitem(last=False)
+
+        logging.info("Profile {} of {}".format(profile_id, profile))
@@ -0,0 +1,364 @@
+"""
+Replay a capture of request traces against the app, reporting latency of each route.
+
+Traces are captured by CaptureMiddleware. The app must be configured against a local CouchDB stand-in,
+which is seeded with the users referenced by the capture before replay begins.
+
+Run from server_flask, typically using `invoke dev.flask.replay`:
+
+    FLASK_ENV=development FLASK_CONFIG_PATH=<config> python replay.py <capture> [<capture> ...]
+"""
+
+import argparse
+import concurrent.futures
+import hashlib
+import json
+from pathlib import Path
+import requests
+import secrets
+import statistics
+import threading
+import time
+from typing import Any, Dict, List, Optional, Set
+from urllib.parse import urljoin
+
+import migraine_shared.database
+import migraine_shared.password
+
+from app import create_app
+import capture
+from config.dev import DevelopmentConfig
+
+# Documents in each _bulk_docs request when seeding users.
+SEED_BATCH_SIZE = 1000
+
+# Concurrent requests when seeding user databases.
+SEED_WORKERS = 8
+
+# Seconds to wait for the user directory to include seeded users.
+DIRECTORY_TIMEOUT = 60
+
+
+def load_traces(*, capture_paths: List[Path]) -> List[Dict]:
+    """
+    Load traces from capture files, including rotated files, in the order they were captured.
+    """
+    traces = []
+    for capture_path in capture_paths:
+        with open(capture_path) as capture_file:
+            traces.extend(json.loads(line) for line in capture_file if line.strip())
+
+    return sorted(traces, key=lambda trace: trace["time"])
+
+
+def synthesize(value: Any) -> Any:
+    """
+    Obtain a body with the shape of a captured body, replacing each redacted string with a random string.
+    """
+    if isinstance(value, dict):
+        return {key: synthesize(item) for (key, item) in value.items()}
+    if isinstance(value, list):
+        return [synthesize(item) for item in value]
+    if isinstance(value, str):
+        match = capture.REDACTED_PATTERN.match(value)
+        if match:
+            return secrets.token_urlsafe(int(match.group(1)))[:int(match.group(1))]
+
+    return value
+
+
+def _requests(*, traces: List[Dict]) -> List[Dict]:
+    """
+    Obtain the requests of traces, including the sub-requests of each batch.
+
+    The status of a sub-request is not captured, so is None.
+    """
+    result = []
+    for trace in traces:
+        result.append(trace)
+        if trace["route"] == "/_batch" and isinstance(trace.get("body"), dict):
+            for sub_request in trace["body"].get("requests", []):
+                if isinstance(sub_request, dict) and isinstance(sub_request.get("path"), str):
+                    result.append({
+                        "method": sub_request.get("method"),
+                        "path": sub_request["path"],
+                        "route": capture.route_for_path(sub_request["path"]),
+                        "body": sub_request.get("body"),
+                        "status": None,
+                    })
+
+    return result
+
+
+def _created_users(*, traces: List[Dict]) -> Set[str]:
+    return {
+        request["body"]["user_name"]
+        for request in _requests(traces=traces)
+        if request["method"] == "POST" and request["route"] == "/users/" and isinstance(request.get("body"), dict)
+        and "user_name" in request["body"] and request.get("status") in [200, None]
+    }
+
+
+def _referenced_users(*, traces: List[Dict]) -> Set[str]:
+    result = set()
+    for request in _requests(traces=traces):
+        match = capture.USER_PATH_PATTERN.match(request["path"])
+        if match and request.get("status", 404) != 404:
+            result.add(match.group(2))
+        if request["route"] == "/users/_lookup" and isinstance(request.get("body"), dict):
+            result.update(request["body"].get("user_names", []))
+
+    return result
+
+
+def seed(
+    *,
+    couchdb_session_admin: requests.Session,
+    couchdb_routing,
+    users: Set[str],
+    population: int,
+    password_iterations: int,
+):
+    """
+    Create the users referenced by a capture, and additional users with no database for a realistic population.
+    """
+    for baseurl in couchdb_routing.baseurls:
+        response = couchdb_session_admin.put(urljoin(baseurl, "_users"))
+        assert response.status_code in [201, 202, 412]  # Created, Accepted, Precondition Failed if it exists
+
+    # A single derived password for every user, so seeding does not derive a key for each.
+    password_fields = migraine_shared.password.derive_password_fields(
+        password=secrets.token_urlsafe(),
+        iterations=password_iterations,
+    )
+
+    population_users = [
+        "p{}".format(hashlib.sha256("population_{}".format(index).encode("utf-8")).hexdigest()[:20])
+        for index in range(population)
+    ]
+    all_users = sorted(users) + population_users
+
+    for batch_start in range(0, len(all_users), SEED_BATCH_SIZE):
+        batch_users = all_users[batch_start:batch_start + SEED_BATCH_SIZE]
+        for (baseurl, baseurl_users) in _users_by_baseurl(couchdb_routing=couchdb_routing, users=batch_users).items():
+            response = couchdb_session_admin.post(
+                urljoin(baseurl, "_users/_bulk_docs"),
+                json={
+                    "docs": [
+                        dict(
+                            {
+                                "_id": "org.couchdb.user:{}".format(user),
+                                "type": "user",
+                                "name": user,
+                                "roles": [],
+                            },
+                            **password_fields,
+                        )
+                        for user in baseurl_users
+                    ],
+                },
+            )
+            assert response.ok
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=SEED_WORKERS) as executor:
+        responses = list(executor.map(
+            lambda user: migraine_shared.database.create_database(
+                couchdb_session_admin=couchdb_session_admin,
+                couchdb_baseurl=couchdb_routing,
+                account=user,
+            ),
+            sorted(users),
+        ))
+    # A database may remain from a previous replay.
+    assert all(response.ok or response.status_code == 412 for response in responses)
+
+
+def _users_by_baseurl(*, couchdb_routing, users: List[str]) -> Dict[str, List[str]]:
+    result: Dict[str, List[str]] = {}
+    for user in users:
+        baseurl = migraine_shared.database.baseurl_for_user(couchdb_baseurl=couchdb_routing, user=user)
+        result.setdefault(baseurl, []).append(user)
+
+    return result
+
+
+def _remote_addr(client: str) -> str:
+    """
+    Obtain a private address for a client pseudonym, so admission control sees distinct clients.
+    """
+    digest = bytes.fromhex(client[1:7])
+    return "10.{}.{}.{}".format(digest[0], digest[1], digest[2])
+
+
+class Replayer:
+    """
+    Replays traces against the test client of an app, concurrently and with the timing of the capture.
+
+    A conditional trace is replayed using the ETag of the most recent replayed response for its path.
+    """
+
+    def __init__(self, *, app, speed: float, concurrency: int):
+        self.app = app
+        self.speed = speed
+        self.concurrency = concurrency
+
+        self.results: List[Dict] = []
+
+        self._etags: Dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def _replay(self, trace: Dict):
+        headers = {"Authorization": "Bearer {}".format(self.app.config["SECRET_KEY"])}
+        if trace.get("conditional"):
+            with self._lock:
+                etag = self._etags.get(trace["path"])
+            if etag:
+                headers["If-None-Match"] = etag
+
+        body = trace.get("body")
+        client = self.app.test_client()
+
+        start = time.perf_counter()
+        response = client.open(
+            trace["path"],
+            method=trace["method"],
+            query_string=trace.get("query", {}),
+            headers=headers,
+            json=synthesize(body) if body is not None else None,
+            environ_base={"REMOTE_ADDR": _remote_addr(trace["client"])},
+        )
+        duration = time.perf_counter() - start
+
+        if "ETag" in response.headers:
+            with self._lock:
+                self._etags[trace["path"]] = response.headers["ETag"]
+
+        with self._lock:
+            self.results.append({
+                "method": trace["method"],
+                "route": trace["route"],
+                "captured_status": trace.get("status"),
+                "captured_duration": trace.get("duration"),
+                "status": response.status_code,
+                "duration": duration,
+            })
+
+    def run(self, *, traces: List[Dict]):
+        if not traces:
+            return
+
+        first_time = traces[0]["time"]
+        start = time.perf_counter()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = []
+            for trace in traces:
+                if self.speed > 0:
+                    delay = start + (trace["time"] - first_time) / self.speed - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                futures.append(executor.submit(self._replay, trace))
+
+            for future in futures:
+                future.result()
+
+
+def _percentile(values: List[float], percentile: int) -> Optional[float]:
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+
+    return statistics.quantiles(values, n=100, method="inclusive")[percentile - 1]
+
+
+def report(*, results: List[Dict]) -> List[Dict]:
+    """
+    Summarize results for each method and route, comparing replayed and captured latency.
+    """
+    groups: Dict[str, List[Dict]] = {}
+    for result in results:
+        groups.setdefault("{} {}".format(result["method"], result["route"]), []).append(result)
+
+    summary = []
+    for (name, group) in sorted(groups.items()):
+        durations = [result["duration"] for result in group]
+        captured_durations = [result["captured_duration"] for result in group if result["captured_duration"] is not None]
+        summary.append({
+            "route": name,
+            "count": len(group),
+            "status_mismatches": sum(1 for result in group if result["status"] != result["captured_status"]),
+            "p50": _percentile(durations, 50),
+            "p95": _percentile(durations, 95),
+            "p99": _percentile(durations, 99),
+            "captured_p50": _percentile(captured_durations, 50),
+            "captured_p95": _percentile(captured_durations, 95),
+            "captured_p99": _percentile(captured_durations, 99),
+        })
+
+    return summary
+
+
+def _format_ms(seconds: Optional[float]) -> str:
+    return "-" if seconds is None else "{:.1f}".format(seconds * 1000)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("captures", nargs="+", type=Path, help="Capture files, including any rotated files.")
+    parser.add_argument("--speed", type=float, default=1.0, help="Speedup over captured timing, or 0 to replay without delay.")
+    parser.add_argument("--concurrency", type=int, default=16, help="Maximum concurrent requests.")
+    parser.add_argument("--population", type=int, default=0, help="Additional users seeded, for a realistic directory size.")
+    parser.add_argument("--report", type=Path, help="Path to which the report is written as JSON.")
+    args = parser.parse_args()
+
+    traces = load_traces(capture_paths=args.captures)
+
+    # Seed using the configuration of the app, then create the app so its user directory begins from the seed.
+    config = DevelopmentConfig()
+
+    couchdb_session_admin = requests.Session()
+    couchdb_session_admin.auth = (config.DATABASE_ADMIN_USER, config.DATABASE_ADMIN_PASSWORD)
+    seed(
+        couchdb_session_admin=couchdb_session_admin,
+        couchdb_routing=config.DATABASE_ROUTING,
+        users=_referenced_users(traces=traces) - _created_users(traces=traces),
+        population=args.population,
+        password_iterations=config.PASSWORD_HASH_ITERATIONS or migraine_shared.password.PBKDF2_DEFAULT_ITERATIONS,
+    )
+
+    app = create_app()
+
+    deadline = time.monotonic() + DIRECTORY_TIMEOUT
+    while not all(directory.caught_up for directory in app.extensions["user_directories"].values()):
+        assert time.monotonic() < deadline, "User directory did not catch up"
+        time.sleep(0.1)
+
+    replayer = Replayer(app=app, speed=args.speed, concurrency=args.concurrency)
+    replayer.run(traces=traces)
+    summary = report(results=replayer.results)
+
+    print("{:<32} {:>6} {:>9} {:>9} {:>9} {:>9} {:>12} {:>12} {:>12}".format(
+        "route", "count", "mismatch", "p50 ms", "p95 ms", "p99 ms", "captured p50", "captured p95", "captured p99",
+    ))
+    for row in summary:
+        print("{:<32} {:>6} {:>9} {:>9} {:>9} {:>9} {:>12} {:>12} {:>12}".format(
+            row["route"],
+            row["count"],
+            row["status_mismatches"],
+            _format_ms(row["p50"]),
+            _format_ms(row["p95"]),
+            _format_ms(row["p99"]),
+            _format_ms(row["captured_p50"]),
+            _format_ms(row["captured_p95"]),
+            _format_ms(row["captured_p99"]),
+        ))
+
+    if args.report:
+        with open(args.report, "w") as report_file:
+            json.dump(summary, report_file, indent=2, sort_keys=True)
+
+
+if __name__ == "__main__":
+    main()
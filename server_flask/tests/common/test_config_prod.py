@@ -13,6 +13,7 @@ test_config = migraine_shared.testing.create_test_config(
 
 couchdb_config = migraine_shared.testing.create_couchdb_config(test_config=test_config)
 couchdb_session_admin = migraine_shared.testing.create_couchdb_session_admin(couchdb_config=couchdb_config)
+couchdb_round_trips = migraine_shared.testing.create_couchdb_round_trips(couchdb_session_admin=couchdb_session_admin)
 test_couchdb_session_admin = migraine_shared.testing.create_test_couchdb_session_admin(couchdb_config=couchdb_config)
 
 flask_config = migraine_shared.testing.create_flask_config(test_config=test_config)
@@ -0,0 +1,150 @@
+"""
+Tests of admission control, independent of any database.
+"""
+
+from flask import Flask
+import pytest
+import threading
+import time
+from werkzeug.middleware.proxy_fix import ProxyFix
+
+import admission
+from admission import admission_controlled, AdmissionController, AdmissionRejected, ConcurrencyLimiter, RateLimiter
+
+
+@pytest.fixture
+def now(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(admission, "timer", lambda: now[0])
+
+    return now
+
+
+def test_rate_limiter_burst_and_refill(now):
+    rate_limiter = RateLimiter(rate=2, burst=3)
+
+    for _ in range(3):
+        rate_limiter.admit(client="10.0.0.1")
+    with pytest.raises(AdmissionRejected) as rejected:
+        rate_limiter.admit(client="10.0.0.1")
+    assert rejected.value.retry_after == pytest.approx(0.5)
+
+    # Each client has its own bucket.
+    rate_limiter.admit(client="10.0.0.2")
+
+    # One token refills in 1 / rate seconds.
+    now[0] += 0.5
+    rate_limiter.admit(client="10.0.0.1")
+    with pytest.raises(AdmissionRejected):
+        rate_limiter.admit(client="10.0.0.1")
+
+    # A bucket does not refill past its burst.
+    now[0] += 60
+    for _ in range(3):
+        rate_limiter.admit(client="10.0.0.1")
+    with pytest.raises(AdmissionRejected):
+        rate_limiter.admit(client="10.0.0.1")
+
+
+def test_rate_limiter_forgets_least_recent(now, monkeypatch):
+    monkeypatch.setattr(admission, "RATE_LIMITER_MAX_CLIENTS", 2)
+    rate_limiter = RateLimiter(rate=1, burst=1)
+
+    rate_limiter.admit(client="10.0.0.1")
+    rate_limiter.admit(client="10.0.0.2")
+    rate_limiter.admit(client="10.0.0.3")
+
+    # The least recently seen client was forgotten, so has a full bucket.
+    rate_limiter.admit(client="10.0.0.1")
+    with pytest.raises(AdmissionRejected):
+        rate_limiter.admit(client="10.0.0.3")
+
+
+def test_concurrency_limiter():
+    concurrency_limiter = ConcurrencyLimiter(max_concurrent=1, max_waiting=1, wait_timeout=5)
+
+    waiting_rejected = []
+
+    def wait():
+        try:
+            with concurrency_limiter.admit():
+                pass
+        except AdmissionRejected:
+            waiting_rejected.append(True)
+
+    with concurrency_limiter.admit():
+        waiting = threading.Thread(target=wait)
+        waiting.start()
+        while concurrency_limiter._waiting == 0:
+            time.sleep(0.001)
+
+        # The queue is full, so a request is rejected without waiting.
+        with pytest.raises(AdmissionRejected):
+            with concurrency_limiter.admit():
+                pass
+
+    # The waiting request runs once the running request completes.
+    waiting.join()
+    assert waiting_rejected == []
+
+
+def test_concurrency_limiter_wait_timeout():
+    concurrency_limiter = ConcurrencyLimiter(max_concurrent=1, max_waiting=1, wait_timeout=0.01)
+
+    with concurrency_limiter.admit():
+        with pytest.raises(AdmissionRejected):
+            with concurrency_limiter.admit():
+                pass
+
+    with concurrency_limiter.admit():
+        pass
+
+
+def _app(*, trusted_proxy_hops: int) -> Flask:
+    app = Flask(__name__)
+    app.extensions["admission"] = AdmissionController(
+        max_concurrent=4,
+        max_waiting=4,
+        wait_timeout=1,
+        rate=0.001,
+        burst=2,
+    )
+
+    @app.route("/", methods=["POST"])
+    @admission_controlled("admission")
+    def create():
+        return "created"
+
+    if trusted_proxy_hops:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=trusted_proxy_hops)
+
+    return app
+
+
+def test_admission_controlled_429(now):
+    client = _app(trusted_proxy_hops=0).test_client()
+
+    assert client.post("/").status_code == 200
+    assert client.post("/").status_code == 200
+
+    response = client.post("/")
+    assert response.status_code == 429
+    assert response.get_json() == {"message": "Too many requests."}
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_admission_controlled_spoofed_forwarded_for(now):
+    # Ingress appends the address it received from, which is the actual client.
+    client = _app(trusted_proxy_hops=1).test_client()
+
+    for index in range(2):
+        response = client.post("/", headers={"X-Forwarded-For": "192.0.2.{}, 203.0.113.7".format(index)})
+        assert response.status_code == 200
+
+    # Varying the address provided by the client does not obtain a new bucket.
+    response = client.post("/", headers={"X-Forwarded-For": "192.0.2.99, 203.0.113.7"})
+    assert response.status_code == 429
+
+    # A different actual client has its own bucket.
+    response = client.post("/", headers={"X-Forwarded-For": "192.0.2.1, 203.0.113.8"})
+    assert response.status_code == 200
@@ -0,0 +1,85 @@
+"""
+Tests of batch deadlines, independent of any database.
+"""
+
+from flask import Blueprint, Flask, g
+from flask_json import as_json, FlaskJSON
+import pytest
+import time
+
+import migraine_shared.session
+
+from batch import batch_blueprint
+
+SECRET_KEY = "secret"
+REQUEST_DEADLINE = 0.5
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    FlaskJSON(app)
+    app.config["SECRET_KEY"] = SECRET_KEY
+
+    # As in create_app, every request has a deadline.
+    @app.before_request
+    def enter_deadline():
+        g.deadline = migraine_shared.session.deadline(REQUEST_DEADLINE)
+        g.deadline.__enter__()
+
+    @app.teardown_request
+    def exit_deadline(exception):
+        if "deadline" in g:
+            g.deadline.__exit__(None, None, None)
+
+    # Sub-requests report the remaining deadline they observe, then take the requested time.
+    sleep_blueprint = Blueprint("sleep_blueprint", __name__)
+
+    @sleep_blueprint.route("/sleep/<float:seconds>", methods=["GET", "POST"])
+    @as_json
+    def sleep(seconds):
+        remaining = migraine_shared.session.remaining()
+        time.sleep(seconds)
+        return {"remaining": remaining}
+
+    app.register_blueprint(batch_blueprint)
+    app.register_blueprint(sleep_blueprint, url_prefix="/users")
+
+    return app.test_client()
+
+
+def _batch(client, sub_requests):
+    response = client.post(
+        "/_batch",
+        json={"requests": sub_requests},
+        headers={"Authorization": "Bearer {}".format(SECRET_KEY)},
+    )
+    assert response.status_code == 200
+
+    return response.get_json()["responses"]
+
+
+def test_batch_deadline_propagated(client):
+    responses = _batch(client, [
+        {"method": "POST", "path": "/users/sleep/0.2"},
+        {"method": "GET", "path": "/users/sleep/0.0"},
+    ])
+
+    assert [response["status"] for response in responses] == [200, 200]
+    assert responses[0]["body"]["remaining"] <= REQUEST_DEADLINE
+
+    # The second sub-request starts after the first, within the deadline of the batch rather than a deadline of its own.
+    assert responses[1]["body"]["remaining"] <= REQUEST_DEADLINE - 0.2
+
+
+def test_batch_deadline_exceeded(client):
+    responses = _batch(client, [
+        {"method": "POST", "path": "/users/sleep/0.3"},
+        {"method": "POST", "path": "/users/sleep/0.3"},
+        {"method": "GET", "path": "/users/sleep/0.0"},
+        {"method": "POST", "path": "/users/sleep/0.0"},
+    ])
+
+    # Sub-requests remaining after the deadline of the batch fail, rather than each obtaining a deadline of its own.
+    assert [response["status"] for response in responses] == [200, 200, 504, 504]
+    assert responses[2]["body"] == {"message": "Batch deadline exceeded."}
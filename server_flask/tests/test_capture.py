@@ -0,0 +1,92 @@
+"""
+Tests of traffic capture and the users it references on replay, independent of any database.
+"""
+
+import json
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+import capture
+from capture import CaptureMiddleware
+import replay
+
+SECRET_KEY = "secret"
+USER_NAME = "capture_user"
+OTHER_USER_NAME = "capture_other_user"
+PASSWORD = "capture-password-c0ffee"
+BEARER = "capture-bearer-token"
+ETAG = '"capture-etag"'
+
+BATCH_BODY = {
+    "requests": [
+        {"method": "GET", "path": "/users/" + OTHER_USER_NAME, "headers": {"If-None-Match": ETAG}},
+        {"method": "POST", "path": "/users/", "body": {"user_name": USER_NAME, "user_password": PASSWORD}},
+        {"method": "DELETE", "path": "/users/" + USER_NAME},
+    ],
+}
+
+
+def _app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "application/json"), ("ETag", ETAG)])
+    return [b'{"status": 200}']
+
+
+def _capture(tmp_path, requests):
+    path = tmp_path / "capture.jsonl"
+    client = Client(CaptureMiddleware(_app, secret_key=SECRET_KEY, path=str(path), max_bytes=1000000, backup_count=1))
+    for (method, request_path, body) in requests:
+        client.open(
+            request_path,
+            method=method,
+            json=body,
+            headers={"Authorization": "Bearer " + BEARER, "If-None-Match": ETAG},
+            environ_base={"REMOTE_ADDR": "10.0.0.1"},
+        )
+
+    return path
+
+
+def test_capture_private(tmp_path):
+    path = _capture(tmp_path, [
+        ("POST", "/users/", {"user_name": USER_NAME, "user_password": PASSWORD}),
+        ("GET", "/users/" + USER_NAME, None),
+        ("POST", "/users/_lookup", {"user_names": [USER_NAME, OTHER_USER_NAME]}),
+        ("POST", "/_batch", BATCH_BODY),
+    ])
+
+    # Passwords, credentials, header values, addresses, and user names never reach the capture.
+    captured = path.read_text()
+    for private in [PASSWORD, BEARER, ETAG.strip('"'), "10.0.0.1", USER_NAME, OTHER_USER_NAME]:
+        assert private not in captured
+
+    traces = [json.loads(line) for line in captured.splitlines()]
+    assert [trace["route"] for trace in traces] == ["/users/", "/users/<user_name>", "/users/_lookup", "/_batch"]
+    assert traces[1]["conditional"]
+
+
+def test_capture_batch_shape(tmp_path):
+    path = _capture(tmp_path, [("POST", "/_batch", BATCH_BODY)])
+    (trace,) = [json.loads(line) for line in path.read_text().splitlines()]
+
+    sub_requests = trace["body"]["requests"]
+
+    # Methods and header names are retained, so replay sends the captured sub-requests.
+    assert [sub_request["method"] for sub_request in sub_requests] == ["GET", "POST", "DELETE"]
+    assert list(sub_requests[0]["headers"]) == ["If-None-Match"]
+    assert sub_requests[0]["headers"]["If-None-Match"] == capture.REDACTED_FORMAT.format(len(ETAG))
+    assert sub_requests[1]["body"]["user_password"] == capture.REDACTED_FORMAT.format(len(PASSWORD))
+
+    user_pseudonym = capture.pseudonym(key=SECRET_KEY.encode("utf-8"), value=USER_NAME)
+    other_pseudonym = capture.pseudonym(key=SECRET_KEY.encode("utf-8"), value=OTHER_USER_NAME)
+    assert sub_requests[1]["body"]["user_name"] == user_pseudonym
+    assert sub_requests[2]["path"] == "/users/" + user_pseudonym
+
+    # Users referenced by sub-requests are seeded, other than those the capture creates.
+    assert replay._referenced_users(traces=[trace]) == {user_pseudonym, other_pseudonym}
+    assert replay._created_users(traces=[trace]) == {user_pseudonym}
+
+
+def test_capture_unknown_method_redacted():
+    shape = capture.body_shape(key=b"key", value=[{"method": "GET"}, {"method": "SECRET"}])
+
+    assert shape == [{"method": "GET"}, {"method": capture.REDACTED_FORMAT.format(6)}]
@@ -0,0 +1,103 @@
+"""
+Tests of validators and the Flask JSON provider, independent of any database.
+"""
+
+from flask import Flask, request
+from flask_json import as_json, FlaskJSON
+import jsonschema.exceptions
+import pytest
+
+import codec
+from codec import CodecJSONProvider, register_validator, validation_error
+import users
+
+SCHEMA = {
+    "type": "object",
+    "properties": {
+        "user_name": {"type": "string", "maxLength": 8},
+        "password": {"type": "string"},
+    },
+    "required": ["user_name", "password"],
+}
+
+
+@pytest.fixture(autouse=True)
+def validators(monkeypatch):
+    # Validators registered by a test are not retained in the registry.
+    monkeypatch.setattr(codec, "VALIDATORS", dict(codec.VALIDATORS))
+
+
+def test_register_validator():
+    validator = register_validator(name="test", schema=SCHEMA)
+
+    assert codec.VALIDATORS["test"] is validator
+    assert validator.schema == SCHEMA
+
+    # A name is registered only once.
+    with pytest.raises(AssertionError):
+        register_validator(name="test", schema=SCHEMA)
+
+
+def test_register_validator_invalid_schema():
+    with pytest.raises(jsonschema.exceptions.SchemaError):
+        register_validator(name="invalid", schema={"type": "object", "properties": {"user_name": {"type": "text"}}})
+
+    assert "invalid" not in codec.VALIDATORS
+
+
+def test_validation_error():
+    validator = register_validator(name="test", schema=SCHEMA)
+
+    assert validation_error(validator=validator, instance={"user_name": "account", "password": "secret"}) is None
+
+    error = validation_error(validator=validator, instance={"user_name": "account"})
+    assert error.validator == "required"
+
+    error = validation_error(validator=validator, instance={"user_name": "account_too_long", "password": "secret"})
+    assert error.validator == "maxLength"
+    assert list(error.path) == ["user_name"]
+
+
+@pytest.fixture
+def app():
+    app = Flask(__name__)
+    FlaskJSON(app)
+    app.json_provider_class = CodecJSONProvider
+    app.json = CodecJSONProvider(app)
+    app.extensions["created"] = []
+
+    validator = register_validator(name="test", schema=SCHEMA)
+
+    @app.route("/", methods=["POST"])
+    @as_json
+    def create():
+        users._validate_request_json_schema(instance=request.json, validator=validator)
+        app.extensions["created"].append(request.json["user_name"])
+        return {"user_name": request.json["user_name"], "unicode": "café"}
+
+    return app
+
+
+def test_json_provider_round_trip(app):
+    response = app.test_client().post("/", json={"user_name": "café", "password": "secret"})
+
+    assert response.status_code == 200
+    assert response.get_json() == {"user_name": "café", "unicode": "café", "status": 200}
+    assert "café".encode("utf-8") in response.data
+    assert app.extensions["created"] == ["café"]
+
+
+@pytest.mark.parametrize(
+    "instance",
+    [
+        {"user_name": "account"},
+        {"user_name": "account_too_long", "password": "secret"},
+        {"user_name": 1, "password": "secret"},
+        ["account", "secret"],
+    ],
+)
+def test_schema_error_400(app, instance):
+    response = app.test_client().post("/", json=instance)
+
+    assert response.status_code == 400
+    assert app.extensions["created"] == []
@@ -0,0 +1,143 @@
+"""
+Tests of response compression, independent of any database.
+"""
+
+import gzip
+import pytest
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+import compression
+from compression import CompressionMiddleware
+
+MINIMUM_SIZE = 100
+BODY = b'{"users": [' + b", ".join(b'"user%d"' % index for index in range(100)) + b"]}"
+SMALL_BODY = b'{"ok": true}'
+
+
+def _client(app, *, minimum_size: int = MINIMUM_SIZE) -> Client:
+    return Client(CompressionMiddleware(app, minimum_size=minimum_size, gzip_level=6, brotli_quality=4))
+
+
+def _json_app(body: bytes, **kwargs):
+    return Response(body, mimetype="application/json", **kwargs)
+
+
+def test_gzip():
+    response = _client(_json_app(BODY, headers={"ETag": '"abc"'})).get("/", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.headers["ETag"] == 'W/"abc"'
+    assert "Content-Length" not in response.headers
+    assert gzip.decompress(response.get_data()) == BODY
+
+
+def test_brotli_installed():
+    # brotli is locked as a dependency of the server, so an environment synced from the lock offers br.
+    assert compression.brotli is not None, "brotli is not installed, run pipenv sync"
+
+
+def test_brotli():
+    brotli = compression.brotli
+
+    response = _client(_json_app(BODY)).get("/", headers={"Accept-Encoding": "gzip, br"})
+
+    assert response.headers["Content-Encoding"] == "br"
+    assert brotli.decompress(response.get_data()) == BODY
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, expected",
+    [
+        ("gzip", "gzip"),
+        ("gzip;q=1.0, br;q=0.5", "gzip"),
+        ("*", "gzip"),
+        ("identity", None),
+        ("gzip;q=0", None),
+        ("", None),
+    ],
+)
+def test_negotiate(monkeypatch, accept_encoding, expected):
+    # Without brotli, only gzip is supported.
+    monkeypatch.setattr(compression, "brotli", None)
+
+    response = _client(_json_app(BODY)).get("/", headers={"Accept-Encoding": accept_encoding})
+
+    assert response.headers.get("Content-Encoding") == expected
+    assert response.headers["Vary"] == "Accept-Encoding"
+    if expected is None:
+        assert response.get_data() == BODY
+
+
+def test_minimum_size():
+    response = _client(_json_app(SMALL_BODY)).get("/", headers={"Accept-Encoding": "gzip"})
+
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.get_data() == SMALL_BODY
+
+
+def test_not_compressible():
+    app = Response(BODY, mimetype="image/png")
+    response = _client(app).get("/", headers={"Accept-Encoding": "gzip"})
+
+    assert "Content-Encoding" not in response.headers
+    assert response.get_data() == BODY
+
+    response = _client(_json_app(b"", status=304)).get("/", headers={"Accept-Encoding": "gzip"})
+    assert "Content-Encoding" not in response.headers
+
+
+def test_vary_merged():
+    app = _json_app(BODY, headers={"Vary": "Origin"})
+    response = _client(app).get("/", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Vary"] == "Origin, Accept-Encoding"
+
+
+def test_head():
+    response = _client(_json_app(BODY)).head("/", headers={"Accept-Encoding": "gzip"})
+
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept-Encoding"
+
+
+def test_streamed():
+    chunks = [BODY[index:index + 10] for index in range(0, len(BODY), 10)]
+
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "application/json")])
+        return iter(chunks)
+
+    response = _client(app).get("/", headers={"Accept-Encoding": "gzip"})
+
+    assert response.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(response.get_data()) == BODY
+
+
+def test_lazy_start_response():
+    # A generator calls start_response only as it produces its first chunk.
+    def app(environ, start_response):
+        start_response("200 OK", [("Content-Type", "application/json")])
+        yield BODY
+
+    for minimum_size in [0, MINIMUM_SIZE]:
+        response = _client(app, minimum_size=minimum_size).get("/", headers={"Accept-Encoding": "gzip"})
+
+        assert response.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(response.get_data()) == BODY
+
+
+def test_write():
+    # The legacy write callable is passed through without encoding.
+    def app(environ, start_response):
+        write = start_response("200 OK", [("Content-Type", "application/json")])
+        write(BODY[:50])
+        return [BODY[50:]]
+
+    response = _client(app).get("/", headers={"Accept-Encoding": "gzip"})
+
+    assert "Content-Encoding" not in response.headers
+    assert response.headers["Vary"] == "Accept-Encoding"
+    assert response.get_data() == BODY
@@ -6,6 +6,7 @@ from urllib.parse import urljoin
 
 import migraine_shared.config
 import migraine_shared.database
+import migraine_shared.testing
 
 
 # Execute tests against both development and production.
@@ -24,12 +25,37 @@ assert flask_session_unauthenticated
 
 AccountTuple = collections.namedtuple("AccountTuple", ["user", "password"])
 
+# Header of a response reporting the CouchDB round trips Flask made in serving it.
+ROUND_TRIPS_HEADER = "X-CouchDB-Round-Trips"
+
+
+def _assert_round_trips(response: requests.Response, *, budget: int):
+    """
+    Assert Flask served a response within a budget of CouchDB round trips.
+    """
+    round_trips = int(response.headers[ROUND_TRIPS_HEADER])
+    assert round_trips <= budget, "{} {} made {} CouchDB round trips, budget is {}".format(
+        response.request.method,
+        response.request.path_url,
+        round_trips,
+        budget,
+    )
+
+
+# Accounts created in bulk before tests, for tests that require an existing account.
+account_pool = migraine_shared.testing.create_account_pool(
+    couchdb_config=couchdb_config,
+    couchdb_session_admin=couchdb_session_admin,
+    prefix="test_flask_user",
+    size=7,
+)
+
 
 @pytest.fixture()
 def sample_account(
     couchdb_config: migraine_shared.config.CouchDBConfig,  # To force different random value per configuration
 ) -> AccountTuple:
-    result = AccountTuple('test_flask_user_{}'.format(secrets.token_hex(nbytes=8)), secrets.token_urlsafe())
+    result = AccountTuple(migraine_shared.testing.unique_account_name(prefix="test_flask_user"), secrets.token_urlsafe())
     return result
 
 
@@ -42,37 +68,28 @@ def sample_account_delete(
     """
     Fixture to delete sample_account.
 
-    The account may have been created by sample_account_create or by a test.
+    The account may have been created by a test.
     """
 
     yield
 
     response = migraine_shared.database.delete_account(
         couchdb_session_admin=couchdb_session_admin,
-        couchdb_baseurl=couchdb_config.baseurl,
+        couchdb_baseurl=couchdb_config.routing,
         account=sample_account.user,
     )
     assert response.ok
 
 
 @pytest.fixture()
-def sample_account_create(
-    couchdb_config: migraine_shared.config.CouchDBConfig,
-    couchdb_session_admin: requests.Session,
-    sample_account: AccountTuple,
-    sample_account_delete,  # None, included for fixture functionality
-):
+def pooled_account(
+    account_pool: migraine_shared.testing.AccountPool,
+) -> migraine_shared.testing.PooledAccount:
     """
-    Fixture to create sample_account.  Uses sample_account_delete to also delete sample_account.
+    Fixture providing an existing account, acquired from account_pool.
     """
 
-    response = migraine_shared.database.create_account(
-        couchdb_session_admin=couchdb_session_admin,
-        couchdb_baseurl=couchdb_config.baseurl,
-        account=sample_account.user,
-        password=sample_account.password,
-    )
-    assert response.ok
+    return account_pool.acquire()
 
 
 def test_flask_create_user_account(
@@ -96,6 +113,8 @@ def test_flask_create_user_account(
         headers={"Authorization": "Bearer " + flask_config.secret_key},
     )
     assert response.ok
+    # Create the user document, the database, and its _security.
+    _assert_round_trips(response, budget=3)
 
     # Response json is a dictionary containing status, user_name, and database.
 
@@ -131,20 +150,17 @@ def test_flask_create_user_account_bad_key_failure(
 def test_flask_create_duplicate_user_account_failure(
     flask_config: migraine_shared.config.FlaskConfig,
     flask_session_unauthenticated: requests.Session,
-    sample_account: AccountTuple,
-    sample_account_create,
+    pooled_account: migraine_shared.testing.PooledAccount,
 ):
     """
     Test creation of a user account when the user already exists. Should return 409.
     """
 
-    assert sample_account_create is None
-
     response = flask_session_unauthenticated.post(
         urljoin(flask_config.baseurl, "users/"),
         json={
-            "user_name": sample_account.user,
-            "user_password": sample_account.password,
+            "user_name": pooled_account.user,
+            "user_password": pooled_account.password,
         },
         headers={"Authorization": "Bearer " + flask_config.secret_key},
     )
@@ -154,15 +170,12 @@ def test_flask_create_duplicate_user_account_failure(
 def test_flask_get_all_users(
     flask_config: migraine_shared.config.FlaskConfig,
     flask_session_unauthenticated: requests.Session,
-    sample_account: AccountTuple,
-    sample_account_create,  # None, included for fixture functionality
+    pooled_account: migraine_shared.testing.PooledAccount,
 ):
     """
     Test retrieval of all current users.
     """
 
-    assert sample_account_create is None
-
     response = flask_session_unauthenticated.get(
         urljoin(flask_config.baseurl, "users/"),
         headers={"Authorization": "Bearer " + flask_config.secret_key},
@@ -172,34 +185,33 @@ def test_flask_get_all_users(
     # Response json is a list of users, with no surrounding dictionary.
     # Ensure our sample is in that list.
 
-    assert sample_account.user in response.json()["users"]
+    assert pooled_account.user in response.json()["users"]
 
 
 def test_flask_get_user(
     flask_config: migraine_shared.config.FlaskConfig,
     flask_session_unauthenticated: requests.Session,
-    sample_account: AccountTuple,
-    sample_account_create,  # None, included for fixture functionality
+    pooled_account: migraine_shared.testing.PooledAccount,
 ):
     """
     Test retrieval of a user profile.
     """
 
-    assert sample_account_create is None
-
     response = flask_session_unauthenticated.get(
-        urljoin(flask_config.baseurl, "users/" + sample_account.user),
+        urljoin(flask_config.baseurl, "users/" + pooled_account.user),
         headers={"Authorization": "Bearer " + flask_config.secret_key},
     )
     assert response.ok
+    # HEAD the user document and the database.
+    _assert_round_trips(response, budget=2)
 
     # Response json is a dictionary containing status, user_name, and database.
 
     assert response.json() == {
         "status": 200,
-        "user_name": sample_account.user,
+        "user_name": pooled_account.user,
         "database": migraine_shared.database.database_for_user(
-            user=sample_account.user
+            user=pooled_account.user
         ),
     }
 
@@ -220,3 +232,288 @@ def test_flask_get_user_failure(
         headers={"Authorization": "Bearer " + flask_config.secret_key},
     )
     assert response.status_code == 404  # Not Found
+
+
+def test_flask_get_all_users_not_modified(
+    flask_config: migraine_shared.config.FlaskConfig,
+    flask_session_unauthenticated: requests.Session,
+    pooled_account: migraine_shared.testing.PooledAccount,
+):
+    """
+    Test retrieval of all current users using the ETag of a previous retrieval. Should return 304.
+    """
+
+    response = flask_session_unauthenticated.get(
+        urljoin(flask_config.baseurl, "users/"),
+        headers={"Authorization": "Bearer " + flask_config.secret_key},
+    )
+    assert response.ok
+    assert response.headers["ETag"]
+
+    response = flask_session_unauthenticated.get(
+        urljoin(flask_config.baseurl, "users/"),
+        headers={
+            "Authorization": "Bearer " + flask_config.secret_key,
+            "If-None-Match": response.headers["ETag"],
+        },
+    )
+    assert response.status_code == 304  # Not Modified
+
+
+def test_flask_get_user_not_modified(
+    flask_config: migraine_shared.config.FlaskConfig,
+    flask_session_unauthenticated: requests.Session,
+    pooled_account: migraine_shared.testing.PooledAccount,
+):
+    """
+    Test retrieval of a user profile using the ETag of a previous retrieval. Should return 304.
+    """
+
+    response = flask_session_unauthenticated.get(
+        urljoin(flask_config.baseurl, "users/" + pooled_account.user),
+        headers={"Authorization": "Bearer " + flask_config.secret_key},
+    )
+    assert response.ok
+    assert response.headers["ETag"]
+
+    response = flask_session_unauthenticated.get(
+        urljoin(flask_config.baseurl, "users/" + pooled_account.user),
+        headers={
+            "Authorization": "Bearer " + flask_config.secret_key,
+            "If-None-Match": response.headers["ETag"],
+        },
+    )
+    assert response.status_code == 304  # Not Modified
+    _assert_round_trips(response, budget=2)
+
+
+def test_flask_lookup_users(
+    flask_config: migraine_shared.config.FlaskConfig,
+    flask_session_unauthenticated: requests.Session,
+    pooled_account: migraine_shared.testing.PooledAccount,
+):
+    """
+    Test lookup of users, including a user that exists and a user that does not.
+    """
+
+    missing_user = 'test_flask_user_{}'.format(secrets.token_hex(nbytes=8))
+
+    response = flask_session_unauthenticated.post(
+        urljoin(flask_config.baseurl, "users/_lookup"),
+        json={
+            "user_names": [pooled_account.user, missing_user],
+        },
+        headers={"Authorization": "Bearer " + flask_config.secret_key},
+    )
+    assert response.ok
+    # One _all_docs on the cluster of each user, then one _dbs_info.
+    _assert_round_trips(response, budget=3)
+
+    # Response json is a dictionary containing status and a result for each user, in the requested order.
+
+    assert response.json() == {
+        "status": 200,
+        "users": [
+            {
+                "user_name": pooled_account.user,
+                "exists": True,
+                "database": migraine_shared.database.database_for_user(
+                    user=pooled_account.user
+                ),
+            },
+            {
+                "user_name": missing_user,
+                "exists": False,
+                "database": None,
+            },
+        ],
+    }
+
+
+def test_flask_delete_user_account(
+    flask_config: migraine_shared.config.FlaskConfig,
+    flask_session_unauthenticated: requests.Session,
+    sample_account: AccountTuple,
+):
+    """
+    Test deletion of a user account, then repeated deletion. Both should return 202.
+
+    Deletion of the database is asynchronous, so the account is created here rather than acquired from account_pool.
+    The sample_account_delete fixture would fail if the database were already deleted.
+    """
+
+    response = flask_session_unauthenticated.post(
+        urljoin(flask_config.baseurl, "users/"),
+        json={
+            "user_name": sample_account.user,
+            "user_password": sample_account.password,
+        },
+        headers={"Authorization": "Bearer " + flask_config.secret_key},
+    )
+    assert response.ok
+
+    for _ in range(2):
+        response = flask_session_unauthenticated.delete(
+            urljoin(flask_config.baseurl, "users/" + sample_account.user),
+            headers={"Authorization": "Bearer " + flask_config.secret_key},
+        )
+        assert response.status_code == 202  # Accepted
+
+        assert response.json() == {
+            "status": 202,
+            "user_name": sample_account.user,
+            "database": migraine_shared.database.database_for_user(
+                user=sample_account.user
+            ),
+        }
+
+    # The user document is deleted synchronously
+    response = flask_session_unauthenticated.get(
+        urljoin(flask_config.baseurl, "users/" + sample_account.user),
+        headers={"Authorization": "Bearer " + flask_config.secret_key},
+    )
+    assert response.status_code == 404  # Not Found
+
+
+def test_flask_get_stats(
+    flask_config: migraine_shared.config.FlaskConfig,
+    flask_session_unauthenticated: requests.Session,
+    pooled_account: migraine_shared.testing.PooledAccount,
+):
+    """
+    Test retrieval of storage statistics, paging until the sample database is found.
+    """
+
+    sample_database = migraine_shared.database.database_for_user(user=pooled_account.user)
+
+    # Begin the page at the sample database, so the first page includes it.
+    response = flask_session_unauthenticated.get(
+        urljoin(flask_config.baseurl, "users/_stats"),
+        params={"start": sample_database, "limit": 1},
+        headers={"Authorization": "Bearer " + flask_config.secret_key},
+    )
+    assert response.ok
+    # One _all_docs, then one _dbs_info.
+    _assert_round_trips(response, budget=2)
+
+    databases = response.json()["databases"]
+    assert len(databases) == 1
+    assert databases[0]["database"] == sample_database
+    assert databases[0]["doc_count"] == 0
+    assert "active" in databases[0]["sizes"]
+    assert "file" in databases[0]["sizes"]
+
+
+@pytest.mark.parametrize("start", ["foo", "user_zz", "user_"])
+def test_flask_get_stats_invalid_start(
+    flask_config: migraine_shared.config.FlaskConfig,
+    flask_session_unauthenticated: requests.Session,
+    start: str,
+):
+    """
+    Test a start that is not a user database is rejected.
+    """
+
+    response = flask_session_unauthenticated.get(
+        urljoin(flask_config.baseurl, "users/_stats"),
+        params={"start": start},
+        headers={"Authorization": "Bearer " + flask_config.secret_key},
+    )
+    assert response.status_code == 400  # Bad Request
+
+
+def test_flask_batch(
+    flask_config: migraine_shared.config.FlaskConfig,
+    flask_session_unauthenticated: requests.Session,
+    sample_account: AccountTuple,
+    sample_account_delete,  # None, included for fixture functionality
+):
+    """
+    Test a batch that creates a user, reading before and after the creation.
+    """
+
+    assert sample_account_delete is None
+
+    response = flask_session_unauthenticated.post(
+        urljoin(flask_config.baseurl, "_batch"),
+        json={
+            "requests": [
+                {"method": "GET", "path": "/users/" + sample_account.user},
+                {
+                    "method": "POST",
+                    "path": "/users/",
+                    "body": {
+                        "user_name": sample_account.user,
+                        "user_password": sample_account.password,
+                    },
+                },
+                {"method": "GET", "path": "/users/" + sample_account.user},
+            ],
+        },
+        headers={"Authorization": "Bearer " + flask_config.secret_key},
+    )
+    assert response.ok
+    # The round trips of each sub-request, within the budget of the corresponding requests.
+    _assert_round_trips(response, budget=2 + 3 + 2)
+
+    # Sub-responses are in the order of the sub-requests, and the creation is a barrier between the reads.
+
+    responses = response.json()["responses"]
+    assert [sub_response["status"] for sub_response in responses] == [404, 200, 200]
+    assert responses[2]["body"] == {
+        "status": 200,
+        "user_name": sample_account.user,
+        "database": migraine_shared.database.database_for_user(
+            user=sample_account.user
+        ),
+    }
+
+
+def test_flask_get_memory(
+    flask_config: migraine_shared.config.FlaskConfig,
+    flask_session_unauthenticated: requests.Session,
+):
+    """
+    Test obtaining memory of whichever pod serves the request.
+    """
+
+    response = flask_session_unauthenticated.get(
+        urljoin(flask_config.baseurl, "_admin/memory/"),
+    )
+    assert response.status_code == 403  # 403 Forbidden
+
+    response = flask_session_unauthenticated.get(
+        urljoin(flask_config.baseurl, "_admin/memory/"),
+        headers={"Authorization": "Bearer " + flask_config.secret_key},
+    )
+    assert response.ok
+
+    memory = response.json()
+    assert memory["rss"]["peak"] > 0
+    assert "counts" in memory["gc"]
+
+
+def test_flask_profile_request(
+    flask_config: migraine_shared.config.FlaskConfig,
+    flask_session_unauthenticated: requests.Session,
+):
+    """
+    Test that a request opting in to profiling identifies its profile.
+    """
+
+    response = flask_session_unauthenticated.get(
+        urljoin(flask_config.baseurl, "users/"),
+        headers={"Authorization": "Bearer " + flask_config.secret_key},
+    )
+    assert response.ok
+    assert "X-Profile-Id" not in response.headers
+
+    response = flask_session_unauthenticated.get(
+        urljoin(flask_config.baseurl, "users/"),
+        headers={
+            "Authorization": "Bearer " + flask_config.secret_key,
+            "X-Profile": "Bearer " + flask_config.secret_key,
+        },
+    )
+    assert response.ok
+    assert int(response.headers["X-Profile-Id"]) > 0
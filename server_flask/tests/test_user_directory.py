@@ -0,0 +1,210 @@
+"""
+Tests of the user directory, following an in-memory changes feed rather than any database.
+"""
+
+import json
+from pathlib import Path
+import pytest
+import requests
+import requests.adapters
+import threading
+import time
+from typing import Dict, List
+from urllib.parse import parse_qsl, urlsplit
+
+import migraine_shared.session
+
+import user_directory
+from user_directory import UserDirectory
+
+BASEURL = "http://localhost:5984/"
+
+# Seconds to wait for the directory to follow the feed.
+FOLLOW_TIMEOUT = 5
+
+
+class FakeChangesFeed(requests.adapters.BaseAdapter):
+    """
+    Transport serving the _users changes feed from a list of changes.
+
+    Sequences are opaque, as in clustered CouchDB, so the directory can only provide them back to the feed.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.changes: List[Dict] = []
+        self.since: List[str] = []
+        self._lock = threading.Lock()
+
+    def change(self, *, user: str, deleted: bool = False, doc_id: str = None):
+        result = {"id": doc_id or "org.couchdb.user:{}".format(user), "changes": [{"rev": "1-a"}]}
+        if deleted:
+            result["deleted"] = True
+
+        with self._lock:
+            result["seq"] = "{}-g1AAAAB{}".format(len(self.changes) + 1, "xyz"[len(self.changes) % 3])
+            self.changes.append(result)
+
+    def close(self):
+        pass
+
+    def send(self, request, **kwargs):
+        assert urlsplit(request.url).path == "/_users/_changes"
+        params = dict(parse_qsl(urlsplit(request.url).query))
+
+        with self._lock:
+            self.since.append(params["since"])
+            seqs = [change["seq"] for change in self.changes]
+            start = seqs.index(params["since"]) + 1 if params["since"] in seqs else 0
+            remaining = self.changes[start:]
+
+        limit = int(params.get("limit", len(remaining)))
+        results = remaining[:limit]
+        if not results and params.get("feed") == "longpoll":
+            # Hold the longpoll open briefly, rather than the full timeout.
+            time.sleep(0.01)
+
+        response = requests.Response()
+        response.status_code = 200
+        response._content = json.dumps({
+            "results": results,
+            "last_seq": results[-1]["seq"] if results else params["since"],
+            "pending": len(remaining) - len(results),
+        }).encode("utf-8")
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+
+        return response
+
+
+@pytest.fixture
+def feed(monkeypatch) -> FakeChangesFeed:
+    feed = FakeChangesFeed()
+
+    class FakeCouchDBSession(migraine_shared.session.CouchDBSession):
+        def __init__(self, **kwargs):
+            super().__init__(**kwargs)
+            self.mount(BASEURL, feed)
+
+    # The directory follows the feed in its own session.
+    monkeypatch.setattr(migraine_shared.session, "CouchDBSession", FakeCouchDBSession)
+    # Catch up in several batches.
+    monkeypatch.setattr(user_directory, "CHANGES_BATCH_LIMIT", 2)
+
+    return feed
+
+
+@pytest.fixture
+def session(feed: FakeChangesFeed) -> requests.Session:
+    session = requests.Session()
+    session.mount(BASEURL, feed)
+
+    return session
+
+
+def _directory(*, snapshot_path=None) -> UserDirectory:
+    return UserDirectory(
+        baseurl=BASEURL,
+        admin_user="admin",
+        admin_password="password",
+        snapshot_path=snapshot_path,
+    )
+
+
+def _wait(condition):
+    deadline = time.monotonic() + FOLLOW_TIMEOUT
+    while not condition():
+        assert time.monotonic() < deadline, "Directory did not follow the feed"
+        time.sleep(0.01)
+
+
+def test_user_directory_follow(feed: FakeChangesFeed):
+    feed.change(user="bob")
+    feed.change(user="Carol")
+    feed.change(user="alice")
+    feed.change(user="_auth", doc_id="_design/_auth")
+    feed.change(user="bob")
+    feed.change(user="dave", deleted=True)
+
+    directory = _directory()
+    directory.start()
+    try:
+        _wait(lambda: directory.caught_up)
+
+        # Sorted by code point, so matches sorted(), and an update does not duplicate a name
+        assert directory.users() == sorted(["alice", "bob", "Carol"])
+        assert directory.seq == feed.changes[-1]["seq"]
+
+        # A deletion removes the name
+        feed.change(user="bob", deleted=True)
+        _wait(lambda: "bob" not in directory.users())
+        assert directory.users() == sorted(["alice", "Carol"])
+    finally:
+        directory.stop()
+
+
+def test_user_directory_current_users(feed: FakeChangesFeed, session: requests.Session):
+    feed.change(user="bob")
+
+    directory = _directory()
+
+    # Not current until caught up at least once
+    assert directory.current_users(couchdb_session=session) is None
+
+    directory.start()
+    _wait(lambda: directory.caught_up)
+    directory.stop()
+
+    assert directory.current_users(couchdb_session=session) == ["bob"]
+
+    # Not current if the feed has any change following the checkpoint
+    feed.change(user="alice")
+    assert directory.current_users(couchdb_session=session) is None
+    assert directory.users() == ["bob"]
+
+
+def test_user_directory_snapshot(feed: FakeChangesFeed, tmp_path: Path):
+    snapshot_path = Path(tmp_path, "snapshots", "users.json")
+    feed.change(user="bob")
+    feed.change(user="alice")
+
+    directory = _directory(snapshot_path=snapshot_path)
+    directory.start()
+    try:
+        # A snapshot is written when first caught up
+        _wait(lambda: snapshot_path.exists())
+    finally:
+        directory.stop()
+    snapshot_seq = directory.seq
+
+    feed.change(user="carol")
+    feed.since.clear()
+
+    # A restored directory follows the feed from the checkpoint of its snapshot
+    restored = _directory(snapshot_path=snapshot_path)
+    restored.start()
+    try:
+        _wait(lambda: restored.caught_up)
+    finally:
+        restored.stop()
+
+    assert feed.since[0] == snapshot_seq
+    assert restored.users() == ["alice", "bob", "carol"]
+
+
+def test_user_directory_snapshot_unusable(feed: FakeChangesFeed, tmp_path: Path):
+    snapshot_path = Path(tmp_path, "users.json")
+    snapshot_path.write_text("not json")
+    feed.change(user="bob")
+
+    # An unusable snapshot is ignored, and the feed is followed from the beginning
+    directory = _directory(snapshot_path=snapshot_path)
+    directory.start()
+    try:
+        _wait(lambda: directory.caught_up)
+    finally:
+        directory.stop()
+
+    assert feed.since[0] == "0"
+    assert directory.users() == ["bob"]
@@ -0,0 +1,250 @@
+import bisect
+import json
+import logging
+import os
+from pathlib import Path
+import requests
+import requests.auth
+import tempfile
+import threading
+from typing import Dict, List, Optional, Union
+from urllib.parse import urljoin
+
+import migraine_shared.session
+
+from timeit import default_timer as timer
+
+
+USER_DOC_ID_PREFIX = "org.couchdb.user:"
+
+# Maximum changes obtained in a single request while catching up.
+CHANGES_BATCH_LIMIT = 10000
+# Milliseconds CouchDB holds a longpoll request open when there are no changes.
+CHANGES_LONGPOLL_TIMEOUT = 60000
+# Seconds to wait after a failure before resuming the feed.
+FOLLOW_RETRY_DELAY = 5
+# Minimum seconds between snapshots.
+SNAPSHOT_INTERVAL = 60
+
+
+class UserDirectory:
+    """
+    In-memory directory of user names, maintained by following the _users changes feed.
+
+    The directory is a sorted list of names.
+    The checkpoint is the exact sequence returned by the feed with the last change applied.
+    Clustered CouchDB sequences are opaque, so the checkpoint is never ordered against another sequence.
+    It is only provided back to the feed, which reports whether any change follows it.
+
+    If a snapshot path is provided, the directory bootstraps from the snapshot
+    and follows the feed from its checkpoint, then periodically writes a new snapshot.
+    Without a snapshot, the directory follows the feed from the beginning.
+    """
+
+    def __init__(
+        self,
+        *,
+        baseurl: str,
+        admin_user: str,
+        admin_password: str,
+        internal_baseurl: Optional[str] = None,
+        snapshot_path: Optional[Union[Path, str]] = None,
+    ):
+        self._baseurl = baseurl
+        self._internal_baseurl = internal_baseurl
+        self._auth = requests.auth.HTTPBasicAuth(
+            username=admin_user,
+            password=admin_password,
+        )
+        self._snapshot_path = Path(snapshot_path) if snapshot_path else None
+
+        self._lock = threading.Lock()
+        self._names: List[str] = []
+        self._seq: str = "0"
+        self._caught_up = threading.Event()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def caught_up(self) -> bool:
+        """
+        Whether the directory has at least once applied every change in the feed.
+        """
+        return self._caught_up.is_set()
+
+    @property
+    def seq(self) -> str:
+        """
+        Checkpoint sequence of the directory.
+        """
+        with self._lock:
+            return self._seq
+
+    def users(self) -> List[str]:
+        """
+        Obtain a list of user names, sorted by code point.
+        """
+        with self._lock:
+            return list(self._names)
+
+    def current_users(self, *, couchdb_session: requests.Session) -> Optional[List[str]]:
+        """
+        Obtain a list of user names, sorted by code point, if the directory includes every change to _users.
+
+        Asks the feed for any change following the checkpoint, so a directory that is behind returns None.
+        """
+        if not self.caught_up:
+            return None
+
+        with self._lock:
+            names = list(self._names)
+            seq = self._seq
+
+        response = couchdb_session.get(
+            urljoin(self._baseurl, "_users/_changes"),
+            params={"since": seq, "limit": 1},
+        )
+        response.raise_for_status()
+        if response.json()["results"]:
+            return None
+
+        return names
+
+    def start(self):
+        """
+        Start following the changes feed in a background thread.
+        """
+        assert self._thread is None
+
+        self._thread = threading.Thread(
+            target=self._follow,
+            name="user_directory",
+            daemon=True,
+        )
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop following the changes feed, waiting for the background thread to complete.
+        """
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _apply(self, *, results: List[Dict], last_seq: str):
+        """
+        Apply a batch of results from the changes feed.
+        """
+        with self._lock:
+            for result in results:
+                if not result["id"].startswith(USER_DOC_ID_PREFIX):
+                    continue
+
+                name = result["id"][len(USER_DOC_ID_PREFIX):]
+                index = bisect.bisect_left(self._names, name)
+                exists = index < len(self._names) and self._names[index] == name
+                if result.get("deleted"):
+                    if exists:
+                        del self._names[index]
+                elif not exists:
+                    self._names.insert(index, name)
+
+            self._seq = last_seq
+
+    def _load_snapshot(self):
+        """
+        Bootstrap from a snapshot, if one exists.
+        """
+        if not self._snapshot_path or not self._snapshot_path.exists():
+            return
+
+        try:
+            with open(self._snapshot_path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+
+            with self._lock:
+                self._names = sorted(snapshot["users"])
+                self._seq = snapshot["seq"]
+        except (OSError, ValueError, KeyError):
+            # An unusable snapshot is not fatal, the feed will be followed from the beginning.
+            logging.exception("Ignoring unusable user directory snapshot: {}".format(self._snapshot_path))
+
+    def _save_snapshot(self):
+        """
+        Write a snapshot, replacing any previous snapshot.
+        """
+        with self._lock:
+            snapshot = {
+                "seq": self._seq,
+                "users": list(self._names),
+            }
+
+        # Write to a temporary file in the same directory, then replace, so a snapshot is never partial.
+        self._snapshot_path.parent.mkdir(parents=True, exist_ok=True)
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self._snapshot_path.parent)
+        try:
+            with os.fdopen(file_descriptor, "w") as snapshot_file:
+                json.dump(snapshot, snapshot_file)
+            os.replace(temp_path, self._snapshot_path)
+        except OSError:
+            os.unlink(temp_path)
+            raise
+
+    def _follow(self):
+        """
+        Follow the changes feed until stopped.
+        """
+        self._load_snapshot()
+
+        # Follow the feed at the internal baseurl, if any, falling back to the public baseurl.
+        session = migraine_shared.session.CouchDBSession(
+            internal_baseurls={self._baseurl: self._internal_baseurl} if self._internal_baseurl else {},
+        )
+        session.auth = self._auth
+
+        snapshot_time = timer()
+        snapshot_seq = self.seq
+
+        while not self._stopped.is_set():
+            try:
+                if self.caught_up:
+                    # Wait for changes
+                    params = {
+                        "feed": "longpoll",
+                        "timeout": CHANGES_LONGPOLL_TIMEOUT,
+                    }
+                else:
+                    # Catch up in batches
+                    params = {
+                        "feed": "normal",
+                        "limit": CHANGES_BATCH_LIMIT,
+                    }
+                params["since"] = self.seq
+
+                response = session.get(
+                    urljoin(self._baseurl, "_users/_changes"),
+                    params=params,
+                    # A longpoll is held open without any bytes in the response.
+                    timeout=(
+                        migraine_shared.session.DEFAULT_CONNECT_TIMEOUT,
+                        CHANGES_LONGPOLL_TIMEOUT / 1000 + migraine_shared.session.DEFAULT_READ_TIMEOUT,
+                    ),
+                )
+                response.raise_for_status()
+                response_json = response.json()
+
+                self._apply(results=response_json["results"], last_seq=response_json["last_seq"])
+
+                # Snapshot when first caught up, then periodically
+                snapshot_due = not self.caught_up or timer() - snapshot_time > SNAPSHOT_INTERVAL
+                if response_json.get("pending", 0) == 0:
+                    self._caught_up.set()
+
+                    if self._snapshot_path and snapshot_due and self.seq != snapshot_seq:
+                        self._save_snapshot()
+                        snapshot_time = timer()
+                        snapshot_seq = self.seq
+            except Exception:
+                logging.exception("Failure following _users changes feed.")
+                self._stopped.wait(FOLLOW_RETRY_DELAY)
@@ -1,17 +1,26 @@
 from flask import abort, Blueprint, current_app, Response
-from flask import jsonify, request
+from flask import g, has_request_context, jsonify, request
 from flask_json import as_json
-import jsonschema
+import hashlib
+import heapq
+import jsonschema.protocols
 import requests
 import requests.auth
 import requests.exceptions
-from typing import Dict
+from typing import Dict, Optional
+import concurrent.futures
+import logging
 from urllib.parse import urljoin
 from functools import wraps
 import re
 import json
+from werkzeug.http import quote_etag, unquote_etag
 
+from admission import admission_controlled
+import codec
 import migraine_shared.database
+import migraine_shared.routing
+import migraine_shared.session
 
 from timeit import default_timer as timer
 
@@ -22,6 +31,28 @@ users_blueprint = Blueprint("users_blueprint", __name__)
 ADMIN_SESSION = None
 ADMIN_SESSION_CREATED_TIME = -10000
 
+# Shared by every admin session, so a failing database is detected across sessions.
+CIRCUIT_BREAKER = migraine_shared.session.CircuitBreaker()
+
+# Background teardown of deleted accounts, each already queued in the database.
+# A teardown this process does not complete (e.g., it is stopped first) is completed by the account reconciler.
+TEARDOWN_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=2,
+    thread_name_prefix="teardown",
+)
+
+
+# Header of a response reporting the CouchDB round trips made in serving its request.
+ROUND_TRIPS_HEADER = "X-CouchDB-Round-Trips"
+
+
+def _count_round_trip(response: requests.Response, *args, **kwargs):
+    """
+    Response hook counting each CouchDB round trip made in serving the current request.
+    """
+    if has_request_context():
+        g.couchdb_round_trips = g.get("couchdb_round_trips", 0) + 1
+
 
 def _admin_session() -> requests.Session:
     """
@@ -39,16 +70,28 @@ def _admin_session() -> requests.Session:
             password=current_app.config["DATABASE_ADMIN_PASSWORD"],
         )
 
-        # Open a session
-        session = requests.Session()
-        response = session.post(
-            urljoin(current_app.config["DATABASE_BASEURL"], "_session"),
-            json={
-                "name": auth.username,
-                "password": auth.password,
-            },
+        # Open a session, authenticated with every cluster.
+        # Each cluster sets its own cookie, which the session sends only to that cluster.
+        # Calls go to the internal baseurl of a cluster, falling back to its public baseurl.
+        session = migraine_shared.session.CouchDBSession(
+            internal_baseurls=current_app.config["DATABASE_INTERNAL_BASEURLS"],
+            fallback_auth=auth,
+            connect_timeout=current_app.config["DATABASE_CONNECT_TIMEOUT"],
+            read_timeout=current_app.config["DATABASE_READ_TIMEOUT"],
+            circuit_breaker=CIRCUIT_BREAKER,
         )
-        response.raise_for_status()
+        for baseurl_current in current_app.config["DATABASE_ROUTING"].baseurls:
+            response = session.post(
+                urljoin(baseurl_current, "_session"),
+                json={
+                    "name": auth.username,
+                    "password": auth.password,
+                },
+            )
+            response.raise_for_status()
+
+        # Count round trips made in serving requests, but not in authenticating the session.
+        session.hooks["response"].append(_count_round_trip)
 
         ADMIN_SESSION = session
         ADMIN_SESSION_CREATED_TIME = time_current
@@ -56,19 +99,18 @@ def _admin_session() -> requests.Session:
     return ADMIN_SESSION
 
 
-def _validate_request_json_schema(*, instance: Dict, schema: Dict):
+def _validate_request_json_schema(*, instance: Dict, validator: jsonschema.protocols.Validator):
     """
-    Validate schema_instance against schema.
+    Validate schema_instance using a validator precompiled from its schema.
 
     Raise 400 on failure.
 
     Args:
         instance (Dict): Schema instance which needs to validated
-        schema (Dict): Schema against which instance will be validated
+        validator (Validator): Validator, obtained from codec.register_validator
     """
-    try:
-        jsonschema.validate(instance=instance, schema=schema)
-    except (jsonschema.SchemaError, jsonschema.ValidationError) as error:
+    error = codec.validation_error(validator=validator, instance=instance)
+    if error:
         abort(
             400,
             jsonify(
@@ -77,6 +119,36 @@ def _validate_request_json_schema(*, instance: Dict, schema: Dict):
         )
 
 
+def _cache_headers(*, etag: str) -> Dict:
+    """
+    Headers for a cacheable response.
+
+    Args:
+        etag (str): Strong ETag identifying the representation, not yet quoted.
+    """
+    return {
+        "ETag": quote_etag(etag),
+        "Cache-Control": current_app.config["CACHE_CONTROL"],
+    }
+
+
+def _not_modified(*, etag: str) -> Optional[Response]:
+    """
+    Obtain a 304 Not Modified if the request's If-None-Match matches etag.
+
+    Returns None if the client does not already have the representation,
+    in which case a complete response is required.
+    """
+    if request.if_none_match.contains_weak(etag):
+        return Response(
+            status=304,
+            headers=_cache_headers(etag=etag),
+            mimetype="application/json",
+        )
+
+    return None
+
+
 def secure(f):
     """
     Decorator function to validate the Bearer token in authorization header.
@@ -95,6 +167,9 @@ def secure(f):
         except:
             abort(403, jsonify(message="Invalid secret key."))  # 403 Forbidden
 
+        # Responses to authenticated requests may report internals, such as their round trips.
+        g.authenticated = True
+
         return f(*args, **kwargs)
 
     return check_authorization_bearer
@@ -107,6 +182,12 @@ def get_users():
     """
     GET all users
 
+    The ETag is derived from the update sequence of the _users database on each cluster,
+    so a client with a current listing receives a 304 Not Modified.
+
+    If the user directory of every cluster includes every change to its _users, the listing is served from the directories.
+    Otherwise the listing falls back to a scan of the _users database on each cluster.
+
     Returns:
         {"users": [list of users]}
     """
@@ -114,25 +195,74 @@ def get_users():
     # Connect to the database
     #
 
-    baseurl = current_app.config["DATABASE_BASEURL"]
+    baseurls = current_app.config["DATABASE_ROUTING"].baseurls
     admin_session = _admin_session()
 
+    # Any change to any user document advances the update sequence of the _users database.
+    # Obtaining it is much cheaper than the full listing, so check it first.
+    update_seqs = []
+    for baseurl_current in baseurls:
+        response = admin_session.get(
+            urljoin(baseurl_current, "_users"),
+        )
+        response.raise_for_status()
+        update_seqs.append(response.json()["update_seq"])
+
+    not_modified = _not_modified(etag=_etag_for_update_seq(update_seq=update_seqs))
+    if not_modified:
+        return not_modified
+
+    # A directory is current if the feed has no change following its checkpoint.
+    # The check follows that of the update sequence, so a current listing includes every change in the ETag.
+    user_directories = current_app.extensions["user_directories"]
+    directory_listings = []
+    for baseurl_current in baseurls:
+        directory_listing = user_directories[baseurl_current].current_users(couchdb_session=admin_session)
+        if directory_listing is None:
+            break
+        directory_listings.append(directory_listing)
+    else:
+        # Each listing is sorted, so they are merged into one sorted listing.
+        return {
+            "users": list(heapq.merge(*directory_listings))
+        }, _cache_headers(etag=_etag_for_update_seq(update_seq=update_seqs))
+
     # Get all users.
     # https://docs.couchdb.org/en/stable/intro/security.html#authentication-database
-    response = admin_session.get(
-        urljoin(baseurl, "_users/{}".format("_all_docs")),
-    )
-    response.raise_for_status()
-
-    # For each element in the list of _user documents, check if 'id' starts with 'org.couchdb.user:'
+    #
+    # Each listing includes its own update sequence, which may have advanced since the check above.
     regex_match_string = "org.couchdb.user:(.*)"
-    return {
-        "users": [
+    listings = []
+    update_seqs = []
+    for baseurl_current in baseurls:
+        response = admin_session.get(
+            urljoin(baseurl_current, "_users/{}".format("_all_docs")),
+            params={"update_seq": "true"},
+        )
+        response.raise_for_status()
+        response_json = response.json()
+
+        # For each element in the list of _user documents, check if 'id' starts with 'org.couchdb.user:'
+        # Sorted in the order of the user directory, which need not be the collation of _all_docs.
+        listings.append(sorted(
             re.match(regex_match_string, user["id"]).group(1)
-            for user in response.json()["rows"]
+            for user in response_json["rows"]
             if re.match(regex_match_string, user["id"])
-        ]
-    }
+        ))
+        update_seqs.append(response_json["update_seq"])
+
+    return {
+        "users": list(heapq.merge(*listings))
+    }, _cache_headers(etag=_etag_for_update_seq(update_seq=update_seqs))
+
+
+def _etag_for_update_seq(*, update_seq) -> str:
+    """
+    Obtain an ETag from a CouchDB update sequence, or a list of sequences from several clusters.
+
+    Sequences are opaque and can be long, so the ETag is a hash of the sequence.
+    """
+    return hashlib.md5(str(update_seq).encode("utf-8")).digest().hex()
 
 
 @users_blueprint.route("/<string:user_name>", methods=["GET"])
@@ -142,6 +272,8 @@ def get_user(user_name):
     """
     GET user_name from couchdb
 
+    The ETag is the revision of the user document.
+
     Args:
         user_name ([string]): [User name]
 
@@ -152,9 +284,12 @@ def get_user(user_name):
     }
     """
     #
-    # Connect to the database
+    # Connect to the database, on the cluster serving the user
     #
-    baseurl = current_app.config["DATABASE_BASEURL"]
+    baseurl = migraine_shared.database.baseurl_for_user(
+        couchdb_baseurl=current_app.config["DATABASE_ROUTING"],
+        user=user_name,
+    )
     admin_session = _admin_session()
 
     #
@@ -165,12 +300,16 @@ def get_user(user_name):
     user_doc_id = "org.couchdb.user:{}".format(user_name)
     user_database = migraine_shared.database.database_for_user(user=user_name)
 
-    # Confirm the user exists
-    response = admin_session.get(
+    # Confirm the user exists.
+    # The user directory lags behind the database in both directions (e.g., a just-deleted user remains),
+    # so existence is always confirmed against _users.
+    # A HEAD provides the revision of the document in its ETag, without the document itself.
+    response = admin_session.head(
         urljoin(baseurl, "_users/{}".format(user_doc_id)),
     )
     if not response.ok:
         abort(404, jsonify(message="User not found."))  # 404 Not Found
+    etag = unquote_etag(response.headers["ETag"])[0]
 
     # User exists, confirm database exists
     response = admin_session.head(
@@ -179,14 +318,204 @@ def get_user(user_name):
     if not response.ok:
         abort(404, jsonify(message="Database not found."))  # 404 Not Found
 
+    not_modified = _not_modified(etag=etag)
+    if not_modified:
+        return not_modified
+
     # Return the profile
-    return {"user_name": user_name, "database": user_database}
+    return {"user_name": user_name, "database": user_database}, _cache_headers(etag=etag)
+
+
+# Maximum number of users in a single lookup.
+LOOKUP_MAX_USERS = 1000
+
+LOOKUP_USERS_VALIDATOR = codec.register_validator(
+    name="lookup_users",
+    schema={
+        "type": "object",
+        "properties": {
+            "user_names": {
+                "type": "array",
+                "items": {"type": "string"},
+                "maxItems": LOOKUP_MAX_USERS,
+            },
+        },
+        "required": ["user_names"],
+    },
+)
+
+
+@users_blueprint.route("/_lookup", methods=["POST"])
+@as_json
+@secure
+def lookup_users():
+    """
+    Lookup many users.
+
+    Costs one request for all user documents, plus one request for each 100 databases.
+
+    Body params:
+    {
+        "user_names": [list of user names],
+    }
+
+    Returns:
+    {
+        "users": [
+            {
+                "user_name": user_name,
+                "exists": whether the user and their database exist,
+                "database": "existing database for the user, or null.",
+            },
+            ...
+        ]
+    }
+    """
+    #
+    # Validate the contents of the request
+    #
+
+    _validate_request_json_schema(instance=request.json, validator=LOOKUP_USERS_VALIDATOR)
+
+    # Obtain contents of the request
+    requested_users = request.json["user_names"]
+
+    #
+    # Connect to the database
+    #
+
+    routing = current_app.config["DATABASE_ROUTING"]
+    admin_session = _admin_session()
+
+    #
+    # Lookup the users
+    #
+
+    accounts_exist = migraine_shared.database.lookup_accounts(
+        couchdb_session_admin=admin_session,
+        couchdb_baseurl=routing,
+        accounts=requested_users,
+    )
+
+    return {
+        "users": [
+            {
+                "user_name": user_current,
+                "exists": accounts_exist[user_current],
+                "database": (
+                    migraine_shared.database.database_for_user(user=user_current)
+                    if accounts_exist[user_current]
+                    else None
+                ),
+            }
+            for user_current in requested_users
+        ]
+    }
+
+
+# Default and maximum number of databases in a page of statistics.
+STATS_DEFAULT_LIMIT = 100
+STATS_MAX_LIMIT = 1000
+
+
+@users_blueprint.route("/_stats", methods=["GET"])
+@as_json
+@secure
+def get_stats():
+    """
+    GET storage statistics for a page of user databases.
+
+    Costs one request to list the page of databases, plus one request for each 100 databases.
+
+    Query params:
+        start: Database at which the page begins, obtained from "next" of a previous page.
+        limit: Maximum number of databases in the page.
+
+    Returns:
+    {
+        "databases": [
+            {
+                "database": database,
+                "doc_count": number of documents,
+                "sizes": {"active": bytes of live data, "file": bytes of the database file},
+            },
+            ...
+        ],
+        "next": "database at which the next page begins, or null."
+    }
+    """
+    #
+    # Validate the contents of the request
+    #
+
+    start = request.args.get("start")
+    if start is not None and not migraine_shared.database.validate_database(database=start):
+        abort(400, jsonify(message="Invalid start."))  # 400 Bad Request
+
+    limit = request.args.get("limit", STATS_DEFAULT_LIMIT, type=int)
+    if not 0 < limit <= STATS_MAX_LIMIT:
+        abort(400, jsonify(message="Invalid limit."))  # 400 Bad Request
+
+    #
+    # Connect to the database
+    #
+
+    routing = current_app.config["DATABASE_ROUTING"]
+    admin_session = _admin_session()
+
+    #
+    # Obtain the page and its statistics
+    #
+
+    databases, next_start = migraine_shared.database.user_databases_page(
+        couchdb_session_admin=admin_session,
+        couchdb_baseurl=routing,
+        start=start,
+        limit=limit,
+    )
+
+    databases_info = migraine_shared.database.databases_info(
+        couchdb_session_admin=admin_session,
+        couchdb_baseurl=routing,
+        databases=databases,
+    )
+
+    return {
+        "databases": [
+            {
+                "database": database_current,
+                "doc_count": databases_info[database_current]["doc_count"],
+                "sizes": {
+                    "active": databases_info[database_current]["sizes"]["active"],
+                    "file": databases_info[database_current]["sizes"]["file"],
+                },
+            }
+            for database_current in databases
+            # A database may have been deleted since it was listed
+            if databases_info[database_current] is not None
+        ],
+        "next": next_start,
+    }
+
+
+CREATE_USER_VALIDATOR = codec.register_validator(
+    name="create_user",
+    schema={
+        "type": "object",
+        "properties": {
+            "user_name": {"type": "string"},
+            "user_password": {"type": "string"},
+        },
+        "required": ["user_name", "user_password"],
+    },
+)
 
 
 # Create a user in couchdb
 @users_blueprint.route("/", methods=["POST"])
 @as_json
 @secure
+@admission_controlled("create_user_admission")
 def create_user():
     """
     Create user account.
@@ -203,20 +532,14 @@ def create_user():
         "database": "database name we create for the user."
     }
 
+    Returns 429 with Retry-After if admission control rejects the request.
+
     """
     #
     # Validate the contents of the request
     #
 
-    schema = {
-        "type": "object",
-        "properties": {
-            "user_name": {"type": "string"},
-            "user_password": {"type": "string"},
-        },
-        "required": ["user_name", "user_password"],
-    }
-    _validate_request_json_schema(instance=request.json, schema=schema)
+    _validate_request_json_schema(instance=request.json, validator=CREATE_USER_VALIDATOR)
 
     # Obtain contents of the request
     requested_user = request.json["user_name"]
@@ -226,7 +549,7 @@ def create_user():
     # Connect to the database
     #
 
-    baseurl = current_app.config["DATABASE_BASEURL"]
+    routing = current_app.config["DATABASE_ROUTING"]
     admin_session = _admin_session()
 
     #
@@ -235,9 +558,14 @@ def create_user():
 
     response = migraine_shared.database.create_account(
         couchdb_session_admin=admin_session,
-        couchdb_baseurl=baseurl,
+        couchdb_baseurl=routing,
         account=requested_user,
         password=requested_password,
+        # Rely on CouchDB conflicts, rather than first checking whether the account exists.
+        optimistic=True,
+        # Derive the password key in the process pool, if configured.
+        password_executor=current_app.extensions.get("password_executor"),
+        password_iterations=current_app.config["PASSWORD_HASH_ITERATIONS"],
     )
 
     if not response.ok:
@@ -253,3 +581,96 @@ def create_user():
         "user_name": requested_user,
         "database": migraine_shared.database.database_for_user(user=requested_user),
     }
+
+
+def _teardown_database(
+    *,
+    admin_session: requests.Session,
+    routing: migraine_shared.routing.RoutingTable,
+    user_name: str,
+):
+    """
+    Background deletion of the database of a deleted user, whose teardown is queued.
+    """
+    try:
+        response = migraine_shared.database.complete_database_teardown(
+            couchdb_session_admin=admin_session,
+            couchdb_baseurl=routing,
+            account=user_name,
+        )
+        if response.status_code not in [204, 404, 409]:
+            logging.error(
+                "Failed to delete database for user {}: {} {}".format(
+                    user_name, response.status_code, response.reason
+                )
+            )
+    except Exception:
+        logging.exception("Failed to delete database for user {}".format(user_name))
+
+
+# Delete a user in couchdb
+@users_blueprint.route("/<string:user_name>", methods=["DELETE"])
+@as_json
+@secure
+def delete_user(user_name):
+    """
+    Delete user account.
+
+    The user document is deleted before returning, so the user can no longer authenticate.
+    Deletion of the database is queued in the database, then completed in the background.
+
+    Deletion is idempotent, deleting a user that does not exist also succeeds.
+
+    Returns 202:
+    {
+        "user_name": user_name,
+        "database": "database name queued for deletion."
+    }
+    """
+    if not migraine_shared.database.validate_user(user=user_name):
+        abort(403, jsonify(message="Invalid user name."))  # 403 Forbidden
+
+    #
+    # Connect to the database
+    #
+
+    routing = current_app.config["DATABASE_ROUTING"]
+    admin_session = _admin_session()
+
+    #
+    # Queue deletion of their database, then delete the user
+    #
+
+    # Queued first, so a database is never left behind by a deleted user.
+    response = migraine_shared.database.queue_database_teardown(
+        couchdb_session_admin=admin_session,
+        couchdb_baseurl=routing,
+        account=user_name,
+    )
+    if response.status_code == 202:
+        response = migraine_shared.database.delete_user_document(
+            couchdb_session_admin=admin_session,
+            couchdb_baseurl=routing,
+            account=user_name,
+        )
+
+    if response.status_code not in [204, 404]:
+        # Flask can return an object of type flask.wrappers.Response.
+        return Response(
+            response=json.dumps(response.reason),
+            status=response.status_code,
+            headers=dict(response.headers),
+            mimetype="application/json",
+        )
+
+    TEARDOWN_EXECUTOR.submit(
+        _teardown_database,
+        admin_session=admin_session,
+        routing=routing,
+        user_name=user_name,
+    )
+
+    return {
+        "user_name": user_name,
+        "database": migraine_shared.database.database_for_user(user=user_name),
+    }, 202
@@ -1,56 +1,150 @@
 import aws_infrastructure.tasks.library.color
 from aws_infrastructure.tasks.collection import compose_collection
+import importlib
 from invoke import Collection
-
-import tasks.aws
-import tasks.celery
-import tasks.codebuild.migraine_flask
-import tasks.database
-import tasks.dependencies
-import tasks.flask
-import tasks.helm
-import tasks.helmfile
-import tasks.tests
-import tasks.terraform.dns
-import tasks.terraform.ecr
-import tasks.terraform.eip
-import tasks.terraform.eip_worker
-import tasks.terraform.instance
-import tasks.terraform.instance_worker
-# import tasks.terraform_old.ecr
-# import tasks.terraform_old.eip
-# import tasks.terraform_old.instance
+import sys
 
 # Enable color
 aws_infrastructure.tasks.library.color.enable_color()
-# Apply the current AWS configuration
-aws_infrastructure.tasks.library.aws_configure.apply_aws_env(aws_env_path=tasks.aws.AWS_ENV_PATH)
+
+#
+# Collections are loaded lazily.
+#
+# Importing a task module can be slow (e.g., computing values, inspecting Terraform state),
+# so a module is imported only if a requested task is within its collection.
+# Requested tasks are inferred from the command line, before Invoke parses it.
+# Listing, help, and completion require every collection, as does any command line that cannot be interpreted.
+#
+
+# Top-level collections, used to recognize task names on the command line.
+TOP_LEVEL_COLLECTIONS = [
+    "aws",
+    "codebuild",
+    "database",
+    "depend",
+    "dev",
+    "helm",
+    "helmfile",
+    "prod",
+    "terraform",
+    "test",
+]
+
+# Flags that require every collection.
+LOAD_ALL_FLAGS = ["-l", "--list", "-h", "--help", "--complete", "--print-completion-script"]
+
+# Modules whose tasks require the current AWS configuration.
+AWS_MODULES = [
+    "tasks.codebuild.migraine_flask",
+    "tasks.helmfile",
+    "tasks.terraform.apply_all",
+    "tasks.terraform.dns",
+    "tasks.terraform.ecr",
+    "tasks.terraform.eip",
+    "tasks.terraform.eip_worker",
+    "tasks.terraform.instance",
+    "tasks.terraform.instance_worker",
+]
+
+
+def _normalize(name: str) -> str:
+    # Invoke accepts dashes in place of underscores.
+    return name.replace("-", "_")
+
+
+def _listing(argv) -> bool:
+    """
+    Whether the command line lists, describes, or completes tasks, rather than executing them.
+    """
+    return any(argument.split("=", 1)[0] in LOAD_ALL_FLAGS for argument in argv[1:])
+
+
+def _requested_tasks(argv):
+    """
+    Obtain the task names requested on the command line, as tuples of collection path components.
+
+    Returns None if every collection is required.
+    """
+    if _listing(argv):
+        return None
+
+    arguments = argv[1:]
+
+    # A task name begins with a top-level collection. Any other argument is a flag or a value.
+    requested = [
+        tuple(_normalize(component) for component in argument.split("."))
+        for argument in arguments
+        if not argument.startswith("-") and _normalize(argument.split(".")[0]) in TOP_LEVEL_COLLECTIONS
+    ]
+
+    return requested or None
+
+
+LISTING = _listing(sys.argv)
+REQUESTED_TASKS = _requested_tasks(sys.argv)
+
+_aws_env_applied = False
+
+
+def _required(*path: str) -> bool:
+    """
+    Whether the collection at path is required by a requested task.
+    """
+    if REQUESTED_TASKS is None:
+        return True
+
+    return any(requested[:len(path)] == path for requested in REQUESTED_TASKS)
+
+
+def _import(module_name: str):
+    """
+    Import a task module, first applying the current AWS configuration if its tasks require it.
+    """
+    global _aws_env_applied
+
+    if module_name in AWS_MODULES and not LISTING and not _aws_env_applied:
+        import aws_infrastructure.tasks.library.aws_configure
+        import tasks.aws
+
+        # Apply the current AWS configuration
+        aws_infrastructure.tasks.library.aws_configure.apply_aws_env(aws_env_path=tasks.aws.AWS_ENV_PATH)
+        _aws_env_applied = True
+
+    return importlib.import_module(module_name)
+
 
 # Build primary task collection
 ns = Collection()
 
 # Compose from aws.py
-compose_collection(ns, tasks.aws.ns, name='aws')
+if _required("aws"):
+    compose_collection(ns, _import("tasks.aws").ns, name='aws')
 
 # Compose from codebuild
-ns_codebuild = Collection("codebuild")
-compose_collection(ns_codebuild, tasks.codebuild.migraine_flask.ns, name="flask")
-compose_collection(ns, ns_codebuild, name="codebuild")
+if _required("codebuild"):
+    ns_codebuild = Collection("codebuild")
+    compose_collection(ns_codebuild, _import("tasks.codebuild.migraine_flask").ns, name="flask")
+    compose_collection(ns, ns_codebuild, name="codebuild")
 
 # Compose from database.py
-compose_collection(ns, tasks.database.ns, name="database")
+if _required("database"):
+    compose_collection(ns, _import("tasks.database").ns, name="database")
 
 # Compose from dependencies.py
-compose_collection(ns, tasks.dependencies.ns, name="depend")
+if _required("depend"):
+    compose_collection(ns, _import("tasks.dependencies").ns, name="depend")
 
 # Compose from helm.py
-compose_collection(ns, tasks.helm.ns, name="helm")
+if _required("helm"):
+    compose_collection(ns, _import("tasks.helm").ns, name="helm")
 
 # Compose from helmfile.py
-compose_collection(ns, tasks.helmfile.ns, name="helmfile")
+if _required("helmfile"):
+    compose_collection(ns, _import("tasks.helmfile").ns, name="helmfile")
 
 # Compose from test.py
-compose_collection(ns, tasks.tests.ns, name="test")
+if _required("test"):
+    compose_collection(ns, _import("tasks.tests").ns, name="test")
 
 #
 # A collection in each of development and production
@@ -59,23 +153,26 @@ ns_dev = Collection("dev")
 ns_prod = Collection("prod")
 
 # Compose from database.py
-compose_collection(
-    ns_dev,
-    tasks.database.ns.collections["dev"],
-    name="database",
-)
-compose_collection(
-    ns_prod,
-    tasks.database.ns.collections["prod"],
-    name="database",
-)
+if _required("dev", "database"):
+    compose_collection(
+        ns_dev,
+        _import("tasks.database").ns.collections["dev"],
+        name="database",
+    )
+if _required("prod", "database"):
+    compose_collection(
+        ns_prod,
+        _import("tasks.database").ns.collections["prod"],
+        name="database",
+    )
 
 # Compose from celery.py
-compose_collection(
-    ns_dev,
-    tasks.celery.ns.collections['dev'],
-    name='celery',
-)
+if _required("dev", "celery"):
+    compose_collection(
+        ns_dev,
+        _import("tasks.celery").ns.collections['dev'],
+        name='celery',
+    )
 # compose_collection(
 #     ns_prod,
 #     tasks.celery.ns.collections['prod'],
@@ -83,35 +180,45 @@ compose_collection(
 # )
 
 # Compose from flask.py
-compose_collection(
-    ns_dev,
-    tasks.flask.ns.collections["dev"],
-    name="flask",
-)
-compose_collection(
-    ns_prod,
-    tasks.flask.ns.collections["prod"],
-    name="flask",
-)
+if _required("dev", "flask"):
+    compose_collection(
+        ns_dev,
+        _import("tasks.flask").ns.collections["dev"],
+        name="flask",
+    )
+if _required("prod", "flask"):
+    compose_collection(
+        ns_prod,
+        _import("tasks.flask").ns.collections["prod"],
+        name="flask",
+    )
 
 # Compose development and production
-compose_collection(ns, ns_dev, name="dev")
-compose_collection(ns, ns_prod, name="prod")
+if _required("dev"):
+    compose_collection(ns, ns_dev, name="dev")
+if _required("prod"):
+    compose_collection(ns, ns_prod, name="prod")
 
 #
 # Terraform infrastructure
 #
 
-ns_terraform = Collection("terraform")
+if _required("terraform"):
+    ns_terraform = Collection("terraform")
+
+    for terraform_name in ["dns", "ecr", "eip", "eip_worker", "instance", "instance_worker"]:
+        if _required("terraform", terraform_name):
+            compose_collection(
+                ns_terraform,
+                _import("tasks.terraform.{}".format(terraform_name)).ns,
+                name=terraform_name,
+            )
 
-compose_collection(ns_terraform, tasks.terraform.dns.ns, name="dns")
-compose_collection(ns_terraform, tasks.terraform.ecr.ns, name="ecr")
-compose_collection(ns_terraform, tasks.terraform.eip.ns, name="eip")
-compose_collection(ns_terraform, tasks.terraform.eip_worker.ns, name="eip_worker")
-compose_collection(ns_terraform, tasks.terraform.instance.ns, name="instance")
-compose_collection(ns_terraform, tasks.terraform.instance_worker.ns, name="instance_worker")
+    # Apply every module, according to dependencies among modules
+    if _required("terraform", "apply_all"):
+        ns_terraform.add_task(_import("tasks.terraform.apply_all").apply_all, "apply-all")
 
-ns.add_collection(ns_terraform, "terraform")
+    ns.add_collection(ns_terraform, "terraform")
 
 #
 # Old Terraform infrastructure
@@ -2,7 +2,14 @@ from aws_infrastructure.tasks import compose_collection
 import aws_infrastructure.tasks.library.codebuild
 import aws_infrastructure.tasks.library.terraform
 from datetime import datetime
+import hashlib
 from invoke import Collection
+from invoke import task
+import json
+from pathlib import Path
+import re
+import shlex
+from typing import Optional
 
 import tasks.terraform.ecr
 
@@ -12,20 +19,143 @@ TERRAFORM_DIR = './terraform/terraform_codebuild/migraine_flask'
 STAGING_LOCAL_DIR = './.staging/codebuild/migraine_flask'
 SOURCE_DIR = './docker/migraine_flask'
 CODEBUILD_PROJECT_NAME = 'aws_infrastructure_migraine_migraine_flask'
+CODEBUILD_ENV_PATH = Path(SOURCE_DIR, 'codebuild_env.sh')
+REPOSITORY = 'aws_infrastructure_migraine/migraine_flask'
+
+# Paths of the repository that determine the image, as the dependencies it installs and the source it serves.
+# Other paths (e.g., helm, terraform, tests) are cloned into the image but do not affect it.
+BUILD_SOURCE_PATHS = [
+    'Pipfile',
+    'Pipfile.lock',
+    'migraine_shared',
+    'server_flask',
+    'tasks',
+]
+
+# Local files that define the build.
+BUILD_DEFINITION_PATHS = [
+    Path(SOURCE_DIR, 'Dockerfile'),
+    Path(SOURCE_DIR, 'buildspec.yaml'),
+]
+
+# Tag deployed by helm, which must refer to the image of the current source.
+LATEST_TAG = 'latest'
 
 BUILD_TIMESTAMP = datetime.now().strftime('%Y%m%d%H%M')
 
+_source_fingerprint: Optional[dict] = None
+
+
+def _codebuild_env() -> dict:
+    """
+    Obtain the variables exported by codebuild_env.sh, which determine the source that is built.
+    """
+    with open(CODEBUILD_ENV_PATH) as codebuild_env_file:
+        return dict(re.findall(r"^export (\w+)='([^']*)'$", codebuild_env_file.read(), flags=re.MULTILINE))
+
+
+def source_fingerprint(*, context) -> dict:
+    """
+    Obtain the commit that will be built, and a fingerprint of its source.
+
+    The fingerprint combines the git trees of the build source paths at that commit with the build definition.
+    A commit that changes nothing in those paths therefore has the fingerprint of its parent.
+    """
+    global _source_fingerprint
+
+    if _source_fingerprint is None:
+        codebuild_env = _codebuild_env()
+        git_repository = codebuild_env['GIT_REPOSITORY']
+        git_repository_branch = codebuild_env['GIT_REPOSITORY_BRANCH']
+
+        commit = context.run(
+            command='git ls-remote "{}" "refs/heads/{}"'.format(git_repository, git_repository_branch),
+            hide=True,
+        ).stdout.split()[0]
+
+        # Trees are read from the commit, so the commit must be available locally
+        if not context.run(command='git cat-file -e "{}^{{commit}}"'.format(commit), hide=True, warn=True).ok:
+            context.run(command='git fetch --quiet "{}" "{}"'.format(git_repository, git_repository_branch))
+
+        # Each line names a path and the hash of its content, so is unchanged unless something within it changes
+        build_source_trees = context.run(
+            command='git ls-tree "{}" -- {}'.format(commit, ' '.join(shlex.quote(path) for path in BUILD_SOURCE_PATHS)),
+            hide=True,
+        ).stdout
+
+        digest = hashlib.sha256(build_source_trees.encode('utf-8'))
+        for build_definition_path in BUILD_DEFINITION_PATHS:
+            with open(build_definition_path, 'rb') as build_definition_file:
+                digest.update(b'\0')
+                digest.update(build_definition_path.name.encode('utf-8'))
+                digest.update(b'\0')
+                digest.update(hashlib.sha256(build_definition_file.read()).digest())
+
+        _source_fingerprint = {
+            'commit': commit,
+            'tag': 'source-{}'.format(digest.hexdigest()[:16]),
+        }
+
+    return _source_fingerprint
+
 
 def codebuild_environment_variables_factory(*, context):
+    fingerprint = source_fingerprint(context=context)
+
     with tasks.terraform.ecr.ecr_read_only(context=context) as ecr:
         return {
             'REGISTRY_URL': ecr.output.registry_url,
-            'REPOSITORY': 'aws_infrastructure_migraine/migraine_flask',
-            'REPOSITORY_URL': ecr.output.repository_urls['aws_infrastructure_migraine/migraine_flask'],
-            'REPOSITORY_TAGS': 'latest {}'.format(BUILD_TIMESTAMP)
+            'REPOSITORY': REPOSITORY,
+            'REPOSITORY_URL': ecr.output.repository_urls[REPOSITORY],
+            'REPOSITORY_TAGS': '{} {} {}'.format(LATEST_TAG, fingerprint['tag'], BUILD_TIMESTAMP),
+            # Build the fingerprinted commit, even if the branch has since moved
+            'GIT_REPOSITORY_COMMIT': fingerprint['commit'],
         }
 
 
+def _image_exists(*, context, tag: str) -> bool:
+    result = context.run(
+        command='aws ecr describe-images --repository-name "{}" --image-ids "imageTag={}"'.format(REPOSITORY, tag),
+        hide=True,
+        warn=True,
+    )
+    if result.ok:
+        return True
+    if 'ImageNotFoundException' not in result.stderr:
+        # Building is always correct, so an inconclusive check does not prevent a build
+        print('Unable to check for an existing image, building: {}'.format(result.stderr.strip()))
+
+    return False
+
+
+def _tag_image(*, context, source_tag: str, tag: str):
+    """
+    Tag an existing image in the repository, without pulling or pushing its layers.
+    """
+    result = context.run(
+        command='aws ecr batch-get-image --repository-name "{}" --image-ids "imageTag={}" --output json'.format(
+            REPOSITORY,
+            source_tag,
+        ),
+        hide=True,
+    )
+    (image,) = json.loads(result.stdout)['images']
+
+    result = context.run(
+        command='aws ecr put-image --repository-name "{}" --image-tag "{}" --image-manifest {} --image-manifest-media-type "{}"'.format(
+            REPOSITORY,
+            tag,
+            shlex.quote(image['imageManifest']),
+            image['imageManifestMediaType'],
+        ),
+        hide=True,
+        warn=True,
+    )
+    # The tag may already refer to the image
+    if not result.ok and 'ImageAlreadyExistsException' not in result.stderr:
+        raise RuntimeError('Failed to tag {}:{} as {}: {}'.format(REPOSITORY, source_tag, tag, result.stderr.strip()))
+
+
 ns = Collection('codebuild/migraine_flask')
 
 ns_codebuild = aws_infrastructure.tasks.library.codebuild.create_tasks(
@@ -47,9 +177,35 @@ compose_collection(
         exclude=[
             'init',
             'apply',
+            'build',
         ],
         exclude_without_state=[
             'destroy'
         ],
     )
 )
+
+
+@task
+def build(context, force=False):
+    """
+    Build the Docker image, unless the repository already has an image of the same source.
+
+    If the build is skipped, the existing image is tagged latest, as if it had been built.
+    """
+
+    fingerprint = source_fingerprint(context=context)
+    if not force and _image_exists(context=context, tag=fingerprint['tag']):
+        print('Image {}:{} exists for commit {}, skipping build and tagging it {}.'.format(
+            REPOSITORY,
+            fingerprint['tag'],
+            fingerprint['commit'],
+            LATEST_TAG,
+        ))
+        _tag_image(context=context, source_tag=fingerprint['tag'], tag=LATEST_TAG)
+        return
+
+    ns_codebuild.tasks['build'](context)
+
+
+ns.add_task(build, 'build')
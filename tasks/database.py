@@ -2,9 +2,14 @@ from aws_infrastructure.tasks.collection import compose_collection
 import migraine_shared.config
 from invoke import Collection
 from invoke import task
+import migraine_shared.rebalance
+import migraine_shared.reconcile
 import requests
 import requests.auth
 import requests.exceptions
+import ruamel.yaml
+import sys
+from typing import List
 from urllib.parse import urljoin
 
 from migraine_shared.config import CouchDBConfig
@@ -70,14 +75,152 @@ def prod_initialize(context):
     _initialize(couchdb_config=couchdb_config)
 
 
+def _rebalance(
+    couchdb_config: migraine_shared.config.CouchDBConfig,
+    hash_start: str,
+    hash_end: str,
+    target: str,
+    delete_source: bool,
+    source: List[str],
+):
+    """
+    Helper to migrate a hash range to a target cluster, then print the resulting clusters.
+    """
+    session = requests.Session()
+    session.auth = requests.auth.HTTPBasicAuth(
+        username=couchdb_config.admin_user,
+        password=couchdb_config.admin_password
+    )
+
+    report = migraine_shared.rebalance.migrate_hash_range(
+        couchdb_session_admin=session,
+        routing=couchdb_config.routing,
+        admin_user=couchdb_config.admin_user,
+        admin_password=couchdb_config.admin_password,
+        hash_start=hash_start.lower(),
+        hash_end=hash_end.lower(),
+        target_baseurl=target,
+        delete_source=delete_source,
+        source_baseurls=source or None,
+    )
+
+    print('Migrated {} users and {} databases.'.format(len(report.users), len(report.databases)))
+    print('Clusters after migration:')
+    yaml = ruamel.yaml.YAML(typ="safe", pure=True)
+    yaml.default_flow_style = False
+    yaml.dump({'clusters': report.routing.to_yaml_config()}, sys.stdout)
+
+
+@task(iterable=['source'])
+def dev_rebalance(context, hash_start, hash_end, target, delete_source=False, source=None):
+    """
+    Migrate a range of database hashes to a target cluster.
+
+    Each --source is a cluster from which to migrate, by default every other cluster in the routing table.
+    """
+    couchdb_config = CouchDBConfig.load(
+        couchdb_config_path=DEV_COUCHDB_CONFIG_PATH
+    )
+    _rebalance(
+        couchdb_config=couchdb_config,
+        hash_start=hash_start,
+        hash_end=hash_end,
+        target=target,
+        delete_source=delete_source,
+        source=source,
+    )
+
+
+@task(iterable=['source'])
+def prod_rebalance(context, hash_start, hash_end, target, delete_source=False, source=None):
+    """
+    Migrate a range of database hashes to a target cluster.
+
+    Each --source is a cluster from which to migrate, by default every other cluster in the routing table.
+    """
+    couchdb_config = CouchDBConfig.load(
+        couchdb_config_path=PROD_COUCHDB_CONFIG_PATH
+    )
+    _rebalance(
+        couchdb_config=couchdb_config,
+        hash_start=hash_start,
+        hash_end=hash_end,
+        target=target,
+        delete_source=delete_source,
+        source=source,
+    )
+
+
+def _reconcile(
+    couchdb_config: migraine_shared.config.CouchDBConfig,
+    repair: bool,
+):
+    """
+    Helper to reconcile user documents with user databases, then print any mismatches.
+    """
+    session = requests.Session()
+    session.auth = requests.auth.HTTPBasicAuth(
+        username=couchdb_config.admin_user,
+        password=couchdb_config.admin_password
+    )
+
+    report = migraine_shared.reconcile.reconcile_accounts(
+        couchdb_session_admin=session,
+        couchdb_baseurl=couchdb_config.routing,
+        repair=repair,
+    )
+
+    print('Completed queued teardowns: {}'.format(len(report.teardowns_completed)))
+    print('Users without database: {}'.format(len(report.users_without_database)))
+    for user in report.users_without_database:
+        print('  {}'.format(user))
+    print('Databases without user: {}'.format(len(report.databases_without_user)))
+    for database in report.databases_without_user:
+        print('  {}'.format(database))
+    if repair:
+        print('Repaired {} users and {} databases.'.format(len(report.users_repaired), len(report.databases_repaired)))
+
+
+@task
+def dev_reconcile(context, repair=False):
+    """
+    Find user documents without a database and databases without a user, repairing them if requested.
+    """
+    couchdb_config = CouchDBConfig.load(
+        couchdb_config_path=DEV_COUCHDB_CONFIG_PATH
+    )
+    _reconcile(
+        couchdb_config=couchdb_config,
+        repair=repair,
+    )
+
+
+@task
+def prod_reconcile(context, repair=False):
+    """
+    Find user documents without a database and databases without a user, repairing them if requested.
+    """
+    couchdb_config = CouchDBConfig.load(
+        couchdb_config_path=PROD_COUCHDB_CONFIG_PATH
+    )
+    _reconcile(
+        couchdb_config=couchdb_config,
+        repair=repair,
+    )
+
+
 # Build task collection
 ns = Collection('database')
 
 ns_dev = Collection('dev')
 ns_dev.add_task(dev_initialize, 'initialize')
+ns_dev.add_task(dev_rebalance, 'rebalance')
+ns_dev.add_task(dev_reconcile, 'reconcile')
 
 ns_prod = Collection('prod')
 ns_prod.add_task(prod_initialize, 'initialize')
+ns_prod.add_task(prod_rebalance, 'rebalance')
+ns_prod.add_task(prod_reconcile, 'reconcile')
 
 compose_collection(ns, ns_dev, name='dev')
 compose_collection(ns, ns_prod, name='prod')
@@ -6,11 +6,22 @@ from aws_infrastructure.tasks.collection import compose_collection
 from invoke import Collection
 from invoke import task
 from pathlib import Path
+import ruamel.yaml
+import secrets
+import time
 
 from tasks.terminal import spawn_new_terminal
 
 FLASK_DIR = './server_flask'
 
+DEV_FLASK_CONFIG_PATH = './secrets/configuration/dev_local_flask.yaml'
+
+# A local CouchDB stand-in for replaying captures, never the development or production database.
+REPLAY_COUCHDB_IMAGE = 'couchdb:3'
+REPLAY_COUCHDB_CONTAINER = 'migraine-replay-couchdb'
+REPLAY_COUCHDB_PORT = 5985
+REPLAY_STAGING_DIR = './.staging/replay'
+
 
 @task
 def dev_serve(context):
@@ -62,11 +73,85 @@ def prod_serve(context):
         )
 
 
+@task
+def dev_replay(context, capture, speed=1.0, concurrency=16, population=0, report=None):
+    """
+    Replay a capture against a local Flask app, backed by a local CouchDB stand-in in Docker.
+
+    The capture is a comma-separated list of capture files, including any rotated files.
+    A speed of 2 replays twice as fast as captured, and 0 replays without delay.
+    The development configuration provides the secret key, so pseudonyms match those of a development capture.
+    """
+
+    admin_password = secrets.token_urlsafe()
+    baseurl = 'http://localhost:{}/'.format(REPLAY_COUCHDB_PORT)
+
+    # Configuration of the app, replacing the database with the stand-in
+    yaml = ruamel.yaml.YAML(typ='safe', pure=True)
+    yaml.default_flow_style = False
+    with open(DEV_FLASK_CONFIG_PATH) as config_file:
+        flask_config = yaml.load(config_file)
+    for key in ['database_clusters', 'database_internal_baseurl', 'capture_path']:
+        flask_config.pop(key, None)
+    flask_config['database_baseurl'] = baseurl
+    flask_config['database_admin'] = {'user': 'admin', 'password': admin_password}
+
+    Path(REPLAY_STAGING_DIR).mkdir(parents=True, exist_ok=True)
+    replay_config_path = Path(REPLAY_STAGING_DIR, 'flask.yaml')
+    with open(replay_config_path, 'w') as config_file:
+        yaml.dump(flask_config, config_file)
+
+    context.run(
+        command=' '.join([
+            'docker',
+            'run',
+            '--detach',
+            '--rm',
+            '--name={}'.format(REPLAY_COUCHDB_CONTAINER),
+            '--publish={}:5984'.format(REPLAY_COUCHDB_PORT),
+            '--env=COUCHDB_USER=admin',
+            '--env=COUCHDB_PASSWORD={}'.format(admin_password),
+            REPLAY_COUCHDB_IMAGE,
+        ]),
+    )
+    try:
+        # Wait for the stand-in to accept requests
+        for _ in range(60):
+            if context.run(command='curl --silent --fail {}_up'.format(baseurl), warn=True, hide=True).ok:
+                break
+            time.sleep(1)
+
+        captures = [str(Path(capture_path).resolve()) for capture_path in capture.split(',')]
+        with context.cd(Path(FLASK_DIR)):
+            context.run(
+                command=' '.join(
+                    [
+                        'pipenv',
+                        'run',
+                        'python',
+                        'replay.py',
+                        '--speed={}'.format(speed),
+                        '--concurrency={}'.format(concurrency),
+                        '--population={}'.format(population),
+                    ]
+                    + (['--report={}'.format(Path(report).resolve())] if report else [])
+                    + captures
+                ),
+                env={
+                    'FLASK_ENV': 'development',
+                    'FLASK_CONFIG_PATH': str(replay_config_path.resolve()),
+                },
+            )
+    finally:
+        context.run(command='docker stop {}'.format(REPLAY_COUCHDB_CONTAINER), warn=True)
+
+
 # Build task collection
 ns = Collection('flask')
 
 ns_dev = Collection('dev')
 ns_dev.add_task(dev_serve, 'serve')
+ns_dev.add_task(dev_replay, 'replay')
 
 ns_prod = Collection('prod')
 ns_prod.add_task(prod_serve, 'serve')
@@ -5,6 +5,12 @@ Tasks for managing Helm charts.
 from aws_infrastructure.tasks import compose_collection
 import aws_infrastructure.tasks.library.helm
 from invoke import Collection
+from invoke import task
+import json
+from pathlib import Path
+import ruamel.yaml
+
+import tasks.staging
 
 CONFIG_KEY = 'helm'
 HELM_BIN = './bin/helm.exe'
@@ -13,6 +19,7 @@ HELM_CHARTS_DIRS = [
 ]
 HELM_REPO_DIR = './helm_repo'
 STAGING_LOCAL_DIR = './.staging/helm_repo'
+STAGING_HASHES_PATH = './.staging/helm_repo_hashes.json'
 
 ns = Collection('helm')
 
@@ -27,5 +34,63 @@ ns_helm = aws_infrastructure.tasks.library.helm.create_tasks(
 compose_collection(
     ns,
     ns_helm,
-    sub=False
+    sub=False,
+    exclude=[
+        'package',
+    ],
 )
+
+
+def _package_name(*, chart_dir: Path) -> str:
+    with open(Path(chart_dir, 'Chart.yaml')) as chart_file:
+        chart = ruamel.yaml.YAML(typ='safe', pure=True).load(chart_file)
+
+    return '{}-{}.tgz'.format(chart['name'], chart['version'])
+
+
+@task
+def package(context, force=False):
+    """
+    Build packages from charts into staging, skipping charts whose content is unchanged.
+    """
+
+    staging_dir = Path(STAGING_LOCAL_DIR)
+    staging_dir.mkdir(parents=True, exist_ok=True)
+
+    try:
+        with open(STAGING_HASHES_PATH) as hashes_file:
+            hashes = json.load(hashes_file)
+    except (FileNotFoundError, ValueError):
+        hashes = {}
+
+    for helm_charts_dir in HELM_CHARTS_DIRS:
+        for chart_dir in sorted(path.parent for path in Path(helm_charts_dir).glob('*/Chart.yaml')):
+            chart_hash = tasks.staging.hash_dir(chart_dir)
+            package_name = _package_name(chart_dir=chart_dir)
+            hash_key = chart_dir.as_posix()
+
+            if (
+                not force
+                and hashes.get(hash_key, {}).get('hash') == chart_hash
+                and Path(staging_dir, package_name).is_file()
+            ):
+                print('Unchanged: {}'.format(package_name))
+                continue
+
+            context.run(command='{} package "{}" --destination "{}"'.format(
+                Path(HELM_BIN),
+                chart_dir,
+                staging_dir,
+            ))
+
+            hashes[hash_key] = {
+                'hash': chart_hash,
+                'package': package_name,
+            }
+            tasks.staging.write_if_changed(
+                path=Path(STAGING_HASHES_PATH),
+                content=json.dumps(hashes, indent=2, sort_keys=True).encode('utf-8'),
+            )
+
+
+ns.add_task(package, 'package')
@@ -1,8 +1,20 @@
-import aws_infrastructure.tasks.library.instance_helmfile
+import aws_infrastructure.tasks.ssh
+import boto3
+import concurrent.futures
 from invoke import Collection
+from invoke import task
+import io
+import json
+import paramiko
 from pathlib import Path
+import re
+import ruamel.yaml
+import shlex
+import sys
+from typing import Dict, List, Optional
 
 import migraine_shared.config
+import tasks.staging
 import tasks.terraform.ecr
 
 CONFIG_KEY = 'helmfile'
@@ -15,6 +27,13 @@ INSTANCE_NAME = 'instance'
 HELMFILE_PATH = './helmfile/helmfile.yaml'
 HELMFILE_CONFIG_PATH = './helmfile/helmfile_config.yaml'
 SSH_CONFIG_PATH = Path(INSTANCE_TERRAFORM_DIR, INSTANCE_NAME, 'ssh_config.yaml')
+SSH_KNOWN_HOSTS_PATH = Path(INSTANCE_TERRAFORM_DIR, INSTANCE_NAME, 'known_hosts')
+
+# Host keys are printed to the console by cloud-init when the instance is created.
+CONSOLE_HOST_KEYS_PATTERN = re.compile(
+    r'-----BEGIN SSH HOST KEY KEYS-----(.*?)-----END SSH HOST KEY KEYS-----',
+    re.DOTALL,
+)
 
 DEV_COUCHDB_CONFIG_PATH = "./secrets/configuration/dev_couchdb.yaml"
 DEV_FLASK_CONFIG_PATH = "./secrets/configuration/dev_server_flask.yaml"
@@ -69,6 +88,19 @@ def flask_prod_helmfile_values_factory(*, context):
                     'user': flask_config_dev.database_admin_user,
                     'password': flask_config_dev.database_admin_password,
                 },
+                'cache_control': flask_config_dev.cache_control,
+                'cors_max_age': flask_config_dev.cors_max_age,
+                'create_user_max_concurrent': flask_config_dev.create_user_max_concurrent,
+                'create_user_max_waiting': flask_config_dev.create_user_max_waiting,
+                'create_user_wait_timeout': flask_config_dev.create_user_wait_timeout,
+                'create_user_rate': flask_config_dev.create_user_rate,
+                'create_user_burst': flask_config_dev.create_user_burst,
+                'trusted_proxy_hops': flask_config_dev.trusted_proxy_hops,
+                'password_hash_iterations': flask_config_dev.password_hash_iterations,
+                'password_hash_processes': flask_config_dev.password_hash_processes,
+                'compression_minimum_size': flask_config_dev.compression_minimum_size,
+                'compression_gzip_level': flask_config_dev.compression_gzip_level,
+                'compression_brotli_quality': flask_config_dev.compression_brotli_quality,
             },
             'prod': {
                 'baseurl': flask_config_prod.baseurl,
@@ -78,6 +110,19 @@ def flask_prod_helmfile_values_factory(*, context):
                     'user': flask_config_prod.database_admin_user,
                     'password': flask_config_prod.database_admin_password,
                 },
+                'cache_control': flask_config_prod.cache_control,
+                'cors_max_age': flask_config_prod.cors_max_age,
+                'create_user_max_concurrent': flask_config_prod.create_user_max_concurrent,
+                'create_user_max_waiting': flask_config_prod.create_user_max_waiting,
+                'create_user_wait_timeout': flask_config_prod.create_user_wait_timeout,
+                'create_user_rate': flask_config_prod.create_user_rate,
+                'create_user_burst': flask_config_prod.create_user_burst,
+                'trusted_proxy_hops': flask_config_prod.trusted_proxy_hops,
+                'password_hash_iterations': flask_config_prod.password_hash_iterations,
+                'password_hash_processes': flask_config_prod.password_hash_processes,
+                'compression_minimum_size': flask_config_prod.compression_minimum_size,
+                'compression_gzip_level': flask_config_prod.compression_gzip_level,
+                'compression_brotli_quality': flask_config_prod.compression_brotli_quality,
             },
         }
     }
@@ -93,22 +138,247 @@ def ecr_helmfile_values_factory(*, context):
         }
 
 
-task_helmfile_migraine_apply = aws_infrastructure.tasks.library.instance_helmfile.task_helmfile_apply(
-    config_key=CONFIG_KEY,
-    ssh_config_path=SSH_CONFIG_PATH,
-    staging_local_dir=STAGING_LOCAL_HELMFILE_DIR,
-    staging_remote_dir=STAGING_REMOTE_HELMFILE_DIR,
-    helmfile_path=HELMFILE_PATH,
-    helmfile_config_path=HELMFILE_CONFIG_PATH,
-    helmfile_values_factories={
-        'ecr_generated': ecr_helmfile_values_factory,
-        'secrets_couchdb_dev_generated': couchdb_dev_helmfile_values_factory,
-        'secrets_couchdb_prod_generated': couchdb_prod_helmfile_values_factory,
-        'secrets_flask_prod_generated': flask_prod_helmfile_values_factory,
-    },
-)
-task_helmfile_migraine_apply.__doc__ = 'Apply helmfile/helmfile.yaml in the instance.'
+HELMFILE_VALUES_FACTORIES = {
+    'ecr_generated': ecr_helmfile_values_factory,
+    'secrets_couchdb_dev_generated': couchdb_dev_helmfile_values_factory,
+    'secrets_couchdb_prod_generated': couchdb_prod_helmfile_values_factory,
+    'secrets_flask_prod_generated': flask_prod_helmfile_values_factory,
+}
+
+
+def _helmfile_values(*, context) -> Dict[str, Dict]:
+    """
+    Compute helmfile values concurrently, as several factories read Terraform outputs or configuration.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(HELMFILE_VALUES_FACTORIES)) as executor:
+        futures = {
+            key: executor.submit(factory, context=context)
+            for (key, factory) in HELMFILE_VALUES_FACTORIES.items()
+        }
+
+    return {key: future.result() for (key, future) in futures.items()}
+
+
+def _stage(*, context) -> Dict[str, str]:
+    """
+    Stage the helmfile, its dependencies, and its generated values, writing only files whose content changed.
+
+    Returns the manifest of the staged files.
+    """
+    yaml = ruamel.yaml.YAML(typ='safe', pure=True)
+
+    with open(HELMFILE_CONFIG_PATH) as helmfile_config_file:
+        helmfile_config = yaml.load(helmfile_config_file)
+    helmfile_config_dir = Path(HELMFILE_CONFIG_PATH).parent
+
+    staging_dir = Path(STAGING_LOCAL_HELMFILE_DIR)
+    staged = []
+
+    helmfile_name = Path(helmfile_config['helmfile']).name
+    tasks.staging.write_if_changed(
+        path=Path(staging_dir, helmfile_name),
+        content=Path(helmfile_config_dir, helmfile_config['helmfile']).read_bytes(),
+    )
+    staged.append(helmfile_name)
+
+    for dependency in helmfile_config.get('dependencies', []):
+        destination = Path(dependency['destination']).as_posix()
+        tasks.staging.write_if_changed(
+            path=Path(staging_dir, destination),
+            content=Path(helmfile_config_dir, dependency['file']).read_bytes(),
+        )
+        staged.append(destination)
+
+    for (key, values) in _helmfile_values(context=context).items():
+        destination = 'values/{}.values.yaml'.format(key)
+        values_stream = io.StringIO()
+        yaml.dump(values, values_stream)
+
+        # Values include secrets, so are readable only by their owner
+        tasks.staging.write_if_changed(
+            path=Path(staging_dir, destination),
+            content=values_stream.getvalue().encode('utf-8'),
+            mode=0o600,
+        )
+        staged.append(destination)
+
+    tasks.staging.remove_except(path=staging_dir, retain=staged)
+
+    return tasks.staging.manifest(staging_dir)
+
+
+def _instance_host_keys(*, host: str) -> List[str]:
+    """
+    Obtain the SSH host keys of the instance with public IP host, as `<type> <key>`, from its console output.
+
+    The console output is obtained through the AWS API, so its keys are trusted where a key offered over SSH is not.
+    """
+    ec2_client = boto3.client('ec2')
+
+    addresses = ec2_client.describe_addresses(PublicIps=[host])['Addresses']
+    instance_ids = [address['InstanceId'] for address in addresses if 'InstanceId' in address]
+    if not instance_ids:
+        raise RuntimeError('No instance is associated with {}.'.format(host))
+
+    console_output = ec2_client.get_console_output(InstanceId=instance_ids[0]).get('Output', '')
+    match = CONSOLE_HOST_KEYS_PATTERN.search(console_output)
+    if not match:
+        raise RuntimeError('Host keys not found in console output of {}, retry once it has booted.'.format(instance_ids[0]))
+
+    # Each line is `<type> <key> <comment>`.
+    return [
+        ' '.join(line.split()[:2])
+        for line in match.group(1).splitlines()
+        if len(line.split()) >= 2
+    ]
+
+
+def _pin_host_keys(*, ssh_config: aws_infrastructure.tasks.ssh.SSHConfig):
+    """
+    Write the host keys of the instance to the known_hosts alongside the SSH config.
+    """
+    host_keys = _instance_host_keys(host=ssh_config.host)
+
+    known_host = ssh_config.host if ssh_config.port == 22 else '[{}]:{}'.format(ssh_config.host, ssh_config.port)
+    with open(SSH_KNOWN_HOSTS_PATH, 'w') as known_hosts_file:
+        for host_key in host_keys:
+            known_hosts_file.write('{} {}\n'.format(known_host, host_key))
+
+    print('Pinned {} host key(s) of {} in {}.'.format(len(host_keys), known_host, SSH_KNOWN_HOSTS_PATH))
+
+
+def _ssh_client() -> paramiko.SSHClient:
+    """
+    Connect to the instance, as described by its SSH config.
+
+    The host key must be known, either to the user or in a known_hosts alongside the SSH config.
+    That known_hosts is pinned from the console output of the instance if it does not exist.
+    An unknown host key is rejected rather than trusted, as the connection transfers secrets.
+    """
+    ssh_config = aws_infrastructure.tasks.ssh.SSHConfig.load(ssh_config_path=SSH_CONFIG_PATH)
+    if not SSH_KNOWN_HOSTS_PATH.exists():
+        _pin_host_keys(ssh_config=ssh_config)
+
+    ssh_client = paramiko.SSHClient()
+    ssh_client.load_system_host_keys()
+    if SSH_KNOWN_HOSTS_PATH.exists():
+        ssh_client.load_host_keys(str(SSH_KNOWN_HOSTS_PATH))
+    ssh_client.set_missing_host_key_policy(paramiko.RejectPolicy())
+    ssh_client.connect(
+        hostname=ssh_config.host,
+        port=ssh_config.port,
+        username=ssh_config.user,
+        key_filename=str(ssh_config.key_filename),
+    )
+
+    return ssh_client
+
+
+def _ssh_exec(*, ssh_client: paramiko.SSHClient, command: str, stdin: Optional[bytes] = None, echo: bool = False) -> bytes:
+    channel = ssh_client.get_transport().open_session()
+    channel.set_combine_stderr(True)
+    channel.exec_command(command)
+
+    if stdin is not None:
+        channel.sendall(stdin)
+    channel.shutdown_write()
+
+    output = io.BytesIO()
+    for chunk in iter(lambda: channel.recv(32 * 1024), b''):
+        output.write(chunk)
+        if echo:
+            sys.stdout.write(chunk.decode('utf-8', errors='replace'))
+            sys.stdout.flush()
+
+    exit_status = channel.recv_exit_status()
+    if exit_status != 0:
+        raise RuntimeError('Remote command failed with exit status {}: {}'.format(exit_status, command))
+
+    return output.getvalue()
+
+
+def _sync(*, ssh_client: paramiko.SSHClient, local_manifest: Dict[str, str], full: bool):
+    """
+    Transfer staged files whose content differs from the remote manifest, as a single compressed archive.
+    """
+    remote_dir = shlex.quote(STAGING_REMOTE_HELMFILE_DIR)
+
+    remote_manifest = {}
+    if not full:
+        remote_manifest_bytes = _ssh_exec(
+            ssh_client=ssh_client,
+            command='cat {}/{} 2>/dev/null || true'.format(remote_dir, tasks.staging.MANIFEST_NAME),
+        )
+        try:
+            remote_manifest = json.loads(remote_manifest_bytes) if remote_manifest_bytes.strip() else {}
+        except ValueError:
+            remote_manifest = {}
+
+    changed = tasks.staging.changed_paths(local_manifest=local_manifest, remote_manifest=remote_manifest)
+    removed = tasks.staging.removed_paths(local_manifest=local_manifest, remote_manifest=remote_manifest)
+    if not changed and not removed:
+        print('Helmfile staging is current, no files transferred.')
+        return
+
+    archive = tasks.staging.archive(
+        path=Path(STAGING_LOCAL_HELMFILE_DIR),
+        relative_paths=changed,
+        manifest_current=local_manifest,
+    )
+    print('Transferring {} changed file(s) ({} bytes compressed), removing {} file(s).'.format(
+        len(changed),
+        len(archive),
+        len(removed),
+    ))
+
+    commands = ['mkdir -p {}'.format(remote_dir), 'cd {}'.format(remote_dir)]
+    if full:
+        commands.append('find . -mindepth 1 -delete')
+    if removed:
+        commands.append('rm -f -- {}'.format(' '.join(shlex.quote(path) for path in removed)))
+    commands.append('tar -xzf -')
+    _ssh_exec(ssh_client=ssh_client, command=' && '.join(commands), stdin=archive)
+
+
+@task
+def task_helmfile_migraine_apply(context, full=False):
+    """
+    Apply helmfile/helmfile.yaml in the instance.
+
+    Only staged files that changed since the previous apply are transferred. With `--full`, every file is transferred.
+    """
+
+    local_manifest = _stage(context=context)
+
+    ssh_client = _ssh_client()
+    try:
+        _sync(ssh_client=ssh_client, local_manifest=local_manifest, full=full)
+
+        helmfile_name = Path(HELMFILE_PATH).name
+        _ssh_exec(
+            ssh_client=ssh_client,
+            command='cd {} && helmfile --file {} apply'.format(
+                shlex.quote(STAGING_REMOTE_HELMFILE_DIR),
+                shlex.quote(helmfile_name),
+            ),
+            echo=True,
+        )
+    finally:
+        ssh_client.close()
+
+
+@task
+def task_helmfile_pin_host_key(context):
+    """
+    Pin the SSH host keys of the instance, as printed to its console output when it was created.
+
+    Run again after the instance is replaced, as its host keys then change.
+    """
+
+    ssh_config = aws_infrastructure.tasks.ssh.SSHConfig.load(ssh_config_path=SSH_CONFIG_PATH)
+    _pin_host_keys(ssh_config=ssh_config)
 
 
 ns = Collection('helmfile')
 ns.add_task(task_helmfile_migraine_apply, 'apply')
+ns.add_task(task_helmfile_pin_host_key, 'pin-host-key')
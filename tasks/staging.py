@@ -0,0 +1,107 @@
+"""
+Helpers for content-addressed staging, so unchanged files are neither rebuilt nor transferred.
+
+A manifest maps the path of each staged file, relative to its staging directory, to a hash of its content.
+"""
+
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import tarfile
+from typing import Dict, Iterable, List
+
+MANIFEST_NAME = '.manifest.json'
+
+
+def hash_file(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def hash_dir(path: Path) -> str:
+    """
+    Obtain a hash of every file within a directory, including their relative paths.
+    """
+    digest = hashlib.sha256()
+    for (relative_path, file_hash) in sorted(manifest(path).items()):
+        digest.update('{}\0{}\0'.format(relative_path, file_hash).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def manifest(path: Path) -> Dict[str, str]:
+    """
+    Obtain a manifest of the files within a directory, excluding any manifest.
+    """
+    return {
+        file_path.relative_to(path).as_posix(): hash_file(file_path)
+        for file_path in sorted(Path(path).rglob('*'))
+        if file_path.is_file() and file_path.name != MANIFEST_NAME
+    }
+
+
+def write_if_changed(*, path: Path, content: bytes, mode: int = 0o644) -> bool:
+    """
+    Write a staged file only if its content differs, so its modification time reflects its content.
+
+    Returns whether the file was written.
+    """
+    path = Path(path)
+    if path.is_file() and path.read_bytes() == content:
+        return False
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = path.with_name('{}.tmp'.format(path.name))
+    with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'wb') as temp_file:
+        temp_file.write(content)
+    os.replace(temp_path, path)
+
+    return True
+
+
+def remove_except(*, path: Path, retain: Iterable[str]):
+    """
+    Remove staged files not retained, given as paths relative to the staging directory.
+    """
+    retain = set(retain) | {MANIFEST_NAME}
+    for file_path in sorted(Path(path).rglob('*'), reverse=True):
+        if file_path.is_file() and file_path.relative_to(path).as_posix() not in retain:
+            file_path.unlink()
+        elif file_path.is_dir() and not any(file_path.iterdir()):
+            file_path.rmdir()
+
+
+def changed_paths(*, local_manifest: Dict[str, str], remote_manifest: Dict[str, str]) -> List[str]:
+    return sorted(
+        relative_path
+        for (relative_path, file_hash) in local_manifest.items()
+        if remote_manifest.get(relative_path) != file_hash
+    )
+
+
+def removed_paths(*, local_manifest: Dict[str, str], remote_manifest: Dict[str, str]) -> List[str]:
+    return sorted(set(remote_manifest.keys()) - set(local_manifest.keys()))
+
+
+def archive(*, path: Path, relative_paths: Iterable[str], manifest_current: Dict[str, str]) -> bytes:
+    """
+    Obtain a compressed archive of staged files, together with the manifest after extraction.
+    """
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for relative_path in relative_paths:
+            tar.add(Path(path, relative_path), arcname=relative_path)
+
+        manifest_bytes = json.dumps(manifest_current, indent=2, sort_keys=True).encode('utf-8')
+        manifest_info = tarfile.TarInfo(MANIFEST_NAME)
+        manifest_info.size = len(manifest_bytes)
+        manifest_info.mode = 0o600
+        tar.addfile(manifest_info, io.BytesIO(manifest_bytes))
+
+    return buffer.getvalue()
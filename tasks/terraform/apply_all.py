@@ -0,0 +1,277 @@
+"""
+Apply every Terraform module, concurrently where dependencies allow.
+
+A module depends on each module whose outputs are read by its variables factory,
+which are found in the source of the factory rather than maintained separately.
+A module is planned only after its dependencies complete, so its plan includes their changes.
+A module whose plan reports no changes is skipped.
+A module with changes applies exactly its saved plan, and only if approved with `--auto-approve`.
+
+Variables are written to the same `variables.generated.tfvars` of a module as `invoke <module>.apply`.
+Unlike `invoke <module>.apply`, which plans and applies in one step, each module applies its saved plan.
+"""
+
+import ast
+import concurrent.futures
+from dataclasses import dataclass
+from invoke import task
+from invoke.context import Context
+import inspect
+import json
+from pathlib import Path
+import textwrap
+import threading
+import time
+from types import ModuleType
+from typing import Callable, Dict, List, Optional
+
+import tasks.terraform.dns
+import tasks.terraform.ecr
+import tasks.terraform.eip
+import tasks.terraform.eip_worker
+import tasks.terraform.instance
+import tasks.terraform.instance_worker
+
+STAGING_LOCAL_DIR = './.staging/terraform_apply_all'
+
+# Package of the Terraform modules, whose outputs a variables factory reads as `tasks.terraform.<module>.<read_only>`.
+TERRAFORM_PACKAGE = 'tasks.terraform'
+
+# Exit codes of `terraform plan -detailed-exitcode`.
+PLAN_NO_CHANGES = 0
+PLAN_CHANGES = 2
+
+# States in which a module is complete.
+COMPLETE_STATES = ['applied', 'unchanged', 'changes planned']
+
+
+@dataclass(frozen=True)
+class TerraformModule:
+    name: str
+    terraform_bin: str
+    terraform_dir: str
+    terraform_variables_factory: Optional[Callable]
+    """
+    Factory of variables provided to Terraform, if any.
+    """
+    terraform_variables_path: Optional[Path]
+    """
+    Path to which variables are written, shared with `invoke <module>.apply`.
+    """
+    dependencies: List[str]
+    """
+    Modules whose outputs are read by the variables factory.
+    """
+
+
+def _factory_dependencies(*, terraform_variables_factory: Optional[Callable]) -> List[str]:
+    """
+    Obtain the modules whose outputs a variables factory reads, from each `tasks.terraform.<module>` in its source.
+    """
+    if terraform_variables_factory is None:
+        return []
+
+    tree = ast.parse(textwrap.dedent(inspect.getsource(terraform_variables_factory)))
+
+    dependencies = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Attribute) and ast.unparse(node.value) == TERRAFORM_PACKAGE:
+            dependencies.add(node.attr)
+
+    return sorted(dependencies)
+
+
+def _terraform_module(module: ModuleType) -> TerraformModule:
+    terraform_variables_factory = getattr(module, 'terraform_variables_factory', None)
+
+    return TerraformModule(
+        name=module.__name__.rsplit('.', 1)[-1],
+        terraform_bin=module.TERRAFORM_BIN,
+        terraform_dir=module.TERRAFORM_DIR,
+        terraform_variables_factory=terraform_variables_factory,
+        terraform_variables_path=getattr(module, 'TERRAFORM_VARIABLES_PATH', None),
+        dependencies=_factory_dependencies(terraform_variables_factory=terraform_variables_factory),
+    )
+
+
+TERRAFORM_MODULES = [
+    _terraform_module(tasks.terraform.dns),
+    _terraform_module(tasks.terraform.ecr),
+    _terraform_module(tasks.terraform.eip),
+    _terraform_module(tasks.terraform.eip_worker),
+    _terraform_module(tasks.terraform.instance),
+    _terraform_module(tasks.terraform.instance_worker),
+]
+
+
+class Progress:
+    """
+    Combined progress of modules, reported one line at a time.
+    """
+
+    def __init__(self, *, names: List[str]):
+        self._lock = threading.Lock()
+        self._states = {name: 'waiting' for name in names}
+        self._start = time.monotonic()
+
+    def update(self, *, name: str, state: str):
+        with self._lock:
+            self._states[name] = state
+            complete = sum(1 for state_current in self._states.values() if state_current in COMPLETE_STATES)
+            print('[{:>4.0f}s {}/{}] {}: {}'.format(
+                time.monotonic() - self._start,
+                complete,
+                len(self._states),
+                name,
+                state,
+            ), flush=True)
+
+    @property
+    def states(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self._states)
+
+
+def _module_context(*, context: Context, log_file) -> Context:
+    """
+    Obtain a context for one module, writing its output to its log.
+
+    Modules are planned concurrently, so none can read from the terminal.
+    """
+    config = context.config.clone()
+    config.run.out_stream = log_file
+    config.run.err_stream = log_file
+    config.run.in_stream = False
+    config.run.env = dict(config.run.env, TF_INPUT='0')
+
+    return Context(config=config)
+
+
+def _plan_path(*, module: TerraformModule, staging_dir: Path) -> Path:
+    return Path(staging_dir, '{}.tfplan'.format(module.name)).resolve()
+
+
+def _plan(*, context: Context, module: TerraformModule, staging_dir: Path) -> int:
+    """
+    Plan a module, saving its plan so an apply performs exactly the changes that were planned.
+    """
+    terraform_bin = Path(module.terraform_bin).resolve()
+    command = [
+        str(terraform_bin),
+        'plan',
+        '-detailed-exitcode',
+        '-input=false',
+        '-out="{}"'.format(_plan_path(module=module, staging_dir=staging_dir)),
+    ]
+
+    if module.terraform_variables_factory:
+        # Each value is written as JSON, which is also a valid Terraform expression.
+        variables_path = Path(module.terraform_variables_path).resolve()
+        variables = module.terraform_variables_factory(context=context)
+        with open(variables_path, 'w') as variables_file:
+            for (key, value) in sorted(variables.items()):
+                variables_file.write('{} = {}\n'.format(key, json.dumps(value)))
+        command.append('-var-file="{}"'.format(variables_path))
+
+    with context.cd(module.terraform_dir):
+        context.run(command='{} init -input=false'.format(terraform_bin))
+        result = context.run(command=' '.join(command), warn=True)
+
+    return result.exited
+
+
+def _apply_plan(*, context: Context, module: TerraformModule, staging_dir: Path):
+    """
+    Apply the saved plan of a module, which fails rather than re-planning if state changed since the plan.
+    """
+    terraform_bin = Path(module.terraform_bin).resolve()
+
+    with context.cd(module.terraform_dir):
+        context.run(command='{} apply -input=false "{}"'.format(
+            terraform_bin,
+            _plan_path(module=module, staging_dir=staging_dir),
+        ))
+
+
+def _apply_module(*, context: Context, module: TerraformModule, staging_dir: Path, progress: Progress, auto_approve: bool):
+    with open(Path(staging_dir, '{}.log'.format(module.name)), 'w') as log_file:
+        module_context = _module_context(context=context, log_file=log_file)
+
+        progress.update(name=module.name, state='planning')
+        exited = _plan(context=module_context, module=module, staging_dir=staging_dir)
+        if exited == PLAN_NO_CHANGES:
+            progress.update(name=module.name, state='unchanged')
+            return
+        if exited != PLAN_CHANGES:
+            raise RuntimeError('Plan of {} failed, see {}'.format(module.name, log_file.name))
+        if not auto_approve:
+            progress.update(name=module.name, state='changes planned')
+            return
+
+        progress.update(name=module.name, state='applying')
+        _apply_plan(context=module_context, module=module, staging_dir=staging_dir)
+        progress.update(name=module.name, state='applied')
+
+
+@task
+def apply_all(context, parallel=4, auto_approve=False):
+    """
+    Plan every Terraform module, applying with `--auto-approve`, concurrently where dependencies allow.
+
+    Without `--auto-approve`, modules are planned but not applied, so review each plan in its log.
+    Dependent modules are then planned against current outputs.
+    With `--auto-approve`, each module with changes applies exactly its saved plan.
+    Output of each module is written to `.staging/terraform_apply_all/<module>.log`.
+    """
+
+    staging_dir = Path(STAGING_LOCAL_DIR)
+    staging_dir.mkdir(parents=True, exist_ok=True)
+
+    modules = {module.name: module for module in TERRAFORM_MODULES}
+    for module in modules.values():
+        unknown = [dependency for dependency in module.dependencies if dependency not in modules]
+        if unknown:
+            raise ValueError('Module {} depends on unknown modules: {}'.format(module.name, ', '.join(unknown)))
+    progress = Progress(names=list(modules.keys()))
+
+    pending = dict(modules)
+    running: Dict[concurrent.futures.Future, str] = {}
+    completed = set()
+    failed = set()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=int(parallel)) as executor:
+        while pending or running:
+            # Start every module whose dependencies have completed.
+            for (name, module) in list(pending.items()):
+                if any(dependency in failed for dependency in module.dependencies):
+                    del pending[name]
+                    failed.add(name)
+                    progress.update(name=name, state='skipped, a dependency failed')
+                elif all(dependency in completed for dependency in module.dependencies):
+                    del pending[name]
+                    running[executor.submit(
+                        _apply_module,
+                        context=context,
+                        module=module,
+                        staging_dir=staging_dir,
+                        progress=progress,
+                        auto_approve=auto_approve,
+                    )] = name
+
+            if not running:
+                break
+
+            done, _ = concurrent.futures.wait(running.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                if future.exception():
+                    failed.add(name)
+                    progress.update(name=name, state='failed: {}'.format(future.exception()))
+                else:
+                    completed.add(name)
+
+    for (name, state) in progress.states.items():
+        print('{:<16} {}'.format(name, state))
+
+    if failed:
+        raise RuntimeError('Failed to apply: {}'.format(', '.join(sorted(failed))))
@@ -3,9 +3,12 @@ import aws_infrastructure.tasks.library.ecr
 import aws_infrastructure.tasks.library.terraform
 from invoke import Collection
 
+import tasks.terraform.output_cache
+
 CONFIG_KEY = 'ecr'
 TERRAFORM_BIN = './bin/terraform.exe'
 TERRAFORM_DIR = './terraform/terraform_ecr'
+OUTPUT_CACHE_MAX_AGE = 60 * 60  # Registry passwords are valid for 12 hours
 
 ns = Collection('ecr')
 
@@ -31,6 +34,15 @@ compose_collection(
     )
 )
 
-ecr_read_only = aws_infrastructure.tasks.library.ecr.create_ecr_read_only(
+ecr_read_only_uncached = aws_infrastructure.tasks.library.ecr.create_ecr_read_only(
     ns_ecr=ns_ecr
 )
+
+# Outputs are cached until state changes.
+# The registry password is obtained on each read and expires, so it is cached only briefly.
+ecr_read_only = tasks.terraform.output_cache.create_cached_read_only(
+    name=CONFIG_KEY,
+    terraform_dir=TERRAFORM_DIR,
+    read_only=ecr_read_only_uncached,
+    max_age=OUTPUT_CACHE_MAX_AGE,
+)
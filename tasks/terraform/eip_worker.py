@@ -3,6 +3,8 @@ import aws_infrastructure.tasks.library.eip
 import aws_infrastructure.tasks.library.terraform
 from invoke import Collection
 
+import tasks.terraform.output_cache
+
 CONFIG_KEY = 'eip_worker'
 TERRAFORM_BIN = './bin/terraform.exe'
 TERRAFORM_DIR = './terraform/terraform_eip_worker'
@@ -31,6 +33,13 @@ compose_collection(
     )
 )
 
-eip_read_only = aws_infrastructure.tasks.library.eip.create_eip_read_only(
+eip_read_only_uncached = aws_infrastructure.tasks.library.eip.create_eip_read_only(
     ns_eip=ns_eip
 )
+
+# Outputs are cached until state changes.
+eip_read_only = tasks.terraform.output_cache.create_cached_read_only(
+    name=CONFIG_KEY,
+    terraform_dir=TERRAFORM_DIR,
+    read_only=eip_read_only_uncached,
+)
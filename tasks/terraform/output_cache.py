@@ -0,0 +1,121 @@
+"""
+Cache of Terraform outputs, so tasks that only read outputs do not invoke Terraform on every run.
+
+Outputs are cached in the staging directory, keyed by a hash of the Terraform state file.
+A change in state (e.g., an apply or a destroy) therefore invalidates the cache.
+Outputs that are not part of the state (e.g., a registry password obtained on each read)
+are additionally limited to a maximum age.
+"""
+
+import contextlib
+import hashlib
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from types import SimpleNamespace
+from typing import Callable, Dict, Optional
+
+STAGING_CACHE_DIR = './.staging/terraform_output_cache'
+TERRAFORM_STATE_FILE = 'terraform.tfstate'
+
+# Serialize each cache, so concurrent readers invoke Terraform at most once.
+_locks: Dict[str, threading.Lock] = {}
+_locks_lock = threading.Lock()
+
+
+def _lock(name: str) -> threading.Lock:
+    with _locks_lock:
+        return _locks.setdefault(name, threading.Lock())
+
+
+def state_hash(*, terraform_dir: str) -> Optional[str]:
+    """
+    Obtain a hash of the Terraform state, or None if there is no local state.
+    """
+    try:
+        with open(Path(terraform_dir, TERRAFORM_STATE_FILE), 'rb') as state_file:
+            return hashlib.sha256(state_file.read()).hexdigest()
+    except FileNotFoundError:
+        return None
+
+
+def _output_as_dict(output) -> Dict:
+    if hasattr(output, '_asdict'):
+        return dict(output._asdict())
+    if isinstance(output, dict):
+        return dict(output)
+
+    return dict(vars(output))
+
+
+def _load(*, cache_path: Path, state_hash_current: str, max_age: Optional[float]) -> Optional[Dict]:
+    try:
+        with open(cache_path) as cache_file:
+            cached = json.load(cache_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+    if cached.get('state_hash') != state_hash_current:
+        return None
+    if max_age is not None and time.time() - cached.get('time', 0) > max_age:
+        return None
+
+    return cached['output']
+
+
+def _store(*, cache_path: Path, state_hash_current: str, output: Dict):
+    cache_path.parent.mkdir(parents=True, exist_ok=True)
+
+    # Outputs may include credentials, so the cache is readable only by its owner.
+    temp_path = cache_path.with_suffix('.tmp')
+    with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as cache_file:
+        json.dump(
+            {
+                'state_hash': state_hash_current,
+                'time': time.time(),
+                'output': output,
+            },
+            cache_file,
+            indent=2,
+            sort_keys=True,
+        )
+    os.replace(temp_path, cache_path)
+
+
+def create_cached_read_only(
+    *,
+    name: str,
+    terraform_dir: str,
+    read_only: Callable,
+    max_age: Optional[float] = None,
+):
+    """
+    Create a context manager equivalent to read_only, but providing cached outputs where possible.
+
+    Only outputs are cached, so the context provides only its output.
+    """
+
+    cache_path = Path(STAGING_CACHE_DIR, '{}.json'.format(name))
+
+    @contextlib.contextmanager
+    def cached_read_only(*, context):
+        with _lock(name):
+            state_hash_current = state_hash(terraform_dir=terraform_dir)
+
+            output = None
+            if state_hash_current is not None:
+                output = _load(cache_path=cache_path, state_hash_current=state_hash_current, max_age=max_age)
+
+            if output is None:
+                with read_only(context=context) as read_only_context:
+                    output = _output_as_dict(read_only_context.output)
+
+                # State may have changed while reading outputs, in which case they are not cached.
+                if state_hash_current is not None and state_hash_current == state_hash(terraform_dir=terraform_dir):
+                    _store(cache_path=cache_path, state_hash_current=state_hash_current, output=output)
+
+        yield SimpleNamespace(output=SimpleNamespace(**output))
+
+    return cached_read_only
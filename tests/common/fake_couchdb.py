@@ -0,0 +1,204 @@
+"""
+In-memory CouchDB clusters, for testing routing between clusters without deploying several clusters.
+
+Serves only the requests used in routing between clusters, following the CouchDB semantics they rely on.
+"""
+
+import json
+import requests
+import requests.adapters
+import requests.structures
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl, unquote, urlsplit
+
+
+class FakeCluster:
+    """
+    Databases of a cluster, each a dictionary from document id to document.
+    """
+
+    def __init__(self):
+        self.databases: Dict[str, Dict[str, dict]] = {"_users": {}}
+        self.security: Dict[str, dict] = {}
+        self._revision = 0
+
+    def put_document(self, *, database: str, doc_id: str, doc: dict) -> str:
+        self._revision += 1
+        rev = "{}-fake".format(self._revision)
+        self.databases[database][doc_id] = dict(doc, _id=doc_id, _rev=rev)
+
+        return rev
+
+    def live_documents(self, *, database: str) -> Dict[str, dict]:
+        return {
+            doc_id: doc
+            for (doc_id, doc) in self.databases[database].items()
+            if not doc.get("_deleted")
+        }
+
+
+def _baseurl(url: str) -> str:
+    url = urlsplit(url)
+    return "{}://{}/".format(url.scheme, url.netloc)
+
+
+def _database_from_url(url: str) -> str:
+    return unquote(urlsplit(url).path.strip("/"))
+
+
+class FakeCouchDBAdapter(requests.adapters.BaseAdapter):
+    """
+    Transport serving requests to each cluster from memory.
+    """
+
+    def __init__(self, *, clusters: Dict[str, FakeCluster]):
+        super().__init__()
+        self.clusters = clusters
+
+    def close(self):
+        pass
+
+    def send(self, request, **kwargs):
+        url = urlsplit(request.url)
+        cluster = self.clusters[_baseurl(request.url)]
+        path = [unquote(segment) for segment in url.path.split("/")[1:] if segment]
+        params = {key: json.loads(value) for (key, value) in parse_qsl(url.query)}
+        body = json.loads(request.body) if request.body else None
+
+        status_code, content, headers = self._handle(
+            cluster=cluster,
+            method=request.method,
+            path=path,
+            params=params,
+            body=body,
+        )
+
+        response = requests.Response()
+        response.status_code = status_code
+        response._content = json.dumps(content).encode("utf-8") if request.method != "HEAD" else b""
+        response.headers = requests.structures.CaseInsensitiveDict(headers or {})
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+
+        return response
+
+    def _handle(
+        self,
+        *,
+        cluster: FakeCluster,
+        method: str,
+        path: List[str],
+        params: Dict,
+        body: Optional[Dict],
+    ) -> Tuple[int, object, Optional[Dict]]:
+        if path == ["_all_dbs"]:
+            return 200, self._key_range(sorted(cluster.databases.keys()), params=params), None
+        if path == ["_dbs_info"]:
+            return 200, [
+                {"key": key, "info": {"db_name": key, "doc_count": len(cluster.live_documents(database=key))}}
+                if key in cluster.databases else {"key": key, "error": "not_found"}
+                for key in body["keys"]
+            ], None
+        if path == ["_replicate"]:
+            return self._replicate(cluster=cluster, body=body)
+
+        database = path[0]
+        if len(path) == 1:
+            if method == "PUT":
+                if database in cluster.databases:
+                    return 412, {"error": "file_exists"}, None
+                cluster.databases[database] = {}
+                return 201, {"ok": True}, None
+            if database not in cluster.databases:
+                return 404, {"error": "not_found"}, None
+            if method == "DELETE":
+                del cluster.databases[database]
+                cluster.security.pop(database, None)
+            return 200, {"db_name": database}, None
+
+        if database not in cluster.databases:
+            return 404, {"error": "not_found"}, None
+        documents = cluster.databases[database]
+
+        if path[1] == "_security":
+            if method == "PUT":
+                cluster.security[database] = body
+                return 200, {"ok": True}, None
+            return 200, cluster.security.get(database, {}), None
+
+        if path[1] == "_all_docs":
+            if method == "POST":
+                return 200, {"rows": [
+                    {"id": key, "key": key, "value": {"rev": documents[key]["_rev"], "deleted": True}}
+                    if key in documents and documents[key].get("_deleted") else
+                    {"id": key, "key": key, "value": {"rev": documents[key]["_rev"]}}
+                    if key in documents else
+                    {"key": key, "error": "not_found"}
+                    for key in body["keys"]
+                ]}, None
+            doc_ids = self._key_range(sorted(cluster.live_documents(database=database).keys()), params=params)
+            return 200, {"rows": [
+                {"id": doc_id, "key": doc_id, "value": {"rev": documents[doc_id]["_rev"]}}
+                for doc_id in doc_ids
+            ]}, None
+
+        doc_id = "/".join(path[1:])
+        document = cluster.live_documents(database=database).get(doc_id)
+        if method == "PUT":
+            if document is not None:
+                return 409, {"error": "conflict"}, None
+            rev = cluster.put_document(database=database, doc_id=doc_id, doc=body)
+            return 201, {"ok": True, "id": doc_id, "rev": rev}, None
+        if document is None:
+            return 404, {"error": "not_found"}, None
+        if method == "DELETE":
+            rev = cluster.put_document(database=database, doc_id=doc_id, doc={"_deleted": True})
+            return 200, {"ok": True, "id": doc_id, "rev": rev}, None
+        return 200, document, {"ETag": '"{}"'.format(document["_rev"])}
+
+    @staticmethod
+    def _key_range(keys: List[str], *, params: Dict) -> List[str]:
+        keys = [
+            key for key in keys
+            if params.get("startkey", key) <= key <= params.get("endkey", key)
+        ]
+
+        return keys[:params["limit"]] if "limit" in params else keys
+
+    def _replicate(self, *, cluster: FakeCluster, body: Dict) -> Tuple[int, object, Optional[Dict]]:
+        source_cluster = self.clusters[_baseurl(body["source"]["url"])]
+        source_database = _database_from_url(body["source"]["url"])
+        target_cluster = self.clusters[_baseurl(body["target"]["url"])]
+        target_database = _database_from_url(body["target"]["url"])
+
+        if source_database not in source_cluster.databases:
+            return 404, {"error": "not_found"}, None
+        if target_database not in target_cluster.databases:
+            if not body.get("create_target"):
+                return 404, {"error": "not_found"}, None
+            target_cluster.databases[target_database] = {}
+
+        doc_ids = body.get("doc_ids", source_cluster.databases[source_database].keys())
+        for doc_id in doc_ids:
+            if doc_id in source_cluster.databases[source_database]:
+                target_cluster.databases[target_database][doc_id] = dict(
+                    source_cluster.databases[source_database][doc_id]
+                )
+
+        return 200, {"ok": True}, None
+
+
+def fake_couchdb_session(*, baseurls: List[str]) -> Tuple[requests.Session, Dict[str, FakeCluster]]:
+    """
+    Obtain a session whose requests to each baseurl are served by an in-memory cluster, together with the clusters.
+    """
+
+    clusters = {baseurl: FakeCluster() for baseurl in baseurls}
+    adapter = FakeCouchDBAdapter(clusters=clusters)
+
+    session = requests.Session()
+    for baseurl in baseurls:
+        session.mount(baseurl, adapter)
+
+    return session, clusters
@@ -0,0 +1,59 @@
+"""
+Tests for JSON encoding and decoding, with and without orjson.
+"""
+
+import pytest
+
+import migraine_shared.codec
+
+
+@pytest.fixture(params=["orjson", "json"])
+def codec(request, monkeypatch):
+    if request.param == "orjson":
+        if migraine_shared.codec.orjson is None:
+            pytest.skip("orjson is not installed")
+    else:
+        monkeypatch.setattr(migraine_shared.codec, "orjson", None)
+
+    return migraine_shared.codec
+
+
+def test_round_trip(codec):
+    obj = {
+        "user_name": "account",
+        "unicode": "café ☃ \U0001f600",
+        "numbers": [0, -1, 2 ** 53, 1.5],
+        "nested": {"empty": {}, "list": [], "null": None, "bool": True},
+    }
+
+    encoded = codec.dumps(obj)
+    assert isinstance(encoded, bytes)
+    assert codec.loads(encoded) == obj
+    assert codec.loads(encoded.decode("utf-8")) == obj
+    assert codec.loads(bytearray(encoded)) == obj
+
+    # Encoded as UTF-8, without escaping.
+    assert "café".encode("utf-8") in encoded
+
+
+def test_dumps_compact_and_sorted(codec):
+    assert codec.dumps({"b": 1, "a": [1, 2]}, sort_keys=True) == b'{"a":[1,2],"b":1}'
+
+
+def test_dumps_non_string_keys(codec):
+    assert codec.loads(codec.dumps({1: "a"})) == {"1": "a"}
+
+
+def test_dumps_default(codec):
+    class Opaque:
+        pass
+
+    with pytest.raises(TypeError):
+        codec.dumps({"value": Opaque()})
+
+    assert codec.loads(codec.dumps({"value": Opaque()}, default=lambda value: "opaque")) == {"value": "opaque"}
+
+
+def test_loads_invalid(codec):
+    with pytest.raises(ValueError):
+        codec.loads(b'{"user_name": ')
@@ -5,6 +5,7 @@ Executed against the development database.
 """
 
 import collections
+import concurrent.futures
 import pytest
 import requests
 import requests.auth
@@ -13,14 +14,17 @@ from urllib.parse import urljoin
 
 import migraine_shared.config
 import migraine_shared.database
+import migraine_shared.testing
 
 # Execute tests against only development.
 from tests.common.test_config_dev import test_config
 from tests.common.test_config_dev import couchdb_config
 from tests.common.test_config_dev import couchdb_session_admin
+from tests.common.test_config_dev import couchdb_round_trips
 assert test_config
 assert couchdb_config
 assert couchdb_session_admin
+assert couchdb_round_trips
 
 AccountTuple = collections.namedtuple('AccountTuple', ['user', 'password'])
 
@@ -31,7 +35,7 @@ def account_primary():
     Account information for a primary test user.
     """
 
-    return AccountTuple('test.account.primary', secrets.token_urlsafe())
+    return AccountTuple(migraine_shared.testing.unique_account_name(prefix='test.primary'), secrets.token_urlsafe())
 
 
 @pytest.fixture
@@ -40,12 +44,14 @@ def account_secondary():
     Account information for a secondary test user.
     """
 
-    return AccountTuple('test.account.secondary', secrets.token_urlsafe())
+    return AccountTuple(migraine_shared.testing.unique_account_name(prefix='test.secondary'), secrets.token_urlsafe())
 
 
+@pytest.mark.couchdb_round_trips(create_account=5, delete_account=3)
 def test_admin_account_creation_and_deletion(
     couchdb_config: migraine_shared.config.CouchDBConfig,
     couchdb_session_admin: requests.Session,
+    couchdb_round_trips: migraine_shared.testing.RoundTripRecorder,
     account_primary: AccountTuple
 ):
     """
@@ -57,11 +63,12 @@ def test_admin_account_creation_and_deletion(
     user_database = migraine_shared.database.database_for_user(user=account_primary.user)
 
     # Ensure account does not exist, in case of previous test failure.
-    response = migraine_shared.database.delete_account(
-        couchdb_session_admin=couchdb_session_admin,
-        couchdb_baseurl=couchdb_config.baseurl,
-        account=account_primary.user,
-    )
+    with couchdb_round_trips.operation("delete_account"):
+        response = migraine_shared.database.delete_account(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_config.baseurl,
+            account=account_primary.user,
+        )
     assert response.status_code in [204, 404]  # OK No Content, Not Found
 
     # Ensure the user does not exist.
@@ -77,12 +84,13 @@ def test_admin_account_creation_and_deletion(
     assert response.status_code == 404  # Not Found
 
     # Perform account creation.
-    response = migraine_shared.database.create_account(
-        couchdb_session_admin=couchdb_session_admin,
-        couchdb_baseurl=couchdb_config.baseurl,
-        account=account_primary.user,
-        password=account_primary.password,
-    )
+    with couchdb_round_trips.operation("create_account"):
+        response = migraine_shared.database.create_account(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_config.baseurl,
+            account=account_primary.user,
+            password=account_primary.password,
+        )
     assert response.status_code == 200  # OK
 
     # Confirm the user now exists.
@@ -98,11 +106,12 @@ def test_admin_account_creation_and_deletion(
     assert response.ok
 
     # Perform account deletion.
-    response = migraine_shared.database.delete_account(
-        couchdb_session_admin=couchdb_session_admin,
-        couchdb_baseurl=couchdb_config.baseurl,
-        account=account_primary.user,
-    )
+    with couchdb_round_trips.operation("delete_account"):
+        response = migraine_shared.database.delete_account(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_config.baseurl,
+            account=account_primary.user,
+        )
     assert response.status_code == 204  # OK No Content
 
     # Ensure the user does not exist.
@@ -274,3 +283,158 @@ def test_account_document_secure(
         urljoin(couchdb_config.baseurl, "{}/{}".format(account_primary_database, "_all_docs"))
     )
     assert response.status_code == 401  # Unauthorized
+
+
+def _session_admin(couchdb_config: migraine_shared.config.CouchDBConfig) -> requests.Session:
+    """
+    Helper providing a separate session authenticated as the admin, for concurrent use by one thread.
+    """
+
+    session = requests.Session()
+    session.auth = requests.auth.HTTPBasicAuth(
+        username=couchdb_config.admin_user,
+        password=couchdb_config.admin_password,
+    )
+
+    return session
+
+
+class _FailingSecuritySession(requests.Session):
+    """
+    Session in which every write of a _security document fails, as if the database were unavailable.
+    """
+
+    def request(self, method, url, *args, **kwargs):
+        if method.upper() == "PUT" and url.endswith("/_security"):
+            response = requests.Response()
+            response.status_code = 503
+            response.reason = "Service Unavailable"
+            return response
+
+        return super().request(method, url, *args, **kwargs)
+
+
+def _delete_account(
+    couchdb_config: migraine_shared.config.CouchDBConfig,
+    couchdb_session_admin: requests.Session,
+    account: str,
+):
+    response = migraine_shared.database.delete_account(
+        couchdb_session_admin=couchdb_session_admin,
+        couchdb_baseurl=couchdb_config.routing,
+        account=account,
+    )
+    assert response.status_code in [204, 404]  # OK No Content, Not Found
+
+
+def test_account_creation_optimistic_race(
+    couchdb_config: migraine_shared.config.CouchDBConfig,
+    couchdb_session_admin: requests.Session,
+    account_primary: AccountTuple,
+):
+    """
+    Test concurrent optimistic creations of an account, of which exactly one succeeds.
+    """
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+            responses = list(executor.map(
+                lambda session: migraine_shared.database.create_account(
+                    couchdb_session_admin=session,
+                    couchdb_baseurl=couchdb_config.routing,
+                    account=account_primary.user,
+                    password=account_primary.password,
+                    optimistic=True,
+                ),
+                [_session_admin(couchdb_config), _session_admin(couchdb_config)],
+            ))
+
+        assert sorted(response.status_code for response in responses) == [200, 409]  # OK, Conflict
+
+        # The successful creation is intact
+        assert migraine_shared.database.lookup_accounts(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_config.routing,
+            accounts=[account_primary.user],
+        ) == {account_primary.user: True}
+    finally:
+        _delete_account(couchdb_config, couchdb_session_admin, account_primary.user)
+
+
+def test_account_creation_optimistic_database_exists(
+    couchdb_config: migraine_shared.config.CouchDBConfig,
+    couchdb_session_admin: requests.Session,
+    account_primary: AccountTuple,
+):
+    """
+    Test optimistic creation when the database already exists, which rolls back the user but not the database.
+    """
+
+    baseurl = migraine_shared.database.baseurl_for_user(couchdb_baseurl=couchdb_config.routing, user=account_primary.user)
+    user_doc_id = "org.couchdb.user:{}".format(account_primary.user)
+    user_database = migraine_shared.database.database_for_user(user=account_primary.user)
+
+    try:
+        response = migraine_shared.database.create_database(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_config.routing,
+            account=account_primary.user,
+        )
+        assert response.ok
+
+        response = migraine_shared.database.create_account(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_config.routing,
+            account=account_primary.user,
+            password=account_primary.password,
+            optimistic=True,
+        )
+        assert response.status_code == 409  # Conflict
+
+        # The user was rolled back
+        response = couchdb_session_admin.get(urljoin(baseurl, "_users/{}".format(user_doc_id)))
+        assert response.status_code == 404  # Not Found
+
+        # The database existed before, so was not rolled back
+        response = couchdb_session_admin.head(urljoin(baseurl, user_database))
+        assert response.ok
+    finally:
+        _delete_account(couchdb_config, couchdb_session_admin, account_primary.user)
+
+
+def test_account_creation_optimistic_database_failure(
+    couchdb_config: migraine_shared.config.CouchDBConfig,
+    couchdb_session_admin: requests.Session,
+    account_primary: AccountTuple,
+):
+    """
+    Test optimistic creation when creating the database fails, which rolls back both the user and the database.
+    """
+
+    baseurl = migraine_shared.database.baseurl_for_user(couchdb_baseurl=couchdb_config.routing, user=account_primary.user)
+    user_doc_id = "org.couchdb.user:{}".format(account_primary.user)
+    user_database = migraine_shared.database.database_for_user(user=account_primary.user)
+
+    failing_session = _FailingSecuritySession()
+    failing_session.auth = requests.auth.HTTPBasicAuth(
+        username=couchdb_config.admin_user,
+        password=couchdb_config.admin_password,
+    )
+
+    try:
+        response = migraine_shared.database.create_account(
+            couchdb_session_admin=failing_session,
+            couchdb_baseurl=couchdb_config.routing,
+            account=account_primary.user,
+            password=account_primary.password,
+            optimistic=True,
+        )
+        assert response.status_code == 503  # Service Unavailable
+
+        # Both the user and the database were rolled back
+        response = couchdb_session_admin.get(urljoin(baseurl, "_users/{}".format(user_doc_id)))
+        assert response.status_code == 404  # Not Found
+        response = couchdb_session_admin.head(urljoin(baseurl, user_database))
+        assert response.status_code == 404  # Not Found
+    finally:
+        _delete_account(couchdb_config, couchdb_session_admin, account_primary.user)
@@ -0,0 +1,114 @@
+"""
+Tests for derivation of password keys, including in a process pool.
+"""
+
+import concurrent.futures
+import hashlib
+import pytest
+import requests
+
+import migraine_shared.config
+import migraine_shared.database
+import migraine_shared.password
+import migraine_shared.session
+
+from tests.common.fake_couchdb import fake_couchdb_session
+
+BASEURL = "http://couchdb.test/"
+
+
+def _verify(*, password_fields: dict, password: str) -> bool:
+    return hashlib.pbkdf2_hmac(
+        migraine_shared.password.PBKDF2_HASH_NAME,
+        password.encode("utf-8"),
+        password_fields["salt"].encode("utf-8"),
+        password_fields["iterations"],
+        migraine_shared.password.PBKDF2_DERIVED_KEY_LENGTH,
+    ).hex() == password_fields["derived_key"]
+
+
+def test_derive_password_fields():
+    password_fields = migraine_shared.password.derive_password_fields(password="secret", iterations=10)
+
+    assert password_fields["password_scheme"] == "pbkdf2"
+    assert password_fields["iterations"] == 10
+    assert _verify(password_fields=password_fields, password="secret")
+    assert not _verify(password_fields=password_fields, password="other")
+
+    # Each derivation has its own salt.
+    assert migraine_shared.password.derive_password_fields(password="secret", iterations=10)["salt"] != (
+        password_fields["salt"]
+    )
+
+
+def test_create_account_password_executor():
+    session, clusters = fake_couchdb_session(baseurls=[BASEURL])
+
+    with migraine_shared.password.create_password_executor() as password_executor:
+        assert password_executor._max_workers == migraine_shared.password.PASSWORD_EXECUTOR_DEFAULT_WORKERS
+
+        response = migraine_shared.database.create_account(
+            couchdb_session_admin=session,
+            couchdb_baseurl=BASEURL,
+            account="account",
+            password="secret",
+            password_executor=password_executor,
+            password_iterations=10,
+        )
+        assert response.status_code == 200
+
+    user_doc = clusters[BASEURL].live_documents(database="_users")["org.couchdb.user:account"]
+    assert "password" not in user_doc
+    assert _verify(password_fields=user_doc, password="secret")
+
+
+class _StalledExecutor(concurrent.futures.Executor):
+    """
+    Executor whose every derivation is queued and never runs.
+    """
+
+    def __init__(self):
+        self.futures = []
+
+    def submit(self, fn, /, *args, **kwargs):
+        self.futures.append(concurrent.futures.Future())
+        return self.futures[-1]
+
+
+def test_create_account_password_executor_deadline():
+    password_executor = _StalledExecutor()
+
+    with migraine_shared.session.deadline(0.05):
+        with pytest.raises(migraine_shared.session.DeadlineExceeded):
+            migraine_shared.database.create_account(
+                couchdb_session_admin=requests.Session(),
+                couchdb_baseurl=BASEURL,
+                account="account",
+                password="secret",
+                password_executor=password_executor,
+            )
+
+    # The queued derivation is abandoned, rather than later occupying a process.
+    assert password_executor.futures[0].cancelled()
+
+
+def test_flask_config_password_hash():
+    yaml_config = {
+        "baseurl": "http://flask.test/",
+        "secret_key": "secret",
+        "database_baseurl": BASEURL,
+        "database_admin": {"user": "admin", "password": "password"},
+    }
+
+    flask_config = migraine_shared.config.FlaskConfig.parse(yaml_config)
+    assert flask_config.password_hash_iterations is None
+    assert flask_config.password_hash_processes == migraine_shared.password.PASSWORD_EXECUTOR_DEFAULT_WORKERS
+
+    # Values may be provided as strings, as when templated into configuration.
+    flask_config = migraine_shared.config.FlaskConfig.parse(dict(
+        yaml_config,
+        password_hash_iterations="100000",
+        password_hash_processes="2",
+    ))
+    assert flask_config.password_hash_iterations == 100000
+    assert flask_config.password_hash_processes == 2
@@ -0,0 +1,213 @@
+"""
+Tests for operations across several clusters, including migration of a hash range between clusters.
+
+Executed against in-memory clusters, as development has only one cluster.
+"""
+
+import pytest
+
+import migraine_shared.database
+import migraine_shared.rebalance
+from migraine_shared.routing import ClusterRoute
+from migraine_shared.routing import RoutingTable
+
+from tests.common.fake_couchdb import FakeCluster
+from tests.common.fake_couchdb import fake_couchdb_session
+
+BASEURL_A = "http://cluster-a.test/"
+BASEURL_B = "http://cluster-b.test/"
+BASEURL_C = "http://cluster-c.test/"
+
+ROUTING = RoutingTable(routes=(
+    ClusterRoute(baseurl=BASEURL_A, hash_start="0", hash_end="7"),
+    ClusterRoute(baseurl=BASEURL_B, hash_start="8", hash_end="f"),
+))
+
+ACCOUNTS = ["account{}".format(index) for index in range(40)]
+
+
+def _hash(account: str) -> str:
+    return migraine_shared.database.database_for_user(user=account)[len("user_"):]
+
+
+def _create_account(cluster: FakeCluster, account: str):
+    database = migraine_shared.database.database_for_user(user=account)
+    cluster.put_document(
+        database="_users",
+        doc_id="org.couchdb.user:{}".format(account),
+        doc={"name": account, "type": "user", "roles": []},
+    )
+    cluster.databases[database] = {}
+    cluster.security[database] = {"members": {"names": [account]}}
+
+
+def _accounts(cluster: FakeCluster):
+    return sorted(
+        doc["name"]
+        for doc in cluster.live_documents(database="_users").values()
+    )
+
+
+def _databases(cluster: FakeCluster):
+    return sorted(database for database in cluster.databases if database.startswith("user_"))
+
+
+@pytest.fixture
+def clusters():
+    session, clusters = fake_couchdb_session(baseurls=[BASEURL_A, BASEURL_B, BASEURL_C])
+    for account in ACCOUNTS:
+        _create_account(clusters[ROUTING.baseurl_for_database(
+            database=migraine_shared.database.database_for_user(user=account),
+        )], account)
+
+    return session, clusters
+
+
+def test_lookup_accounts_multiple_clusters(clusters):
+    session, clusters = clusters
+
+    # An account whose user document exists but whose database does not.
+    missing_database = ACCOUNTS[0]
+    del clusters[ROUTING.baseurl_for_database(
+        database=migraine_shared.database.database_for_user(user=missing_database),
+    )].databases[migraine_shared.database.database_for_user(user=missing_database)]
+
+    result = migraine_shared.database.lookup_accounts(
+        couchdb_session_admin=session,
+        couchdb_baseurl=ROUTING,
+        accounts=ACCOUNTS + ["missing", "_invalid"],
+    )
+
+    assert result == dict(
+        {account: True for account in ACCOUNTS[1:]},
+        **{missing_database: False, "missing": False, "_invalid": False},
+    )
+
+
+def test_user_databases_page_multiple_clusters(clusters):
+    session, clusters = clusters
+
+    databases = []
+    start = None
+    while True:
+        databases_page, start = migraine_shared.database.user_databases_page(
+            couchdb_session_admin=session,
+            couchdb_baseurl=ROUTING,
+            start=start,
+            limit=7,
+        )
+        assert len(databases_page) <= 7
+        databases.extend(databases_page)
+        if start is None:
+            break
+
+    assert databases == sorted(migraine_shared.database.database_for_user(user=account) for account in ACCOUNTS)
+
+    # A prefix begins the page at the first database with that prefix.
+    databases_page, _ = migraine_shared.database.user_databases_page(
+        couchdb_session_admin=session,
+        couchdb_baseurl=ROUTING,
+        start="user_8",
+        limit=1000,
+    )
+    assert databases_page == _databases(clusters[BASEURL_B])
+
+    for start in ["foo", "user_zz", "user_"]:
+        with pytest.raises(ValueError):
+            migraine_shared.database.user_databases_page(
+                couchdb_session_admin=session,
+                couchdb_baseurl=ROUTING,
+                start=start,
+                limit=10,
+            )
+
+
+def test_migrate_hash_range(clusters):
+    session, clusters = clusters
+
+    in_range = sorted(account for account in ACCOUNTS if "4" <= _hash(account)[0] <= "9")
+    assert any(_hash(account) < "8" for account in in_range)
+    assert any(_hash(account) >= "8" for account in in_range)
+
+    # Step 1: copy the range while the current routing table is deployed.
+    report = migraine_shared.rebalance.migrate_hash_range(
+        couchdb_session_admin=session,
+        routing=ROUTING,
+        admin_user="admin",
+        admin_password="password",
+        hash_start="4",
+        hash_end="9",
+        target_baseurl=BASEURL_C,
+    )
+
+    assert report.routing == RoutingTable(routes=(
+        ClusterRoute(baseurl=BASEURL_A, hash_start="0", hash_end="3"),
+        ClusterRoute(baseurl=BASEURL_C, hash_start="4", hash_end="9"),
+        ClusterRoute(baseurl=BASEURL_B, hash_start="a", hash_end="f"),
+    ))
+    assert sorted(report.users) == in_range
+    assert _accounts(clusters[BASEURL_C]) == in_range
+    assert _databases(clusters[BASEURL_C]) == sorted(
+        migraine_shared.database.database_for_user(user=account) for account in in_range
+    )
+    for account in in_range:
+        database = migraine_shared.database.database_for_user(user=account)
+        assert clusters[BASEURL_C].security[database] == {"members": {"names": [account]}}
+
+    # An account created in the range on its source before the new routing table is deployed.
+    created = next(
+        "created{}".format(index)
+        for index in range(1000)
+        if "4" <= _hash("created{}".format(index))[0] <= "7"
+    )
+    _create_account(clusters[BASEURL_A], created)
+
+    # Step 3: after the new routing table is deployed, copy anything new and delete the source copies.
+    report = migraine_shared.rebalance.migrate_hash_range(
+        couchdb_session_admin=session,
+        routing=report.routing,
+        admin_user="admin",
+        admin_password="password",
+        hash_start="4",
+        hash_end="9",
+        target_baseurl=BASEURL_C,
+        delete_source=True,
+    )
+
+    assert sorted(report.users) == sorted(in_range + [created])
+    assert _accounts(clusters[BASEURL_C]) == sorted(in_range + [created])
+    for baseurl in [BASEURL_A, BASEURL_B]:
+        assert not set(_accounts(clusters[baseurl])) & set(in_range + [created])
+        assert all(not "4" <= database[len("user_")] <= "9" for database in _databases(clusters[baseurl]))
+
+    # Every account remains.
+    assert all(migraine_shared.database.lookup_accounts(
+        couchdb_session_admin=session,
+        couchdb_baseurl=report.routing,
+        accounts=ACCOUNTS + [created],
+    ).values())
+
+
+def test_migrate_hash_range_source_not_routed(clusters):
+    session, clusters = clusters
+
+    # The target serves every range previously served by cluster A, which is no longer routed.
+    routing = ROUTING.reassign(hash_start="0", hash_end="7", baseurl=BASEURL_C)
+    assert BASEURL_A not in routing.baseurls
+
+    report = migraine_shared.rebalance.migrate_hash_range(
+        couchdb_session_admin=session,
+        routing=routing,
+        admin_user="admin",
+        admin_password="password",
+        hash_start="0",
+        hash_end="7",
+        target_baseurl=BASEURL_C,
+        delete_source=True,
+        source_baseurls=[BASEURL_A],
+    )
+
+    assert report.routing == routing
+    assert _accounts(clusters[BASEURL_A]) == []
+    assert _databases(clusters[BASEURL_A]) == []
+    assert _accounts(clusters[BASEURL_C]) == sorted(account for account in ACCOUNTS if _hash(account) < "8")
@@ -0,0 +1,153 @@
+"""
+Tests for reconciliation of user documents with user databases.
+
+Executed against the development database.
+Repair is tested only on the accounts created by a test, as other mismatches may exist in development.
+"""
+
+import requests
+import secrets
+from urllib.parse import urljoin
+
+import migraine_shared.config
+import migraine_shared.database
+import migraine_shared.reconcile
+import migraine_shared.testing
+
+# Execute tests against only development.
+from tests.common.test_config_dev import test_config
+from tests.common.test_config_dev import couchdb_config
+from tests.common.test_config_dev import couchdb_session_admin
+assert test_config
+assert couchdb_config
+assert couchdb_session_admin
+
+
+def test_merge_join():
+    users = sorted([
+        (migraine_shared.database.database_for_user(user=user), user)
+        for user in ["alice", "bob", "carol"]
+    ])
+    databases = sorted([
+        migraine_shared.database.database_for_user(user=user)
+        for user in ["bob", "carol", "dave"]
+    ])
+
+    users_without_database, databases_without_user = migraine_shared.reconcile._merge_join(
+        users=users,
+        databases=iter(databases),
+    )
+
+    assert users_without_database == ["alice"]
+    assert databases_without_user == [migraine_shared.database.database_for_user(user="dave")]
+
+
+def test_merge_join_empty():
+    assert migraine_shared.reconcile._merge_join(users=[], databases=iter([])) == ([], [])
+    assert migraine_shared.reconcile._merge_join(
+        users=[("user_00", "alice")],
+        databases=iter([]),
+    ) == (["alice"], [])
+    assert migraine_shared.reconcile._merge_join(
+        users=[],
+        databases=iter(["user_00"]),
+    ) == ([], ["user_00"])
+
+
+def test_reconcile_accounts(
+    couchdb_config: migraine_shared.config.CouchDBConfig,
+    couchdb_session_admin: requests.Session,
+):
+    """
+    Test a user without a database and a database without a user are found, then repaired.
+    """
+
+    user_without_database = migraine_shared.testing.unique_account_name(prefix="test.orphan")
+    user_deleted = migraine_shared.testing.unique_account_name(prefix="test.orphan")
+    database_without_user = migraine_shared.database.database_for_user(user=user_deleted)
+
+    baseurl_user_without_database = migraine_shared.database.baseurl_for_user(
+        couchdb_baseurl=couchdb_config.routing,
+        user=user_without_database,
+    )
+
+    try:
+        # A user document without a database
+        response = couchdb_session_admin.put(
+            urljoin(baseurl_user_without_database, "_users/org.couchdb.user:{}".format(user_without_database)),
+            json={
+                "type": "user",
+                "name": user_without_database,
+                "roles": [],
+                "password": secrets.token_urlsafe(),
+            },
+        )
+        assert response.ok
+
+        # A database without a user document
+        response = migraine_shared.database.create_database(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_config.routing,
+            account=user_deleted,
+        )
+        assert response.ok
+
+        # Find without repair
+        report = migraine_shared.reconcile.reconcile_accounts(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_config.routing,
+            repair=False,
+        )
+        assert user_without_database in report.users_without_database
+        assert database_without_user in report.databases_without_user
+        assert not report.consistent
+        assert report.users_repaired == []
+        assert report.databases_repaired == []
+
+        # Repair only the mismatches created by this test
+        users_repaired, databases_repaired = migraine_shared.reconcile._repair(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=baseurl_user_without_database,
+            users_without_database=[user_without_database],
+            databases_without_user=[],
+        )
+        assert users_repaired == [user_without_database]
+        users_repaired, databases_repaired = migraine_shared.reconcile._repair(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=migraine_shared.database.baseurl_for_user(
+                couchdb_baseurl=couchdb_config.routing,
+                user=user_deleted,
+            ),
+            users_without_database=[],
+            databases_without_user=[database_without_user],
+        )
+        assert databases_repaired == [database_without_user]
+
+        # The user now has a database, and the database without a user is deleted
+        assert migraine_shared.database.lookup_accounts(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_config.routing,
+            accounts=[user_without_database],
+        ) == {user_without_database: True}
+        assert migraine_shared.database.databases_info(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_config.routing,
+            databases=[database_without_user],
+        ) == {database_without_user: None}
+
+        # Neither is reported again
+        report = migraine_shared.reconcile.reconcile_accounts(
+            couchdb_session_admin=couchdb_session_admin,
+            couchdb_baseurl=couchdb_config.routing,
+            repair=False,
+        )
+        assert user_without_database not in report.users_without_database
+        assert database_without_user not in report.databases_without_user
+    finally:
+        for user in [user_without_database, user_deleted]:
+            response = migraine_shared.database.delete_account(
+                couchdb_session_admin=couchdb_session_admin,
+                couchdb_baseurl=couchdb_config.routing,
+                account=user,
+            )
+            assert response.status_code in [204, 404]
@@ -0,0 +1,139 @@
+"""
+Tests for routing of user databases across clusters.
+"""
+
+import pytest
+import time
+
+from migraine_shared.routing import ClusterRoute
+from migraine_shared.routing import RoutingTable
+
+BASEURL_A = "http://cluster-a.test/"
+BASEURL_B = "http://cluster-b.test/"
+BASEURL_C = "http://cluster-c.test/"
+
+
+def _routing(*ranges) -> RoutingTable:
+    return RoutingTable(routes=tuple(
+        ClusterRoute(baseurl=baseurl, hash_start=hash_start, hash_end=hash_end)
+        for (baseurl, hash_start, hash_end) in ranges
+    ))
+
+
+def test_routing_table_valid():
+    _routing((BASEURL_A, "0", "f"))
+    _routing((BASEURL_A, "0", "7"), (BASEURL_B, "8", "f"))
+    _routing((BASEURL_B, "8", "f"), (BASEURL_A, "0", "7"))
+    _routing((BASEURL_A, "0", "7"), (BASEURL_B, "80", "bf"), (BASEURL_C, "c", "f"))
+
+
+@pytest.mark.parametrize(
+    "ranges",
+    [
+        # No routes
+        [],
+        # Gap at the beginning, middle, and end
+        [(BASEURL_A, "1", "f")],
+        [(BASEURL_A, "0", "6"), (BASEURL_B, "8", "f")],
+        [(BASEURL_A, "0", "e")],
+        [(BASEURL_A, "0", "7"), (BASEURL_B, "80", "fe")],
+        # Overlap
+        [(BASEURL_A, "0", "8"), (BASEURL_B, "8", "f")],
+        [(BASEURL_A, "0", "f"), (BASEURL_B, "f0", "ff")],
+        [(BASEURL_A, "0", "f"), (BASEURL_B, "0", "f")],
+        # Invalid ranges
+        [(BASEURL_A, "f", "0")],
+        [(BASEURL_A, "0", "ff")],
+        [(BASEURL_A, "0", "g")],
+        [(BASEURL_A, "", "")],
+    ],
+)
+def test_routing_table_invalid(ranges):
+    with pytest.raises(ValueError):
+        _routing(*ranges)
+
+
+def test_routing_table_long_prefixes():
+    # Coverage is validated without enumerating prefixes, so long prefixes are validated quickly.
+    start = time.monotonic()
+    _routing(
+        (BASEURL_A, "00000000", "7fffffff"),
+        (BASEURL_B, "80000000", "bfffffff"),
+        (BASEURL_C, "c", "f"),
+    )
+    assert time.monotonic() - start < 1
+
+    with pytest.raises(ValueError):
+        _routing(
+            (BASEURL_A, "00000000", "7ffffffe"),
+            (BASEURL_B, "80000000", "ffffffff"),
+        )
+
+
+def test_routing_table_parse():
+    routing = RoutingTable.parse([
+        {"baseurl": BASEURL_A, "hash_range": ["0", "7"]},
+        {"baseurl": BASEURL_B, "hash_range": ["8", "F"]},
+    ])
+
+    assert routing == _routing((BASEURL_A, "0", "7"), (BASEURL_B, "8", "f"))
+    assert RoutingTable.parse(routing.to_yaml_config()) == routing
+    assert routing.baseurls == [BASEURL_A, BASEURL_B]
+
+
+def test_route_for_database():
+    routing = _routing((BASEURL_A, "0", "7"), (BASEURL_B, "80", "bf"), (BASEURL_C, "c", "f"))
+
+    assert routing.baseurl_for_database(database="user_00000000000000000000000000000000") == BASEURL_A
+    assert routing.baseurl_for_database(database="user_7fffffffffffffffffffffffffffffff") == BASEURL_A
+    assert routing.baseurl_for_database(database="user_80000000000000000000000000000000") == BASEURL_B
+    assert routing.baseurl_for_database(database="user_bfffffffffffffffffffffffffffffff") == BASEURL_B
+    assert routing.baseurl_for_database(database="user_c0000000000000000000000000000000") == BASEURL_C
+
+    # A prefix is routed as the first database beginning with that prefix.
+    assert routing.baseurl_for_database(database="user_8") == BASEURL_B
+    assert routing.baseurl_for_database(database="user_c") == BASEURL_C
+
+    for database in ["foo", "user_", "user_zz", "user_8G", "_users", "user_{}".format("0" * 33)]:
+        with pytest.raises(ValueError):
+            routing.route_for_database(database=database)
+
+
+def test_group_databases():
+    routing = _routing((BASEURL_A, "0", "7"), (BASEURL_B, "8", "f"))
+
+    assert routing.group_databases(databases=["user_9", "user_1", "user_f", "user_0"]) == {
+        BASEURL_B: ["user_9", "user_f"],
+        BASEURL_A: ["user_1", "user_0"],
+    }
+
+
+def test_intersect():
+    routing = _routing((BASEURL_A, "0", "7"), (BASEURL_B, "8", "f"))
+
+    assert routing.intersect(hash_start="6", hash_end="9") == [
+        ClusterRoute(baseurl=BASEURL_A, hash_start="6", hash_end="7"),
+        ClusterRoute(baseurl=BASEURL_B, hash_start="8", hash_end="9"),
+    ]
+    assert routing.intersect(hash_start="40", hash_end="4f") == [
+        ClusterRoute(baseurl=BASEURL_A, hash_start="40", hash_end="4f"),
+    ]
+
+
+def test_reassign():
+    routing = _routing((BASEURL_A, "0", "7"), (BASEURL_B, "8", "f"))
+
+    assert routing.reassign(hash_start="4", hash_end="9", baseurl=BASEURL_C) == _routing(
+        (BASEURL_A, "0", "3"),
+        (BASEURL_C, "4", "9"),
+        (BASEURL_B, "a", "f"),
+    )
+    assert routing.reassign(hash_start="40", hash_end="4f", baseurl=BASEURL_C) == _routing(
+        (BASEURL_A, "00", "3f"),
+        (BASEURL_C, "40", "4f"),
+        (BASEURL_A, "50", "7f"),
+        (BASEURL_B, "80", "ff"),
+    )
+    assert routing.reassign(hash_start="0", hash_end="f", baseurl=BASEURL_C) == _routing(
+        (BASEURL_C, "0", "f"),
+    )
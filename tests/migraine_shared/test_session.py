@@ -0,0 +1,159 @@
+"""
+Tests for the deadlines and circuit breaker of CouchDB sessions.
+"""
+
+import pytest
+import requests
+import requests.adapters
+
+import migraine_shared.session
+from migraine_shared.session import CircuitBreaker
+from migraine_shared.session import CircuitOpen
+from migraine_shared.session import CouchDBSession
+from migraine_shared.session import DeadlineExceeded
+
+BASEURL = "http://couchdb.test/"
+HOST = "couchdb.test"
+
+
+class _Adapter(requests.adapters.BaseAdapter):
+    """
+    Transport whose every call has the next outcome: a status code, or an exception to raise.
+    """
+
+    def __init__(self, outcomes):
+        super().__init__()
+        self.outcomes = list(outcomes)
+        self.calls = 0
+
+    def close(self):
+        pass
+
+    def send(self, request, **kwargs):
+        self.calls += 1
+        outcome = self.outcomes.pop(0)
+        if isinstance(outcome, Exception):
+            raise outcome
+
+        response = requests.Response()
+        response.status_code = outcome
+        response._content = b"{}"
+        response.request = request
+
+        return response
+
+
+@pytest.fixture
+def now(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(migraine_shared.session, "timer", lambda: now[0])
+
+    return now
+
+
+def _session(circuit_breaker: CircuitBreaker, outcomes) -> CouchDBSession:
+    session = CouchDBSession(circuit_breaker=circuit_breaker)
+    session.mount(BASEURL, _Adapter(outcomes))
+
+    return session
+
+
+def _open(circuit_breaker: CircuitBreaker, now):
+    for _ in range(migraine_shared.session.CIRCUIT_FAILURE_THRESHOLD):
+        circuit_breaker.record(host=HOST, success=False)
+
+    with pytest.raises(CircuitOpen):
+        circuit_breaker.before_call(host=HOST)
+
+    # Allow a trial.
+    now[0] += migraine_shared.session.CIRCUIT_RESET_TIMEOUT + 1
+
+
+def test_circuit_trial_success_closes(now):
+    circuit_breaker = CircuitBreaker()
+    _open(circuit_breaker, now)
+
+    assert _session(circuit_breaker, [200]).get(BASEURL).status_code == 200
+    assert circuit_breaker.before_call(host=HOST) is False
+
+
+def test_circuit_trial_failure_reopens(now):
+    circuit_breaker = CircuitBreaker()
+    _open(circuit_breaker, now)
+
+    assert _session(circuit_breaker, [500]).post(BASEURL).status_code == 500
+    with pytest.raises(CircuitOpen):
+        circuit_breaker.before_call(host=HOST)
+
+
+def test_circuit_single_trial(now):
+    circuit_breaker = CircuitBreaker()
+    _open(circuit_breaker, now)
+
+    assert circuit_breaker.before_call(host=HOST) is True
+    with pytest.raises(CircuitOpen):
+        circuit_breaker.before_call(host=HOST)
+
+
+def test_circuit_trial_released_after_deadline(now):
+    circuit_breaker = CircuitBreaker()
+    _open(circuit_breaker, now)
+
+    session = _session(circuit_breaker, [200])
+    with migraine_shared.session.deadline(1):
+        now[0] += 2
+        with pytest.raises(DeadlineExceeded):
+            session.get(BASEURL)
+
+    # The call was not attempted, so a later call is still the trial.
+    assert session.get(BASEURL).status_code == 200
+    assert circuit_breaker.before_call(host=HOST) is False
+
+
+def test_circuit_trial_released_after_error(now):
+    circuit_breaker = CircuitBreaker()
+    _open(circuit_breaker, now)
+
+    session = _session(circuit_breaker, [requests.exceptions.InvalidHeader("invalid"), 200])
+    with pytest.raises(requests.exceptions.InvalidHeader):
+        session.get(BASEURL)
+
+    assert session.get(BASEURL).status_code == 200
+    assert circuit_breaker.before_call(host=HOST) is False
+
+
+def test_retry_records_each_attempt(now, monkeypatch):
+    monkeypatch.setattr(migraine_shared.session.time, "sleep", lambda seconds: None)
+
+    circuit_breaker = CircuitBreaker()
+    session = _session(circuit_breaker, [requests.exceptions.ConnectionError("refused"), 503, 200])
+
+    assert session.get(BASEURL).status_code == 200
+    assert session.adapters[BASEURL].calls == 3
+    assert circuit_breaker.before_call(host=HOST) is False
+
+
+def test_circuit_trial_released_after_deadline_timeout(now):
+    circuit_breaker = CircuitBreaker()
+    _open(circuit_breaker, now)
+
+    # The deadline shortened the timeout, so the timeout does not indicate a failure of the host.
+    session = _session(circuit_breaker, [requests.exceptions.ReadTimeout("timeout"), 200])
+    with migraine_shared.session.deadline(1):
+        with pytest.raises(requests.exceptions.ReadTimeout):
+            session.post(BASEURL)
+
+    assert session.post(BASEURL).status_code == 200
+    assert circuit_breaker.before_call(host=HOST) is False
+
+
+def test_circuit_trial_failure_after_timeout(now):
+    circuit_breaker = CircuitBreaker()
+    _open(circuit_breaker, now)
+
+    session = _session(circuit_breaker, [requests.exceptions.ReadTimeout("timeout")])
+    with pytest.raises(requests.exceptions.ReadTimeout):
+        session.post(BASEURL)
+
+    with pytest.raises(CircuitOpen):
+        circuit_breaker.before_call(host=HOST)
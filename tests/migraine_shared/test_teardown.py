@@ -0,0 +1,113 @@
+"""
+Tests for queued teardown of the databases of deleted accounts, against in-memory clusters.
+"""
+
+import migraine_shared.database
+import migraine_shared.reconcile
+
+from tests.common.fake_couchdb import fake_couchdb_session
+
+BASEURL = "http://couchdb.test/"
+
+
+def _create_account(*, session, clusters, account: str):
+    clusters[BASEURL].put_document(
+        database="_users",
+        doc_id="org.couchdb.user:{}".format(account),
+        doc={"name": account, "type": "user", "roles": []},
+    )
+    response = migraine_shared.database.create_database(
+        couchdb_session_admin=session,
+        couchdb_baseurl=BASEURL,
+        account=account,
+    )
+    assert response.ok
+
+
+def _delete_user_document(*, session, account: str):
+    response = migraine_shared.database.delete_user_document(
+        couchdb_session_admin=session,
+        couchdb_baseurl=BASEURL,
+        account=account,
+    )
+    assert response.status_code == 204
+
+
+def _queue(*, session, account: str):
+    response = migraine_shared.database.queue_database_teardown(
+        couchdb_session_admin=session,
+        couchdb_baseurl=BASEURL,
+        account=account,
+    )
+    assert response.status_code == 202
+
+
+def _pending(*, session):
+    return migraine_shared.database.pending_database_teardowns(couchdb_session_admin=session, couchdb_baseurl=BASEURL)
+
+
+def test_database_teardown():
+    session, clusters = fake_couchdb_session(baseurls=[BASEURL])
+    database = migraine_shared.database.database_for_user(user="alice")
+
+    # Nothing is pending before the teardown database is created
+    assert _pending(session=session) == []
+
+    _create_account(session=session, clusters=clusters, account="alice")
+
+    # Queueing is persisted and idempotent
+    _queue(session=session, account="alice")
+    _queue(session=session, account="alice")
+    assert _pending(session=session) == ["alice"]
+
+    _delete_user_document(session=session, account="alice")
+
+    response = migraine_shared.database.complete_database_teardown(
+        couchdb_session_admin=session,
+        couchdb_baseurl=BASEURL,
+        account="alice",
+    )
+    assert response.status_code == 204
+    assert database not in clusters[BASEURL].databases
+    assert _pending(session=session) == []
+
+
+def test_database_teardown_account_recreated():
+    session, clusters = fake_couchdb_session(baseurls=[BASEURL])
+    database = migraine_shared.database.database_for_user(user="alice")
+
+    _create_account(session=session, clusters=clusters, account="alice")
+    _queue(session=session, account="alice")
+
+    # The account exists when the teardown is completed (e.g., deleting its user document failed)
+    response = migraine_shared.database.complete_database_teardown(
+        couchdb_session_admin=session,
+        couchdb_baseurl=BASEURL,
+        account="alice",
+    )
+    assert response.status_code == 409
+    assert database in clusters[BASEURL].databases
+    assert _pending(session=session) == []
+
+
+def test_reconcile_completes_teardowns():
+    session, clusters = fake_couchdb_session(baseurls=[BASEURL])
+
+    _create_account(session=session, clusters=clusters, account="alice")
+    _create_account(session=session, clusters=clusters, account="bob")
+
+    # A teardown is queued, but the process that queued it stops before completing it
+    _queue(session=session, account="alice")
+    _delete_user_document(session=session, account="alice")
+
+    report = migraine_shared.reconcile.reconcile_accounts(
+        couchdb_session_admin=session,
+        couchdb_baseurl=BASEURL,
+        repair=False,
+    )
+
+    assert report.teardowns_completed == ["alice"]
+    assert report.consistent
+    assert migraine_shared.database.database_for_user(user="alice") not in clusters[BASEURL].databases
+    assert migraine_shared.database.database_for_user(user="bob") in clusters[BASEURL].databases
+    assert _pending(session=session) == []